@@ -0,0 +1,728 @@
+"""
+Benchmarks for deepES.
+
+Run all of them with ``python bench_deepes.py``, or pick some by name, e.g. ``python bench_deepes.py representation``.
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+from itertools import product
+from timeit import timeit
+from typing import FrozenSet, Optional
+
+from deepes import Position, Piece, Color, Move, parse_move, parse_san, parse_moves
+from deepes import CorpusProcessor, replay_game, _parse_fen, pack_positions, unpack_positions, evaluate, evaluate_batch
+from deepes import PositionDB, PositionRecord, OpeningBook, polyglot_key, encode_polyglot_move, Tablebases, Searcher
+from deepes import PawnHashTable, evaluate_pawns, ParallelSearcher, SQUARE_NAMES, SQUARE_INDICES, PROMOTIONS_BY_CODE
+
+FEN_CORPUS = (
+    'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1',
+    'rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq e3 0 1',
+    'r1bqkb1r/ppp2ppp/2np1n2/4p3/4P3/1P3N2/PBPP1PPP/RN1QKB1R w KQkq - 0 5',
+    'rn2kbn1/1ppb2p1/p7/1B1pppqp/2rPPPQP/1P6/P1P3PR/RNB1K1N1 w Qq - 6 11',
+    'rnbq1bn1/1ppp1p2/pB2k1r1/4p1Pp/2P5/2QP3R/PP2PPP1/RN2KBN1 b Q - 4 9',
+    'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1',
+    '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1',
+    'r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1',
+    'rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8',
+    'r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10',
+    '3R2R1/8/4k3/8/2r5/8/2r5/5K2 b - - 3 28',
+    '8/8/1K1k3r/8/4r3/8/8/R6R w - - 0 32',
+)
+
+
+class ArrayPosition:
+    """
+    Piece lookup and candidate target generation on a tuple-of-tuples board array: the methods of Position before it
+    was backed by bitboards, copied verbatim with their doctests left out. Kept here only as a baseline to measure
+    against.
+    """
+
+    def __init__(self, fen):
+        self._board_array = Position.board_array_from_fen_pieces(fen.split(' ')[0])
+        self._en_passant_target = fen.split(' ')[3]
+
+    @staticmethod
+    def square_str_to_xy(square_str):
+        return list('abcdefgh').index(square_str[0]), list('87654321').index(square_str[1])
+
+    @staticmethod
+    def square_xy_to_str(x, y):
+        return 'abcdefgh'[x] + '87654321'[y]
+
+    def find_pieces_xy(self, piece: Piece, color: Color) -> FrozenSet[tuple]:
+        char = piece.value.upper() if color == Color.WHITE else piece.value.lower()
+        return frozenset((x, y) for x in range(8) for y in range(8) if self._board_array[y][x] == char)
+
+    def _look_xy(self, x, y) -> str:
+        """Find character occupying xy"""
+        return self._board_array[y][x]
+
+    def _look_sq(self, square_str) -> str:
+        """Find character occupying square"""
+        return self._look_xy(*self.square_str_to_xy(square_str))
+
+    def _empty_xy(self, x, y) -> bool:
+        """Is xy empty?"""
+        return self._look_xy(x, y) == '.'
+
+    @staticmethod
+    def _xy_on_board(x, y) -> bool:
+        """Does xy exist on board?"""
+        return 0 <= x <= 7 and 0 <= y <= 7
+
+    def candidate_targets_from(self, origin: str) -> Optional[FrozenSet[str]]:
+        """
+        Return candidate targets for the piece in the given square.
+        "Candidate targets" meaning squares where the piece could move if we do not take into account checks.
+
+        Empty origin square returns None, and a non-empty square with no targets returns an empty frozenset.
+        """
+        char = self._look_sq(origin)
+        if char == '.':
+            return
+
+        piece_type = Piece(char.upper())
+        color = Color.WHITE if char.isupper() else Color.BLACK
+
+        candidates = set()
+
+        x, y = self.square_str_to_xy(origin)
+
+        # chains of positions a bishop, rook or queen moves in a single direction
+        horizontal_pos = ((d, 0) for d in range(1, 8))
+        horizontal_neg = ((-d, 0) for d in range(1, 8))
+        vertical_pos = ((0, d) for d in range(1, 8))
+        vertical_neg = ((0, -d) for d in range(1, 8))
+        diagonal_pos_pos = ((d, d) for d in range(1, 8))
+        diagonal_pos_neg = ((d, -d) for d in range(1, 8))
+        diagonal_neg_pos = ((-d, d) for d in range(1, 8))
+        diagonal_neg_neg = ((-d, -d) for d in range(1, 8))
+
+        if piece_type == Piece.PAWN:
+            start_y = 6 if color == Color.WHITE else 1
+            dy = -1 if color == Color.WHITE else 1
+
+            # moves straight ahead
+            if self._empty_xy(x, y+dy):
+                candidates.add(self.square_xy_to_str(x, y+dy))
+                if y == start_y and self._empty_xy(x, y+2*dy):  # rank 2
+                    candidates.add(self.square_xy_to_str(x, y+2*dy))
+
+            # capturing moves
+            for pxy in ((x-1, y+dy), (x+1, y+dy)):
+                if self._xy_on_board(*pxy):
+                    if self._look_xy(*pxy).islower() and color == Color.WHITE:
+                        candidates.add(self.square_xy_to_str(*pxy))
+                    if self._look_xy(*pxy).isupper() and color == Color.BLACK:
+                        candidates.add(self.square_xy_to_str(*pxy))
+
+                if self._en_passant_target != '-' and pxy == self.square_str_to_xy(self._en_passant_target):
+                    candidates.add(self._en_passant_target)
+
+        elif piece_type == Piece.KNIGHT:
+            possible_xys = (
+                (x+1, y+2), (x+1, y-2),
+                (x+2, y+1), (x+2, y-1),
+                (x-1, y+2), (x-1, y-2),
+                (x-2, y+1), (x-2, y-1)
+            )
+            for pxy in possible_xys:
+                if not self._xy_on_board(*pxy):
+                    continue
+                if self._empty_xy(*pxy):
+                    candidates.add(self.square_xy_to_str(*pxy))
+                # capturing moves
+                elif (self._look_xy(*pxy).islower() and color == Color.WHITE) \
+                        or (self._look_xy(*pxy).isupper() and color == Color.BLACK):
+                    candidates.add(self.square_xy_to_str(*pxy))
+
+        elif piece_type == Piece.BISHOP:
+            for direction_displacement_seq in diagonal_pos_pos, diagonal_pos_neg, diagonal_neg_pos, diagonal_neg_neg:
+                for dx, dy in direction_displacement_seq:
+                    pxy = x+dx, y+dy
+                    if not self._xy_on_board(*pxy):
+                        break
+                    if self._empty_xy(*pxy):
+                        candidates.add(self.square_xy_to_str(*pxy))
+                    else:
+                        if (self._look_xy(*pxy).islower() and color == Color.WHITE) \
+                                or (self._look_xy(*pxy).isupper() and color == Color.BLACK):
+                            candidates.add(self.square_xy_to_str(*pxy))
+                        break
+
+        elif piece_type == Piece.ROOK:
+            for direction_displacement_seq in horizontal_pos, horizontal_neg, vertical_pos, vertical_neg:
+                for dx, dy in direction_displacement_seq:
+                    pxy = x+dx, y+dy
+                    if not self._xy_on_board(*pxy):
+                        break
+                    if self._empty_xy(*pxy):
+                        candidates.add(self.square_xy_to_str(*pxy))
+                    else:
+                        if (self._look_xy(*pxy).islower() and color == Color.WHITE) \
+                                or (self._look_xy(*pxy).isupper() and color == Color.BLACK):
+                            candidates.add(self.square_xy_to_str(*pxy))
+                        break
+
+        elif piece_type == Piece.QUEEN:
+            for direction_displacement_seq in horizontal_pos, horizontal_neg, vertical_pos, vertical_neg, \
+                                              diagonal_pos_pos, diagonal_pos_neg, diagonal_neg_pos, diagonal_neg_neg:
+                for dx, dy in direction_displacement_seq:
+                    pxy = x+dx, y+dy
+                    if not self._xy_on_board(*pxy):
+                        break
+                    if self._empty_xy(*pxy):
+                        candidates.add(self.square_xy_to_str(*pxy))
+                    else:
+                        if (self._look_xy(*pxy).islower() and color == Color.WHITE) \
+                                or (self._look_xy(*pxy).isupper() and color == Color.BLACK):
+                            candidates.add(self.square_xy_to_str(*pxy))
+                        break
+
+        elif piece_type == Piece.KING:
+            displacements = set(product((-1, 0, 1), repeat=2))
+            displacements.remove((0, 0))
+            for dx, dy in displacements:
+                pxy = x+dx, y+dy
+                if not self._xy_on_board(*pxy):
+                    continue
+                if self._empty_xy(*pxy):
+                    candidates.add(self.square_xy_to_str(*pxy))
+                # capturing moves
+                elif (self._look_xy(*pxy).islower() and color == Color.WHITE) \
+                        or (self._look_xy(*pxy).isupper() and color == Color.BLACK):
+                    candidates.add(self.square_xy_to_str(*pxy))
+
+        return frozenset(candidates)
+
+
+def _occupied_squares(position):
+    return [Position.square_xy_to_str(x, y) for y in range(8) for x in range(8) if not position._empty_xy(x, y)]
+
+
+def _report(name, baseline_seconds, seconds):
+    print('{:<40} {:>10.1f} ms {:>10.1f} ms {:>8.2f}x'.format(
+        name, baseline_seconds * 1000, seconds * 1000, baseline_seconds / seconds))
+
+
+def _report_header(baseline_name, name):
+    print('{:<40} {:>13} {:>13} {:>9}'.format('', baseline_name, name, 'speedup'))
+
+
+def bench_representation(number=200):
+    """Piece lookup and candidate target generation: board array vs. bitboards."""
+    positions = [Position(fen) for fen in FEN_CORPUS]
+    references = [ArrayPosition(fen) for fen in FEN_CORPUS]
+    origins = [_occupied_squares(p) for p in positions]
+
+    for position, reference, squares in zip(positions, references, origins):
+        for square in squares:
+            assert position.candidate_targets_from(square) == reference.candidate_targets_from(square)
+
+    def lookup(ps):
+        for p in ps:
+            for piece in Piece:
+                for color in Color:
+                    p.find_pieces_xy(piece, color)
+
+    def targets(ps):
+        for p, squares in zip(ps, origins):
+            for square in squares:
+                p.candidate_targets_from(square)
+
+    _report_header('board array', 'bitboards')
+    _report('find_pieces_xy', timeit(lambda: lookup(references), number=number),
+            timeit(lambda: lookup(positions), number=number))
+    _report('candidate_targets_from', timeit(lambda: targets(references), number=number),
+            timeit(lambda: targets(positions), number=number))
+
+
+def bench_targets_per_piece(number=200):
+    """Candidate target generation per piece type: generator chains on the board array vs. attack tables."""
+    positions = [Position(fen) for fen in FEN_CORPUS]
+    references = [ArrayPosition(fen) for fen in FEN_CORPUS]
+
+    _report_header('generators', 'tables')
+    for piece in Piece:
+        origins = [[square for color in Color for square in p.find_pieces(piece, color)] for p in positions]
+
+        def targets(ps):
+            for p, squares in zip(ps, origins):
+                for square in squares:
+                    p.candidate_targets_from(square)
+
+        _report(piece.name.lower(), timeit(lambda: targets(references), number=number),
+                timeit(lambda: targets(positions), number=number))
+
+
+def bench_move_codes(number=200):
+    """Legal move generation: a new Move per move vs. packed move codes, and shared Moves looked up by code."""
+    positions = [Position(fen) for fen in FEN_CORPUS]
+
+    def constructed():
+        for p in positions:
+            [Move(code & 63, code >> 6 & 63, PROMOTIONS_BY_CODE[code >> 12]) for code in p._legal_move_codes()]
+
+    def codes():
+        for p in positions:
+            p._legal_move_codes()
+
+    def looked_up():
+        for p in positions:
+            p.legal_moves()
+
+    _report_header('new Moves', 'codes')
+    _report('move codes', timeit(constructed, number=number), timeit(codes, number=number))
+    _report('legal_moves()', timeit(constructed, number=number), timeit(looked_up, number=number))
+
+
+def baseline_attacked_squares(reference, color):
+    """
+    Names of the squares attacked by `color` on the board array of an ArrayPosition, as a set of strings, in the
+    style of its candidate_targets_from() but with pawn captures only and the squares of own pieces included
+    """
+    attacked = set()
+    for x in range(8):
+        for y in range(8):
+            char = reference._look_xy(x, y)
+            if char == '.' or char.isupper() != (color == Color.WHITE):
+                continue
+            piece_type = Piece(char.upper())
+            if piece_type == Piece.PAWN:
+                dy = -1 if color == Color.WHITE else 1
+                steps, sliding = ((-1, dy), (1, dy)), False
+            elif piece_type == Piece.KNIGHT:
+                steps, sliding = ((1, 2), (1, -2), (2, 1), (2, -1), (-1, 2), (-1, -2), (-2, 1), (-2, -1)), False
+            elif piece_type == Piece.KING:
+                steps, sliding = tuple(step for step in product((-1, 0, 1), repeat=2) if step != (0, 0)), False
+            else:
+                steps, sliding = (), True
+                if piece_type in (Piece.ROOK, Piece.QUEEN):
+                    steps += ((1, 0), (-1, 0), (0, 1), (0, -1))
+                if piece_type in (Piece.BISHOP, Piece.QUEEN):
+                    steps += ((1, 1), (1, -1), (-1, 1), (-1, -1))
+            for dx, dy in steps:
+                px, py = x + dx, y + dy
+                while reference._xy_on_board(px, py):
+                    attacked.add(reference.square_xy_to_str(px, py))
+                    if not sliding or not reference._empty_xy(px, py):
+                        break
+                    px, py = px + dx, py + dy
+    return attacked
+
+
+def bench_attacks(number=200):
+    """Which squares the enemy attacks: a set of names built on the board array vs. reverse lookups and attack maps."""
+    positions = [Position(fen) for fen in FEN_CORPUS]
+    enemies = [(p, Color.BLACK if p._active_color == Color.WHITE else Color.WHITE) for p in positions]
+    references = [(ArrayPosition(fen), enemy) for fen, (_, enemy) in zip(FEN_CORPUS, enemies)]
+    all_squares = range(64)
+
+    for (p, enemy), (reference, _) in zip(enemies, references):
+        assert baseline_attacked_squares(reference, enemy) == p.attacked_squares(enemy)
+
+    def via_names(squares):
+        for reference, enemy in references:
+            attacked = baseline_attacked_squares(reference, enemy)
+            for sq in squares:
+                SQUARE_NAMES[sq] in attacked
+
+    def via_reverse_lookups(squares):
+        for p, enemy in enemies:
+            p._attack_cache = None  # as after a move
+            for sq in squares:
+                p.is_attacked(sq, enemy)
+
+    def via_attack_maps(squares):
+        for p, enemy in enemies:
+            p._attack_cache = None  # as after a move
+            attacks = p.attack_map(enemy)
+            for sq in squares:
+                attacks >> sq & 1
+
+    king_squares = [SQUARE_INDICES['e1']]
+    _report_header('names', 'bitboards')
+    _report('one square', timeit(lambda: via_names(king_squares), number=number),
+            timeit(lambda: via_reverse_lookups(king_squares), number=number))
+    _report('every square', timeit(lambda: via_names(all_squares), number=number),
+            timeit(lambda: via_reverse_lookups(all_squares), number=number))
+    _report('every square, attack map', timeit(lambda: via_names(all_squares), number=number),
+            timeit(lambda: via_attack_maps(all_squares), number=number))
+
+
+SAN_TOKENS = (
+    'e4 e5 Nf3 Nc6 Bb5 a6 Ba4 Nf6 O-O Be7 Re1 b5 Bb3 d6 c3 O-O h3 Nb8 d4 Nbd7 c4 c6 cxb5 axb5 Nc3 Bb7 Bg5 b4 Nb1 h6 '
+    'Bh4 c5 dxe5 Nxe4 Bxe7 Qxe7 exd6 Qf6 Nbd2 Nxd6 Nc4 Nxc4 Bxc4 Nb6 Ne5 Rae8 Bxf7+ Rxf7 Nxf7 Rxe1+ Qxe1 Kxf7 '
+    'Qe3 Qg5 Qxg5 hxg5 b3 Ke6 a3 Kd6 axb4 cxb4 Ra5 Nd5 f3 Bc8 Kf2 Bf5 Ra7 g6 Ra6+ Kc5 Ke1 Nf4 g3 Nxh3 Kd2 Kb5 '
+    'Rd6 Kc5 Ra6 Nf2 g4 Bd3 Re6 e8=Q Rxe8 Kd4 O-O-O'
+).split()
+
+
+def baseline_parse_move(move_str: str) -> dict:
+    """parse_move() as it was before parse_san(), copied verbatim without its doctests. Kept here only as a baseline."""
+    d = dict(piece=None, orig_rank=None, orig_file=None, capture=False,
+             target=None, castle=None, check=False, checkmate=False, promote=None)
+
+    # let's make sure you don't pass lists or something stupid here
+    if not isinstance(move_str, str):
+        raise TypeError('Expected string')
+
+    # castling
+    if move_str[0] in 'O0':
+        if move_str in ('O-O', '0-0'):
+            castle_side = 'kingside'
+        elif move_str in ('O-O-O', '0-0-0'):
+            castle_side = 'queenside'
+        else:
+            raise ValueError('Unable to parse this one')
+        d['castle'] = castle_side
+        return d
+
+    # get piece
+    if move_str[0] in 'KQRBNP':
+        d['piece'] = move_str[0]
+        move_str = move_str[1:]
+    elif move_str[0] in 'abcdefgh':
+        d['piece'] = 'P'
+    else:
+        raise ValueError('Unable to parse this one')
+
+    # captures
+    if 'x' in move_str:
+        if move_str.count('x') != 1:
+            raise ValueError('Unable to parse this one')
+        d['capture'] = True
+        move_str = move_str.replace('x', '')
+
+    # find last 12345678 from string; that should be the target rank
+    target_rank_index = None
+    for i, c in reversed(tuple(enumerate(move_str))):
+        if c in '12345678':
+            target_rank_index = i
+            break
+    if target_rank_index is None:
+        raise ValueError('Unable to parse this one')
+    d['target'] = move_str[target_rank_index-1:target_rank_index+1]
+
+    before_target, after_target = move_str[:target_rank_index-1], move_str[target_rank_index+1:]
+
+    # disambiguating origin before target
+    if before_target == '':
+        pass
+    elif len(before_target) == 1:
+        if before_target in 'abcdefgh':
+            d['orig_file'] = before_target
+        elif before_target in '12345678':
+            d['orig_rank'] = before_target
+        else:
+            raise ValueError('Unable to parse this one')
+    elif len(before_target) == 2:
+        d['orig_file'], d['orig_rank'] = before_target
+    else:
+        raise ValueError('Unable to parse this one')
+
+    # whatever happens after the target square
+    if after_target == '':
+        pass
+    elif after_target[0] in '+#=':
+        # promotion
+        if after_target[0] == '=':
+            if after_target[1] in 'KQRBN':
+                d['promote'] = after_target[1]
+            else:
+                raise ValueError('Unable to parse this one')
+            remains = after_target[2:]
+        else:
+            remains = after_target
+        # check/mate
+        if remains == '+':
+            d['check'] = True
+        elif remains == '#':
+            d['checkmate'] = True
+        elif remains == '':
+            pass
+        else:
+            raise ValueError('Unable to parse this one')
+    else:
+        raise ValueError('Unable to parse this one')
+
+    return d
+
+
+def bench_san(number=200):
+    """Parsing SAN tokens: the character-by-character parser, parse_san() without memo, and the memoized APIs."""
+    tokens = SAN_TOKENS * 10
+    uncached = parse_san.__wrapped__
+    print('{:<40} {:>13}'.format('', 'tokens/s'))
+    for name, parse in (('character-by-character parser', lambda: [baseline_parse_move(t) for t in tokens]),
+                        ('parse_move', lambda: [parse_move(t) for t in tokens]),
+                        ('parse_san without memo', lambda: [uncached(t) for t in tokens]),
+                        ('parse_moves', lambda: parse_moves(tokens))):
+        seconds = timeit(parse, number=number)
+        print('{:<40} {:>13.0f}'.format(name, len(tokens) * number / seconds))
+
+
+def bench_corpus(games=400):
+    """Replaying a PGN corpus with 1 to N worker processes."""
+    game = '[Event "bench"]\n\n{} 1-0\n\n'.format(' '.join(SAN_TOKENS[:20]))
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'corpus.pgn')
+        with open(path, 'w') as f:
+            f.write(game * games)
+        print('{:<40} {:>13} {:>9}'.format('workers', 'games/s', 'scaling'))
+        single = None
+        workers = 1
+        while workers <= (os.cpu_count() or 1):
+            processor = CorpusProcessor(workers=workers, chunk_bytes=16 * 1024)
+            start = time.perf_counter()
+            for _ in processor.map(path, replay_game):
+                pass
+            rate = games / (time.perf_counter() - start)
+            single = single or rate
+            print('{:<40} {:>13.0f} {:>8.2f}x'.format(workers, rate, rate / single))
+            workers *= 2
+
+
+def _random_game_fens(games, plies, seed=0):
+    rng = random.Random(seed)
+    fens = []
+    for _ in range(games):
+        position = Position()
+        for _ in range(plies):
+            moves = sorted(position.legal_moves(), key=Move.uci)
+            if not moves:
+                break
+            position.push(rng.choice(moves))
+            fens.append(position.fen())
+    return fens
+
+
+def bench_fen(lines=1000000):
+    """Reading a file of FEN lines into positions and writing them back, without and with the parse cache."""
+    fens = _random_game_fens(games=200, plies=40)
+    rng = random.Random(1)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'positions.fen')
+        with open(path, 'w') as f:
+            f.writelines(rng.choice(fens) + '\n' for _ in range(lines))
+
+        print('{:<40} {:>13}'.format('', 'lines/s'))
+        _parse_fen.cache_clear()
+        start = time.perf_counter()
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    Position.__new__(Position)._parse(line)
+        print('{:<40} {:>13.0f}'.format('parse without cache', lines / (time.perf_counter() - start)))
+
+        for name in ('from_fens, cold cache', 'from_fens, warm cache'):
+            start = time.perf_counter()
+            with open(path) as f:
+                positions = Position.from_fens(f)
+            print('{:<40} {:>13.0f}'.format(name, lines / (time.perf_counter() - start)))
+
+        for name in ('fen', 'fen, cached'):
+            start = time.perf_counter()
+            for position in positions:
+                position.fen()
+            print('{:<40} {:>13.0f}'.format(name, lines / (time.perf_counter() - start)))
+
+
+def bench_codec(number=20):
+    """Encoding and decoding positions: FEN strings vs. the packed binary layout."""
+    positions = [Position(fen) for fen in _random_game_fens(games=50, plies=40)]
+    fens = [p.fen() for p in positions]
+    buffer = pack_positions(positions)
+    print('{:<40} {:>13.1f} {:>13.1f}'.format('bytes per position', sum(map(len, fens)) / len(fens),
+                                              len(buffer) / len(positions)))
+
+    def fen_encode():
+        for p in positions:
+            p._fen = None
+            p.fen()
+
+    def fen_decode():
+        for fen in fens:
+            Position.__new__(Position)._parse(fen)
+
+    _report_header('FEN', 'binary')
+    _report('encode', timeit(fen_encode, number=number), timeit(lambda: pack_positions(positions), number=number))
+    _report('decode', timeit(fen_decode, number=number),
+            timeit(lambda: list(unpack_positions(buffer)), number=number))
+
+
+def bench_evaluate_batch(number=5):
+    """Evaluating many positions: evaluate() in a loop vs. evaluate_batch() on Position objects and packed bytes."""
+    positions = [Position(fen) for fen in _random_game_fens(games=250, plies=80)]
+    buffer = pack_positions(positions)
+    loop = timeit(lambda: [evaluate(p) for p in positions], number=number)
+    print('{} positions'.format(len(positions)))
+    _report_header('evaluate()', 'batch')
+    _report('Position objects', loop, timeit(lambda: evaluate_batch(positions), number=number))
+    _report('packed positions', loop, timeit(lambda: evaluate_batch(buffer), number=number))
+
+
+def bench_pawn_hash(number=5):
+    """Pawn-structure evaluation: computed every time vs. looked up in a PawnHashTable, and hit rates in a search."""
+    positions = [Position(fen) for fen in _random_game_fens(games=250, plies=80)]
+    table = PawnHashTable()
+
+    def compute():
+        for p in positions:
+            evaluate_pawns(p._bitboards['P'], p._bitboards['p'])
+
+    def lookup():
+        for p in positions:
+            table.score(p)
+
+    lookup()  # fill the table, as a search fills it with the pawns of the positions it visits
+    print('{} positions'.format(len(positions)))
+    _report_header('computed', 'cached')
+    _report('pawn structure', timeit(compute, number=number), timeit(lookup, number=number))
+    for fen in FEN_CORPUS[:4]:
+        searcher = Searcher()
+        searcher.search(Position(fen), max_depth=3)
+        print('{:<40} {:>12.1%} hits'.format('search ' + fen[:32], searcher.pawn_table.stats()['hit_rate']))
+
+
+def bench_staged(depth=4):
+    """Search move generation: all legal moves generated and sorted at every node vs. staged generation."""
+    positions = [Position(fen) for fen in FEN_CORPUS[:6]]
+    print('{:<28} {:>10} {:>10} {:>12} {:>12} {:>14}'.format('depth {}, {} positions'.format(depth, len(positions)),
+                                                            'time', 'nodes', 'moves/node', 'cutoffs',
+                                                            'first move'))
+    for staged in (False, True):
+        searcher = Searcher(staged=staged)
+        seconds = 0
+        totals = {'nodes': 0, 'moves_generated': 0, 'cutoffs': 0}
+        first_move_cutoffs = 0
+        for position in positions:
+            searcher.new_game()
+            seconds += searcher.search(position, max_depth=depth).seconds
+            stats = searcher.stats()
+            for name in totals:
+                totals[name] += stats[name]
+            first_move_cutoffs += searcher.first_move_cutoffs
+        print('{:<28} {:>8.2f} s {:>10} {:>12.1f} {:>12} {:>14.1%}'.format(
+            'staged' if staged else 'all at once', seconds, totals['nodes'],
+            totals['moves_generated'] / totals['nodes'], totals['cutoffs'], first_move_cutoffs / totals['cutoffs']))
+
+
+def bench_parallel(depth=5, max_workers=None):
+    """Lazy SMP scaling: time to depth and nodes per second for 1, 2, 4, ... workers, up to the number of CPUs."""
+    max_workers = max_workers or os.cpu_count() or 1
+    counts = sorted({min(2 ** i, max_workers) for i in range(max_workers.bit_length() + 1)})
+    positions = [Position(fen) for fen in FEN_CORPUS[2:5]]
+    print('{:<40} {:>13} {:>13} {:>9}'.format('depth {}, {} positions'.format(depth, len(positions)), 'time to depth',
+                                              'nodes/s', 'speedup'))
+    baseline = None
+    for workers in counts:
+        with ParallelSearcher(workers=workers) as searcher:
+            searcher.search(Position(), max_depth=1)  # start the helpers
+            seconds = nodes = 0
+            for position in positions:
+                searcher.new_game()
+                result = searcher.search(position, max_depth=depth)
+                seconds += result.seconds
+                nodes += result.nodes
+        baseline = baseline or seconds
+        print('{:<40} {:>11.2f} s {:>13.0f} {:>8.2f}x'.format('{} workers'.format(workers), seconds, nodes / seconds,
+                                                            baseline / seconds))
+
+
+def bench_position_db(positions=1000000, number=100000):
+    """Lookups in a memory-mapped position database, hits and misses."""
+    rng = random.Random(2)
+    records = {rng.getrandbits(64): PositionRecord(1, 1, 0, 0, None, None) for _ in range(positions)}
+    keys = list(records)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'positions.db')
+        start = time.perf_counter()
+        PositionDB.write(path, records)
+        print('{:<40} {:>10.1f} s'.format('write {} records'.format(positions), time.perf_counter() - start))
+        with PositionDB(path) as db:
+            hits = [rng.choice(keys) for _ in range(number)]
+            misses = [rng.getrandbits(64) for _ in range(number)]
+            print('{:<40} {:>13}'.format('', 'lookups/s'))
+            for name, probe_keys in (('hit', hits), ('miss', misses)):
+                seconds = timeit(lambda: [db.get(key) for key in probe_keys], number=1)
+                print('{:<40} {:>13.0f}'.format(name, number / seconds))
+
+
+def bench_book(games=2000, number=2000):
+    """Probing an opening book of random games, in book and out of book."""
+    rng = random.Random(3)
+    weights = {}
+    for _ in range(games):
+        position = Position()
+        for _ in range(16):
+            moves = sorted(position.legal_moves(), key=Move.uci)
+            if not moves:
+                break
+            move = rng.choice(moves)
+            codes = weights.setdefault(polyglot_key(position), {})
+            code = encode_polyglot_move(position, move)
+            codes[code] = codes.get(code, 0) + 1
+            position.push(move)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'book.bin')
+        OpeningBook.write(path, weights)
+        with OpeningBook(path) as book:
+            in_book = Position()
+            out_of_book = Position().move('a3').move('a6').move('b3').move('b6').move('c3').move('c6')
+            print('{:<40} {:>13}'.format('{} entries'.format(len(book)), 'us/probe'))
+            for name, probe, position in (('entries, in book', book.entries, in_book),
+                                          ('best_move, in book', book.best_move, in_book),
+                                          ('best_move, out of book', book.best_move, out_of_book)):
+                seconds = timeit(lambda: probe(position), number=number)
+                print('{:<40} {:>13.1f}'.format(name, seconds / number * 1e6))
+
+
+def bench_tablebase(material='KRvK', number=2000):
+    """Generating a tablebase, probing it, and searching an endgame with and without it."""
+    with tempfile.TemporaryDirectory() as directory, Tablebases(directory) as tablebases:
+        tablebases.generate(material, progress=lambda name, seconds: print('{:<40} {:>10.2f} s'.format(
+            'generate ' + name, seconds)))
+        position = Position('8/8/8/8/8/2k5/8/K2R4 w - - 0 1')
+        seconds = timeit(lambda: tablebases.probe(position), number=number)
+        print('{:<40} {:>10.1f} us'.format('probe', seconds / number * 1e6))
+        for name, searcher in (('search depth 6', Searcher()), ('search depth 6 with tablebase',
+                                                                 Searcher(tablebases=tablebases))):
+            result = searcher.search(position, max_depth=6)
+            print('{:<40} {:>10} nodes {:>8.2f} s  score {}'.format(name, result.nodes, result.seconds,
+                                                                     result.score))
+
+
+BENCHMARKS = {
+    'representation': bench_representation,
+    'targets': bench_targets_per_piece,
+    'attacks': bench_attacks,
+    'moves': bench_move_codes,
+    'san': bench_san,
+    'corpus': bench_corpus,
+    'fen': bench_fen,
+    'codec': bench_codec,
+    'evaluate': bench_evaluate_batch,
+    'pawns': bench_pawn_hash,
+    'staged': bench_staged,
+    'parallel': bench_parallel,
+    'positions': bench_position_db,
+    'book': bench_book,
+    'tablebase': bench_tablebase,
+}
+
+
+def main(argv=None):
+    names = (argv if argv is not None else sys.argv[1:]) or list(BENCHMARKS)
+    for name in names:
+        print('== {}: {}'.format(name, BENCHMARKS[name].__doc__))
+        BENCHMARKS[name]()
+        print()
+
+
+if __name__ == '__main__':
+    main()
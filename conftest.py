@@ -0,0 +1,20 @@
+import pytest
+
+
+def pytest_addoption(parser):
+    parser.addoption('--run-benchmarks', action='store_true',
+                     help='run the timing benchmarks marked with @pytest.mark.benchmark')
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'benchmark: timing benchmark compared against a baseline, '
+                                       'skipped unless --run-benchmarks is given')
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--run-benchmarks'):
+        return
+    skip = pytest.mark.skip(reason='timing benchmark, run with --run-benchmarks')
+    for item in items:
+        if 'benchmark' in item.keywords:
+            item.add_marker(skip)
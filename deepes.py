@@ -1,6 +1,30 @@
-from itertools import product
+import argparse
+import asyncio
+import io
+import json
+import mmap
+import multiprocessing
+import os
+import queue
+import random
+import re
+import struct
+import sys
+import threading
+import time
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
-from typing import Tuple, Optional, Set, FrozenSet
+from functools import lru_cache
+from itertools import islice
+from multiprocessing.sharedctypes import RawArray
+from typing import Tuple, Optional, Set, FrozenSet, List, NamedTuple, Dict, Iterable, Iterator, Callable
+
+try:
+    import numpy as np
+except ImportError:  # optional, only needed for the array views of packed positions
+    np = None
 
 
 class Piece(Enum):
@@ -17,28 +41,538 @@ class Color(Enum):
     BLACK = 'b'
 
 
+FILES = 'abcdefgh'
+RANKS = '87654321'
+
+# Squares are indexed 0..63 in the same order as the board array and FEN piece placement: a8 is 0, h8 is 7,
+# a1 is 56 and h1 is 63. Bit i of a bitboard stands for square i.
+SQUARE_NAMES = tuple(f + r for r in RANKS for f in FILES)
+SQUARE_INDICES = {name: i for i, name in enumerate(SQUARE_NAMES)}
+
+PIECE_CHARS = 'KQRBNPkqrbnp'
+WHITE_PIECE_CHARS = 'KQRBNP'
+BLACK_PIECE_CHARS = 'kqrbnp'
+
+FULL_BB = (1 << 64) - 1
+FILE_A_BB = sum(1 << (y * 8) for y in range(8))
+FILE_H_BB = FILE_A_BB << 7
+
+
+def _iter_bits(bb):
+    """Yield indices of the set bits of a bitboard, lowest first."""
+    while bb:
+        lsb = bb & -bb
+        yield lsb.bit_length() - 1
+        bb ^= lsb
+
+
+def _north(bb):
+    return bb >> 8
+
+
+def _south(bb):
+    return (bb << 8) & FULL_BB
+
+
+def _east(bb):
+    return (bb << 1) & ~FILE_A_BB & FULL_BB
+
+
+def _west(bb):
+    return (bb >> 1) & ~FILE_H_BB
+
+
+def _north_east(bb):
+    return _east(_north(bb))
+
+
+def _north_west(bb):
+    return _west(_north(bb))
+
+
+def _south_east(bb):
+    return _east(_south(bb))
+
+
+def _south_west(bb):
+    return _west(_south(bb))
+
+
+def _knight_jumps(bb):
+    attacks = 0
+    for vertical in (lambda b: _north(_north(b)), lambda b: _south(_south(b))):
+        attacks |= _east(vertical(bb)) | _west(vertical(bb))
+    for horizontal in (lambda b: _east(_east(b)), lambda b: _west(_west(b))):
+        attacks |= _north(horizontal(bb)) | _south(horizontal(bb))
+    return attacks
+
+
+def _slide(bb, shift, occupied):
+    """Squares reached by sliding from bb in one direction, up to and including the first occupied square."""
+    attacks = 0
+    bb = shift(bb)
+    while bb:
+        attacks |= bb
+        if bb & occupied:
+            break
+        bb = shift(bb)
+    return attacks
+
+
+# Attack tables, built once at import and indexed by square. A ray holds every square from (but excluding) its
+# origin to the edge of the board in one direction. Rays listed in POSITIVE_RAYS run towards higher square indices,
+# so the nearest blocker on them is the lowest set bit; on NEGATIVE_RAYS it is the highest set bit.
+KNIGHT_ATTACKS = tuple(_knight_jumps(1 << sq) for sq in range(64))
+KING_ATTACKS = tuple(_north(bb) | _south(bb) | _east(bb) | _west(bb) |
+                     _north_east(bb) | _north_west(bb) | _south_east(bb) | _south_west(bb)
+                     for bb in (1 << sq for sq in range(64)))
+WHITE_PAWN_ATTACKS = tuple(_north_east(1 << sq) | _north_west(1 << sq) for sq in range(64))
+BLACK_PAWN_ATTACKS = tuple(_south_east(1 << sq) | _south_west(1 << sq) for sq in range(64))
+
+NORTH_RAYS, SOUTH_RAYS, EAST_RAYS, WEST_RAYS, NORTH_EAST_RAYS, NORTH_WEST_RAYS, SOUTH_EAST_RAYS, SOUTH_WEST_RAYS = (
+    tuple(_slide(1 << sq, shift, 0) for sq in range(64))
+    for shift in (_north, _south, _east, _west, _north_east, _north_west, _south_east, _south_west)
+)
+ROOK_POSITIVE_RAYS = (SOUTH_RAYS, EAST_RAYS)
+ROOK_NEGATIVE_RAYS = (NORTH_RAYS, WEST_RAYS)
+BISHOP_POSITIVE_RAYS = (SOUTH_EAST_RAYS, SOUTH_WEST_RAYS)
+BISHOP_NEGATIVE_RAYS = (NORTH_EAST_RAYS, NORTH_WEST_RAYS)
+
+
+def _sliding_attacks(sq, occupied, positive_rays, negative_rays):
+    attacks = 0
+    for rays in positive_rays:
+        ray = rays[sq]
+        blockers = ray & occupied
+        if blockers:
+            ray ^= rays[(blockers & -blockers).bit_length() - 1]
+        attacks |= ray
+    for rays in negative_rays:
+        ray = rays[sq]
+        blockers = ray & occupied
+        if blockers:
+            ray ^= rays[blockers.bit_length() - 1]
+        attacks |= ray
+    return attacks
+
+
+def rook_attacks(sq, occupied):
+    """
+    Bitboard of squares a rook on square index `sq` attacks, given the bitboard of occupied squares.
+
+    >>> [SQUARE_NAMES[s] for s in _iter_bits(rook_attacks(SQUARE_INDICES['a1'], 1 << SQUARE_INDICES['a3']))]
+    ['a3', 'a2', 'b1', 'c1', 'd1', 'e1', 'f1', 'g1', 'h1']
+    """
+    return _sliding_attacks(sq, occupied, ROOK_POSITIVE_RAYS, ROOK_NEGATIVE_RAYS)
+
+
+def bishop_attacks(sq, occupied):
+    """Bitboard of squares a bishop on square index `sq` attacks, given the bitboard of occupied squares."""
+    return _sliding_attacks(sq, occupied, BISHOP_POSITIVE_RAYS, BISHOP_NEGATIVE_RAYS)
+
+
+def queen_attacks(sq, occupied):
+    """Bitboard of squares a queen on square index `sq` attacks, given the bitboard of occupied squares."""
+    return (_sliding_attacks(sq, occupied, ROOK_POSITIVE_RAYS, ROOK_NEGATIVE_RAYS) |
+            _sliding_attacks(sq, occupied, BISHOP_POSITIVE_RAYS, BISHOP_NEGATIVE_RAYS))
+
+
+def _build_line_tables():
+    between = [[0] * 64 for _ in range(64)]
+    line = [[0] * 64 for _ in range(64)]
+    for rays, opposite_rays in ((NORTH_RAYS, SOUTH_RAYS), (SOUTH_RAYS, NORTH_RAYS), (EAST_RAYS, WEST_RAYS),
+                                (WEST_RAYS, EAST_RAYS), (NORTH_EAST_RAYS, SOUTH_WEST_RAYS),
+                                (SOUTH_WEST_RAYS, NORTH_EAST_RAYS), (NORTH_WEST_RAYS, SOUTH_EAST_RAYS),
+                                (SOUTH_EAST_RAYS, NORTH_WEST_RAYS)):
+        for a in range(64):
+            full_line = rays[a] | opposite_rays[a] | 1 << a
+            for b in _iter_bits(rays[a]):
+                between[a][b] = rays[a] & ~rays[b] & ~(1 << b)
+                line[a][b] = full_line
+    return tuple(map(tuple, between)), tuple(map(tuple, line))
+
+
+# BETWEEN[a][b] holds the squares strictly between two aligned squares and LINE[a][b] the whole line through them;
+# both are 0 for squares that are not on a common rank, file or diagonal.
+BETWEEN, LINE = _build_line_tables()
+ROOK_EMPTY_BOARD_ATTACKS = tuple(rook_attacks(sq, 0) for sq in range(64))
+BISHOP_EMPTY_BOARD_ATTACKS = tuple(bishop_attacks(sq, 0) for sq in range(64))
+
+PROMOTION_PIECES = (Piece.QUEEN, Piece.ROOK, Piece.BISHOP, Piece.KNIGHT)
+
+# castling rights are kept as bits of an integer, in the order they appear in FEN
+CASTLING_BITS = {'K': 1, 'Q': 2, 'k': 4, 'q': 8}
+
+
+def _castling_rights_kept():
+    kept = [15] * 64
+    for square, lost in (('e1', 'KQ'), ('h1', 'K'), ('a1', 'Q'), ('e8', 'kq'), ('h8', 'k'), ('a8', 'q')):
+        for right in lost:
+            kept[SQUARE_INDICES[square]] &= ~CASTLING_BITS[right]
+    return tuple(kept)
+
+
+# castling rights that remain after a piece moves from or to the given square
+CASTLING_RIGHTS_KEPT = _castling_rights_kept()
+
+# rook origin and target squares, keyed by the target square of a castling king
+CASTLING_ROOK_MOVES = {SQUARE_INDICES['g1']: (SQUARE_INDICES['h1'], SQUARE_INDICES['f1']),
+                       SQUARE_INDICES['c1']: (SQUARE_INDICES['a1'], SQUARE_INDICES['d1']),
+                       SQUARE_INDICES['g8']: (SQUARE_INDICES['h8'], SQUARE_INDICES['f8']),
+                       SQUARE_INDICES['c8']: (SQUARE_INDICES['a8'], SQUARE_INDICES['d8'])}
+
+
+def _castling_side(right, rook, empty, passed, target):
+    return (CASTLING_BITS[right], SQUARE_INDICES[rook], sum(1 << SQUARE_INDICES[sq] for sq in empty),
+            SQUARE_INDICES[passed], SQUARE_INDICES[target])
+
+
+# for each castling right: its bit, the rook's square, the squares that must be empty, and the squares the king
+# passes over and lands on, which must not be attacked
+WHITE_CASTLING = (_castling_side('K', 'h1', ('f1', 'g1'), 'f1', 'g1'),
+                  _castling_side('Q', 'a1', ('d1', 'c1', 'b1'), 'd1', 'c1'))
+BLACK_CASTLING = (_castling_side('k', 'h8', ('f8', 'g8'), 'f8', 'g8'),
+                  _castling_side('q', 'a8', ('d8', 'c8', 'b8'), 'd8', 'c8'))
+
+
+def _zobrist_keys(seed=20160306):
+    rng = random.Random(seed)
+    piece_keys = {char: tuple(rng.getrandbits(64) for _ in range(64)) for char in PIECE_CHARS}
+    castling_keys = tuple(rng.getrandbits(64) for _ in range(4))
+    # one key per combination of castling rights, so that a change of rights is a single xor
+    castling_combination_keys = tuple(
+        _xor_all(key for bit, key in enumerate(castling_keys) if rights >> bit & 1) for rights in range(16))
+    en_passant_keys = tuple(rng.getrandbits(64) for _ in range(8))
+    black_to_move_key = rng.getrandbits(64)
+    return piece_keys, castling_combination_keys, en_passant_keys, black_to_move_key
+
+
+def _xor_all(keys):
+    result = 0
+    for key in keys:
+        result ^= key
+    return result
+
+
+# Zobrist keys: one random 64-bit number per piece and square, per combination of castling rights, per en passant
+# file and for black being on move. The key of a position is the xor of the numbers of the features it has.
+ZOBRIST_PIECE_KEYS, ZOBRIST_CASTLING_KEYS, ZOBRIST_EN_PASSANT_KEYS, ZOBRIST_BLACK_TO_MOVE_KEY = _zobrist_keys()
+
+
+class Move(NamedTuple):
+    """A move of the piece on square index `origin` to `target`. Castling is encoded as the king's move."""
+    origin: int
+    target: int
+    promotion: Optional[Piece] = None
+
+    def uci(self) -> str:
+        """
+        Long algebraic notation of the move, as used by the UCI protocol
+
+        >>> Move(SQUARE_INDICES['e7'], SQUARE_INDICES['e8'], Piece.QUEEN).uci()
+        'e7e8q'
+        """
+        if self.promotion is None:
+            return SQUARE_NAMES[self.origin] + SQUARE_NAMES[self.target]
+        return SQUARE_NAMES[self.origin] + SQUARE_NAMES[self.target] + self.promotion.value.lower()
+
+    @classmethod
+    def from_uci(cls, uci: str) -> 'Move':
+        """
+        >>> Move.from_uci('e2e4') == Move(SQUARE_INDICES['e2'], SQUARE_INDICES['e4'])
+        True
+        """
+        promotion = Piece(uci[4].upper()) if len(uci) == 5 else None
+        return cls(SQUARE_INDICES[uci[:2]], SQUARE_INDICES[uci[2:4]], promotion)
+
+
+PROMOTION_CODES = {None: 0, Piece.QUEEN: 1, Piece.ROOK: 2, Piece.BISHOP: 3, Piece.KNIGHT: 4}
+PROMOTIONS_BY_CODE = (None, Piece.QUEEN, Piece.ROOK, Piece.BISHOP, Piece.KNIGHT)
+# One shared Move for every move code, so that turning codes into moves is a lookup rather than a construction
+MOVES_BY_CODE = (None,) + tuple(Move(code & 63, code >> 6 & 63, PROMOTIONS_BY_CODE[code >> 12])
+                                for code in range(1, len(PROMOTIONS_BY_CODE) << 12))
+
+
+def encode_move(move: Optional[Move]) -> int:
+    """
+    Pack a move into 16 bits: origin in bits 0-5, target in bits 6-11 and promotion in bits 12-14. No move is 0.
+    Move generation works on these codes, see Position._legal_move_codes().
+
+    >>> decode_move(encode_move(Move.from_uci('a7a8n'))).uci()
+    'a7a8n'
+    """
+    if move is None:
+        return 0
+    return move.origin | move.target << 6 | PROMOTION_CODES[move.promotion] << 12
+
+
+def decode_move(code: int) -> Optional[Move]:
+    """Inverse of encode_move"""
+    return MOVES_BY_CODE[code]
+
+
+class _Undo(NamedTuple):
+    """What Position.pop() needs to take back a move, pushed on the position's stack by push()"""
+    move: Move
+    char: str
+    captured: str
+    captured_sq: int
+    castling_rights: int
+    en_passant_square: Optional[int]
+    halfmove_clock: int
+    zobrist: int
+    pawn_key: int
+    score: int
+
+
+STARTING_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+
+# Binary position layout, little-endian: occupied squares bitboard; a 4-bit code (the index in PIECE_CHARS) for each
+# occupied square in square order, two per byte, low nibble first; state bits (0: black to move, 1-4: castling
+# rights, 5-8: en passant file + 1 or 0 for none); halfmove clock; fullmove number; two reserved zero bytes.
+POSITION_STRUCT = struct.Struct('<Q16sHHH2x')
+POSITION_BYTES = POSITION_STRUCT.size
+PIECE_CODES = {char: code for code, char in enumerate(PIECE_CHARS)}
+# the two piece characters for each byte of packed piece codes
+_PIECE_CODE_PAIRS = tuple((PIECE_CHARS + '????')[byte & 15] + (PIECE_CHARS + '????')[byte >> 4] for byte in range(256))
+POSITION_DTYPE = None if np is None else np.dtype([
+    ('occupied', '<u8'), ('pieces', 'u1', (16,)), ('state', '<u2'), ('halfmove_clock', '<u2'),
+    ('fullmove_number', '<u2'), ('reserved', 'V2')])
+
+# runs of empty squares, longest first, and the digits they are written as in FEN
+_EMPTY_RUNS = tuple(('.' * n, str(n)) for n in range(8, 0, -1))
+# FEN piece placement to square characters: digits become runs of empty squares
+_FEN_PLACEMENT_TABLE = str.maketrans(dict((digit, run) for run, digit in _EMPTY_RUNS))
+
+
 class Position:
     def __init__(self, fen=None):
-        if fen is None:
-            fen = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+        self._set_parsed(_parse_fen(STARTING_FEN if fen is None else fen))
+
+    @classmethod
+    def from_fens(cls, fens: Iterable[str]) -> List['Position']:
+        """
+        Positions for many FENs at once, e.g. the lines of a file. Surrounding whitespace and blank lines are ignored.
 
-        self._board_array = self.board_array_from_fen_pieces(fen.split(' ')[0])
+        >>> [p.fen() for p in Position.from_fens(['8/8/8/8/8/8/8/K6k w - - 0 1\\n', '\\n'])]
+        ['8/8/8/8/8/8/8/K6k w - - 0 1']
+        """
+        new = cls.__new__
+        parse = _parse_fen
+        positions = []
+        for fen in fens:
+            fen = fen.strip()
+            if fen:
+                position = new(cls)
+                position._set_parsed(parse(fen))
+                positions.append(position)
+        return positions
 
-        fen_color = fen.split(' ')[1]
+    def _parse(self, fen):
+        """Set up the position from a FEN, splitting and scanning it once"""
+        fen_pieces, fen_color, castling_availability, en_passant_target, halfmove_clock, fullmove_number = fen.split()
         try:
-            self._active_color = {'w': Color.WHITE, 'b': Color.BLACK}[fen_color]
+            active_color = {'w': Color.WHITE, 'b': Color.BLACK}[fen_color]
         except KeyError:
             raise KeyError('Unexpected active color {}'.format(fen_color))
+        castling_rights = 0
+        for right in castling_availability.replace('-', ''):
+            castling_rights |= CASTLING_BITS[right]
+        ranks = fen_pieces.translate(_FEN_PLACEMENT_TABLE).split('/')
+        if len(ranks) != 8 or any(len(rank) != 8 for rank in ranks):
+            raise ValueError('Expected 8 ranks of 8 squares in {}'.format(fen_pieces))
+        self._setup(list(''.join(ranks)), active_color, castling_rights,
+                    None if en_passant_target == '-' else SQUARE_INDICES[en_passant_target], int(halfmove_clock),
+                    int(fullmove_number))
+
+    def _setup(self, squares, active_color, castling_rights, en_passant_square, halfmove_clock, fullmove_number):
+        """Set every field from the square list and the state, with no moves pushed"""
+        bitboards = self._bitboards = dict.fromkeys(PIECE_CHARS, 0)
+        zobrist = ZOBRIST_CASTLING_KEYS[castling_rights]
+        score = 0
+        for sq, char in enumerate(squares):
+            if char != '.':
+                bitboards[char] |= 1 << sq
+                zobrist ^= ZOBRIST_PIECE_KEYS[char][sq]
+                score += PIECE_SQUARE_VALUES[char][sq]
+        pawn_key = 0
+        for char in 'Pp':
+            for sq in _iter_bits(bitboards[char]):
+                pawn_key ^= ZOBRIST_PIECE_KEYS[char][sq]
+        if en_passant_square is not None:
+            zobrist ^= ZOBRIST_EN_PASSANT_KEYS[en_passant_square % 8]
+        if active_color == Color.BLACK:
+            zobrist ^= ZOBRIST_BLACK_TO_MOVE_KEY
+        self._squares = squares
+        self._white = (bitboards['K'] | bitboards['Q'] | bitboards['R'] | bitboards['B'] | bitboards['N'] |
+                       bitboards['P'])
+        self._black = (bitboards['k'] | bitboards['q'] | bitboards['r'] | bitboards['b'] | bitboards['n'] |
+                       bitboards['p'])
+        self._active_color = active_color
+        self._castling_rights = castling_rights
+        self._en_passant_square = en_passant_square
+        self._halfmove_clock = halfmove_clock
+        self._fullmove_number = fullmove_number
+        # undo information for every move pushed on this position, see push() and pop()
+        self._stack = []
+        self._zobrist = zobrist
+        # Zobrist key of the pawns alone, for caching pawn-structure evaluations
+        self._pawn_key = pawn_key
+        # material plus piece-square values from white's point of view, kept up to date by push() and pop()
+        self._score = score
+        # serialized FEN, computed on demand and dropped whenever the position changes
+        self._fen = None
+        # attack maps by color (True for white) and the checkers of the side to move, computed on demand and dropped
+        # whenever the position changes
+        self._attack_cache = None
+
+    def to_bytes(self) -> bytes:
+        """
+        Position packed into POSITION_BYTES bytes, see POSITION_STRUCT. The moves pushed on it are not included.
+
+        >>> len(Position().to_bytes())
+        32
+        """
+        buffer = bytearray(POSITION_BYTES)
+        self._pack_into(buffer, 0)
+        return bytes(buffer)
+
+    def _pack_into(self, buffer, offset):
+        codes = [PIECE_CODES[char] for char in self._squares if char != '.']
+        if len(codes) > 32:
+            raise ValueError('Cannot pack more than 32 pieces')
+        codes.append(0)
+        pieces = bytes([codes[i] | codes[i + 1] << 4 for i in range(0, len(codes) - 1, 2)])
+        state = self._castling_rights << 1 | (self._active_color == Color.BLACK)
+        if self._en_passant_square is not None:
+            if self._en_passant_square // 8 != (2 if self._active_color == Color.WHITE else 5):
+                raise ValueError('En passant target {} on the wrong rank'.format(self._en_passant_target))
+            state |= (self._en_passant_square % 8 + 1) << 5
+        POSITION_STRUCT.pack_into(buffer, offset, self._white | self._black, pieces, state, self._halfmove_clock,
+                                  self._fullmove_number)
+
+    @classmethod
+    def from_bytes(cls, data) -> 'Position':
+        """
+        Position from the output of to_bytes()
+
+        >>> Position.from_bytes(Position().move('e4').to_bytes()).fen()
+        'rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq e3 0 1'
+        """
+        if len(data) != POSITION_BYTES:
+            raise ValueError('Expected {} bytes, got {}'.format(POSITION_BYTES, len(data)))
+        position = cls.__new__(cls)
+        position._unpack(POSITION_STRUCT.unpack(data))
+        return position
+
+    def _unpack(self, fields):
+        occupied, pieces, state, halfmove_clock, fullmove_number = fields
+        # the occupied squares become format fields, filled with the piece characters in square order
+        template = format(occupied, '064b')[::-1].replace('0', '.').replace('1', '{}')
+        squares = list(template.format(*''.join([_PIECE_CODE_PAIRS[byte] for byte in pieces])))
+        black = state & 1
+        en_passant_file = state >> 5 & 15
+        self._setup(squares, Color.BLACK if black else Color.WHITE, state >> 1 & 15,
+                    (40 if black else 16) + en_passant_file - 1 if en_passant_file else None, halfmove_clock,
+                    fullmove_number)
+
+    def _parsed(self) -> tuple:
+        """The fields of a position with no moves pushed, for _set_parsed(), in a small immutable tuple"""
+        return (''.join(self._squares), tuple([self._bitboards[char] for char in PIECE_CHARS]), self._white,
+                self._black, self._active_color, self._castling_rights, self._en_passant_square, self._halfmove_clock,
+                self._fullmove_number, self._zobrist, self._pawn_key, self._score)
 
-        self._castling_availability, self._en_passant_target = fen.split(' ')[2:4]
-        self._halfmove_clock = int(fen.split(' ')[4])
-        self._fullmove_number = int(fen.split(' ')[5])
+    def _set_parsed(self, parsed):
+        """Set every field from the output of _parsed(), with no moves pushed"""
+        (squares, bitboards, self._white, self._black, self._active_color, self._castling_rights,
+         self._en_passant_square, self._halfmove_clock, self._fullmove_number, self._zobrist, self._pawn_key,
+         self._score) = parsed
+        self._squares = list(squares)
+        self._bitboards = dict(zip(PIECE_CHARS, bitboards))
+        self._stack = []
+        self._fen = None
+        self._attack_cache = None
+
+    def _copy_from(self, other):
+        self._squares = other._squares[:]
+        self._bitboards = other._bitboards.copy()
+        self._white = other._white
+        self._black = other._black
+        self._active_color = other._active_color
+        self._castling_rights = other._castling_rights
+        self._en_passant_square = other._en_passant_square
+        self._halfmove_clock = other._halfmove_clock
+        self._fullmove_number = other._fullmove_number
+        self._stack = other._stack[:]
+        self._zobrist = other._zobrist
+        self._pawn_key = other._pawn_key
+        self._score = other._score
+        self._fen = other._fen
+        self._attack_cache = None
+
+    @property
+    def _board_array(self):
+        """Tuple of ranks (8th rank first), each a tuple of one-character strings"""
+        squares = self._squares
+        return tuple(tuple(squares[y * 8:y * 8 + 8]) for y in range(8))
 
     def __repr__(self):
         return '{}({})'.format(self.__class__.__name__, repr(self.fen()))
 
     def __eq__(self, other):
-        return isinstance(other, self.__class__) and other.fen() == self.fen()
+        if not isinstance(other, self.__class__):
+            return False
+        # different keys are the common case and settle it; equal keys still need a full comparison
+        return (self._zobrist == other._zobrist and self._squares == other._squares
+                and self._active_color == other._active_color and self._castling_rights == other._castling_rights
+                and self._en_passant_square == other._en_passant_square
+                and self._halfmove_clock == other._halfmove_clock and self._fullmove_number == other._fullmove_number)
+
+    def __hash__(self):
+        """Hash of the Zobrist key. Like the key it changes with push() and pop(), so don't do those while the
+        position is in a set or a dict key."""
+        return hash(self._zobrist)
+
+    def zobrist_key(self) -> int:
+        """
+        64-bit Zobrist key of the position, maintained incrementally as moves are pushed and popped.
+        Positions that differ only by their move clocks have the same key.
+
+        >>> Position().zobrist_key() == Position().move('Nf3').move('Nf6').move('Ng1').move('Ng8').zobrist_key()
+        True
+        """
+        return self._zobrist
+
+    def pawn_key(self) -> int:
+        """
+        64-bit Zobrist key of the pawns alone, maintained incrementally like zobrist_key(). Positions with the same
+        pawns have the same pawn key, whatever the other pieces.
+
+        >>> Position().pawn_key() == Position().move('Nf3').move('Nc6').pawn_key()
+        True
+        """
+        return self._pawn_key
+
+    def _compute_pawn_key(self) -> int:
+        """Pawn key computed from scratch"""
+        key = 0
+        for sq, char in enumerate(self._squares):
+            if char == 'P' or char == 'p':
+                key ^= ZOBRIST_PIECE_KEYS[char][sq]
+        return key
+
+    def _compute_zobrist(self) -> int:
+        """Zobrist key computed from scratch"""
+        key = 0
+        for sq, char in enumerate(self._squares):
+            if char != '.':
+                key ^= ZOBRIST_PIECE_KEYS[char][sq]
+        key ^= ZOBRIST_CASTLING_KEYS[self._castling_rights]
+        if self._en_passant_square is not None:
+            key ^= ZOBRIST_EN_PASSANT_KEYS[self._en_passant_square % 8]
+        if self._active_color == Color.BLACK:
+            key ^= ZOBRIST_BLACK_TO_MOVE_KEY
+        return key
 
     @staticmethod
     def board_array_from_fen_pieces(fen_pieces):
@@ -62,120 +596,558 @@ class Position:
 
     @staticmethod
     def fen_pieces_from_board_array(board_array):
-        fen_pieces = ''
-        for rank in board_array:
-            empties = 0
-            for square in rank:
-                if square == '.':
-                    empties += 1
-                else:
-                    if empties >= 1:
-                        fen_pieces += str(empties)
-                        empties = 0
-                    fen_pieces += square
-            if empties > 0:
-                fen_pieces += str(empties)
-            fen_pieces += '/'
-        fen_pieces = fen_pieces[:-1]
+        fen_pieces = '/'.join(''.join(rank) for rank in board_array)
+        for run, digit in _EMPTY_RUNS:
+            fen_pieces = fen_pieces.replace(run, digit)
         return fen_pieces
 
     def basic_board(self):
         """Human-readable basic visualization of the board at this position"""
-        return '\n'.join(''.join(piece for piece in rank) for rank in self._board_array)
+        squares = self._squares
+        return '\n'.join(''.join(squares[y * 8:y * 8 + 8]) for y in range(8))
+
+    @property
+    def _castling_availability(self):
+        """Castling availability field of the FEN"""
+        return ''.join(right for right, bit in CASTLING_BITS.items() if self._castling_rights & bit) or '-'
+
+    @property
+    def _en_passant_target(self):
+        """En passant target square field of the FEN"""
+        return '-' if self._en_passant_square is None else SQUARE_NAMES[self._en_passant_square]
 
     def fen(self):
         """Forsyth-Edwards notation string of the position"""
-        return '{} {} {} {} {} {}'.format(self.fen_pieces_from_board_array(self._board_array), self._active_color.value,
-                                          self._castling_availability, self._en_passant_target, self._halfmove_clock,
-                                          self._fullmove_number)
+        if self._fen is None:
+            squares = self._squares
+            fen_pieces = '/'.join([''.join(squares[i:i + 8]) for i in range(0, 64, 8)])
+            for run, digit in _EMPTY_RUNS:
+                fen_pieces = fen_pieces.replace(run, digit)
+            self._fen = '{} {} {} {} {} {}'.format(fen_pieces, self._active_color.value, self._castling_availability,
+                                                   self._en_passant_target, self._halfmove_clock,
+                                                   self._fullmove_number)
+        return self._fen
+
+    def copy(self) -> 'Position':
+        """Independent copy of this position"""
+        new = self.__class__.__new__(self.__class__)
+        new._copy_from(self)
+        return new
 
     def move(self, move_str):
-        new_en_passant_target = None
-        reset_halfmove_clock = False
-        remove_castling_availability = None
-
-        parsed = parse_move(move_str)
-
-        if parsed['castle'] is not None:
-            raise NotImplementedError('castling not implemented')
-        if parsed['promote'] is not None:
-            raise NotImplementedError('promotion not implemented')
-
-        piece = Piece(parsed['piece'])
-        target = parsed['target']
-        targ_x, targ_y = self.square_str_to_xy(target)
-
-        # origin coordinates can be None, or they can be specified in move string
-        orig_x = orig_y = None
-        if parsed['orig_file'] is not None:
-            orig_x = list('abcdefgh').index(parsed['orig_file'])
-        if parsed['orig_rank'] is not None:
-            orig_y = list('87654321').index(parsed['orig_rank'])
-
-        if parsed['capture']:
-            raise NotImplementedError('captures not implemented')
-        else:
-            if not self._empty_xy(targ_x, targ_y):
-                raise Exception('Illegal move: target occupied')
-
-        possible_origins = set(self.pieces_that_can_move_here(target=target, piece=piece, color=self._active_color))
-
-        # if origin rank/file was specified, discard possible origins that do not match
-        if orig_x:
-            for po in possible_origins:
-                if self.square_str_to_xy(po)[0] != orig_x:
-                    possible_origins.remove(po)
-        if orig_y:
-            for po in possible_origins:
-                if self.square_str_to_xy(po)[1] != orig_y:
-                    possible_origins.remove(po)
-
-        # if we have an unambiguous origin at this point, we're good
-        if len(possible_origins) == 0:
+        """Position after the move given in standard algebraic notation"""
+        new = self.copy()
+        new.push(self._move_from_san(move_str))
+        return new
+
+    def _move_from_san(self, move_str) -> Move:
+        """Find the legal move matching a move in standard algebraic notation, or raise if there is none."""
+        return self._move_from_parsed(parse_san(move_str))
+
+    def _move_from_parsed(self, parsed) -> Move:
+        """Find the legal move matching a parsed move in standard algebraic notation, or raise if there is none."""
+        white = self._active_color == Color.WHITE
+        squares = self._squares
+
+        if parsed.castle is not None:
+            king_char = 'K' if white else 'k'
+            target = SQUARE_INDICES[('g' if parsed.castle == 'kingside' else 'c') + ('1' if white else '8')]
+            candidates = [m for m in self.legal_moves() if m.target == target and squares[m.origin] == king_char]
+            if not candidates:
+                raise Exception('Illegal move: cannot castle {}'.format(parsed.castle))
+            return candidates[0]
+
+        char = parsed.piece if white else parsed.piece.lower()
+        target = SQUARE_INDICES[parsed.target]
+        promotion = None if parsed.promote is None else Piece(parsed.promote)
+
+        if parsed.capture:
+            is_en_passant = parsed.piece == 'P' and target == self._en_passant_square
+            if squares[target] == '.' and not is_en_passant:
+                raise Exception('Illegal move: nothing to capture')
+        elif squares[target] != '.':
+            raise Exception('Illegal move: target occupied')
+
+        if parsed.piece == 'P' and parsed.target[1] in '18' and promotion is None:
+            raise Exception('Illegal move: must promote upon advancing to final rank')
+
+        # origin file/rank can be specified in move string to disambiguate
+        candidates = [m for m in self.legal_moves()
+                      if m.target == target and squares[m.origin] == char and m.promotion == promotion
+                      and parsed.orig_file in (None, SQUARE_NAMES[m.origin][0])
+                      and parsed.orig_rank in (None, SQUARE_NAMES[m.origin][1])]
+
+        if len(candidates) == 0:
             raise Exception('Illegal move: no possible origins')
-        elif len(possible_origins) > 1:
+        elif len(candidates) > 1:
             raise Exception('Illegal move: ambiguous origin')
+        return candidates[0]
+
+    def push(self, move: Move):
+        """
+        Play a legal move on this position, in place. pop() takes it back.
+
+        >>> pos = Position()
+        >>> pos.push(Move.from_uci('e2e4'))
+        >>> pos.fen()
+        'rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq e3 0 1'
+        >>> pos.pop().uci()
+        'e2e4'
+        >>> pos == Position()
+        True
+        """
+        origin, target, promotion = move
+        squares = self._squares
+        bitboards = self._bitboards
+        char = squares[origin]
+        captured = squares[target]
+        captured_sq = target
+        white = char.isupper()
+        origin_bb = 1 << origin
+        target_bb = 1 << target
+
+        # take the captured piece off the board; an en passant capture takes the pawn behind the target
+        if captured != '.':
+            bitboards[captured] ^= target_bb
+            if white:
+                self._black ^= target_bb
+            else:
+                self._white ^= target_bb
+        elif target == self._en_passant_square and (char == 'P' or char == 'p'):
+            captured_sq = target + 8 if white else target - 8
+            captured = squares[captured_sq]
+            squares[captured_sq] = '.'
+            bitboards[captured] ^= 1 << captured_sq
+            if white:
+                self._black ^= 1 << captured_sq
+            else:
+                self._white ^= 1 << captured_sq
+
+        self._stack.append(_Undo(move, char, captured, captured_sq, self._castling_rights, self._en_passant_square,
+                                 self._halfmove_clock, self._zobrist, self._pawn_key, self._score))
+        self._fen = None
+        self._attack_cache = None
+        key = self._zobrist ^ ZOBRIST_BLACK_TO_MOVE_KEY
+        score = self._score
+        if captured != '.':
+            key ^= ZOBRIST_PIECE_KEYS[captured][captured_sq]
+            score -= PIECE_SQUARE_VALUES[captured][captured_sq]
+            if captured == 'P' or captured == 'p':
+                self._pawn_key ^= ZOBRIST_PIECE_KEYS[captured][captured_sq]
+        if self._en_passant_square is not None:
+            key ^= ZOBRIST_EN_PASSANT_KEYS[self._en_passant_square % 8]
+
+        # move the piece, promoting it if asked to
+        placed = char
+        if promotion is not None:
+            placed = promotion.value if white else promotion.value.lower()
+        squares[origin] = '.'
+        squares[target] = placed
+        bitboards[char] ^= origin_bb
+        bitboards[placed] ^= target_bb
+        if white:
+            self._white ^= origin_bb | target_bb
+        else:
+            self._black ^= origin_bb | target_bb
+        key ^= ZOBRIST_PIECE_KEYS[char][origin] ^ ZOBRIST_PIECE_KEYS[placed][target]
+        score += PIECE_SQUARE_VALUES[placed][target] - PIECE_SQUARE_VALUES[char][origin]
+        if char == 'P' or char == 'p':
+            self._pawn_key ^= ZOBRIST_PIECE_KEYS[char][origin]
+            if placed == char:
+                self._pawn_key ^= ZOBRIST_PIECE_KEYS[char][target]
+
+        # a castling king brings its rook along
+        if (char == 'K' or char == 'k') and (target - origin == 2 or origin - target == 2):
+            self._move_castling_rook(target, white)
+            rook_origin, rook_target = CASTLING_ROOK_MOVES[target]
+            rook = 'R' if white else 'r'
+            key ^= ZOBRIST_PIECE_KEYS[rook][rook_origin] ^ ZOBRIST_PIECE_KEYS[rook][rook_target]
+            score += PIECE_SQUARE_VALUES[rook][rook_target] - PIECE_SQUARE_VALUES[rook][rook_origin]
+        self._score = score
+
+        castling_rights = self._castling_rights & CASTLING_RIGHTS_KEPT[origin] & CASTLING_RIGHTS_KEPT[target]
+        if castling_rights != self._castling_rights:
+            key ^= ZOBRIST_CASTLING_KEYS[self._castling_rights] ^ ZOBRIST_CASTLING_KEYS[castling_rights]
+            self._castling_rights = castling_rights
+
+        if (char == 'P' or char == 'p') and (target - origin == 16 or origin - target == 16):
+            self._en_passant_square = (origin + target) // 2
+            key ^= ZOBRIST_EN_PASSANT_KEYS[target % 8]
+        else:
+            self._en_passant_square = None
+        self._zobrist = key
+
+        if char == 'P' or char == 'p' or captured != '.':
+            self._halfmove_clock = 0
+        else:
+            self._halfmove_clock += 1
+        if not white:
+            self._fullmove_number += 1
+        self._active_color = Color.BLACK if white else Color.WHITE
+
+    def pop(self) -> Move:
+        """Take back the last move played with push(), restoring the position exactly, and return the move."""
+        (move, char, captured, captured_sq, castling_rights, en_passant_square, halfmove_clock, self._zobrist,
+         self._pawn_key, self._score) = self._stack.pop()
+        self._fen = None
+        self._attack_cache = None
+        origin, target, promotion = move
+        squares = self._squares
+        bitboards = self._bitboards
+        white = char.isupper()
+        origin_bb = 1 << origin
+        target_bb = 1 << target
+
+        placed = squares[target]
+        squares[target] = '.'
+        squares[origin] = char
+        bitboards[placed] ^= target_bb
+        bitboards[char] ^= origin_bb
+        if white:
+            self._white ^= origin_bb | target_bb
+        else:
+            self._black ^= origin_bb | target_bb
+
+        if (char == 'K' or char == 'k') and (target - origin == 2 or origin - target == 2):
+            self._move_castling_rook(target, white)
+
+        if captured != '.':
+            squares[captured_sq] = captured
+            bitboards[captured] ^= 1 << captured_sq
+            if white:
+                self._black ^= 1 << captured_sq
+            else:
+                self._white ^= 1 << captured_sq
+
+        self._castling_rights = castling_rights
+        self._en_passant_square = en_passant_square
+        self._halfmove_clock = halfmove_clock
+        if not white:
+            self._fullmove_number -= 1
+        self._active_color = Color.WHITE if white else Color.BLACK
+        return move
+
+    def _move_castling_rook(self, king_target, white):
+        """Move the rook of a castling king to the square it lands on, or back when the move is taken back."""
+        rook_origin, rook_target = CASTLING_ROOK_MOVES[king_target]
+        squares = self._squares
+        rook_bb = 1 << rook_origin | 1 << rook_target
+        if squares[rook_origin] == '.':
+            rook_origin, rook_target = rook_target, rook_origin
+        squares[rook_target] = squares[rook_origin]
+        squares[rook_origin] = '.'
+        self._bitboards[squares[rook_target]] ^= rook_bb
+        if white:
+            self._white ^= rook_bb
+        else:
+            self._black ^= rook_bb
+
+    def attackers_of(self, square: str, color: Color) -> FrozenSet[str]:
+        """
+        Squares of the pieces of `color` that attack `square`, found by looking outwards from the square
+
+        >>> sorted(Position().attackers_of('f3', Color.WHITE))
+        ['e2', 'g1', 'g2']
+        """
+        return frozenset(SQUARE_NAMES[sq] for sq in _iter_bits(
+            self._attackers(SQUARE_INDICES[square], color == Color.WHITE, self._white | self._black)))
+
+    def is_square_attacked(self, square: str, color: Color) -> bool:
+        """
+        Does a piece of `color` attack `square`? See is_attacked() for the same query on a square index.
+
+        >>> Position().is_square_attacked('e3', Color.WHITE), Position().is_square_attacked('e4', Color.WHITE)
+        (True, False)
+        """
+        return self.is_attacked(SQUARE_INDICES[square], color)
+
+    def is_attacked(self, sq: int, color: Color) -> bool:
+        """
+        Does a piece of `color` attack square index `sq`? Answered from the attack map of `color` if it has been
+        computed for this position, e.g. by attack_map(), and by looking outwards from the square otherwise.
+
+        >>> Position().is_attacked(SQUARE_INDICES['e3'], Color.WHITE)
+        True
+        """
+        by_white = color == Color.WHITE
+        cache = self._attack_cache
+        if cache is not None and by_white in cache:
+            return bool(cache[by_white] >> sq & 1)
+        return bool(self._attackers(sq, by_white, self._white | self._black))
+
+    def attack_map(self, color: Color) -> int:
+        """
+        Bitboard of the squares attacked by the pieces of `color`, whether empty or not, with bit `sq` set for
+        attacked square index `sq`. It is kept until the next push() or pop().
+
+        >>> bin(Position().attack_map(Color.BLACK)).count('1')
+        22
+        """
+        return self._attack_map(color == Color.WHITE)
+
+    def attacked_squares(self, color: Color) -> FrozenSet[str]:
+        """
+        Names of all squares attacked by the pieces of `color`, whether empty or not. See attack_map() for the same
+        squares as a bitboard.
+
+        >>> len(Position().attacked_squares(Color.BLACK))
+        22
+        """
+        return frozenset(SQUARE_NAMES[sq] for sq in _iter_bits(self._attack_map(color == Color.WHITE)))
+
+    def in_check(self, color: Optional[Color] = None) -> bool:
+        """
+        Is the king of `color`, by default the side to move, attacked?
+
+        >>> Position('7k/6Q1/6K1/8/8/8/8/8 b - - 0 1').in_check()
+        True
+        """
+        if color is None or color == self._active_color:
+            return self._in_check()
+        white = color == Color.WHITE
+        king_sq = self._bitboards['K' if white else 'k'].bit_length() - 1
+        return bool(self._attackers(king_sq, not white, self._white | self._black))
+
+    def _in_check(self) -> bool:
+        """Is the king of the side to move attacked?"""
+        return bool(self._checkers())
+
+    def _checkers(self) -> int:
+        """Bitboard of the pieces giving check to the side to move"""
+        cache = self._attack_cache
+        if cache is None:
+            cache = self._attack_cache = {}
+        checkers = cache.get('checkers')
+        if checkers is None:
+            white = self._active_color == Color.WHITE
+            king_sq = self._bitboards['K' if white else 'k'].bit_length() - 1
+            checkers = cache['checkers'] = self._attackers(king_sq, not white, self._white | self._black)
+        return checkers
+
+    def _attack_map(self, by_white) -> int:
+        """Bitboard of the squares attacked by the pieces of one color"""
+        cache = self._attack_cache
+        if cache is None:
+            cache = self._attack_cache = {}
+        attacks = cache.get(by_white)
+        if attacks is not None:
+            return attacks
+        bitboards = self._bitboards
+        occupied = self._white | self._black
+        if by_white:
+            pawns = bitboards['P']
+            attacks = (pawns & ~FILE_A_BB) >> 9 | (pawns & ~FILE_H_BB) >> 7
+            king, queens, rooks, bishops, knights = 'K', 'Q', 'R', 'B', 'N'
+        else:
+            pawns = bitboards['p']
+            attacks = ((pawns & ~FILE_A_BB) << 7 | (pawns & ~FILE_H_BB) << 9) & FULL_BB
+            king, queens, rooks, bishops, knights = 'k', 'q', 'r', 'b', 'n'
+        for sq in _iter_bits(bitboards[knights]):
+            attacks |= KNIGHT_ATTACKS[sq]
+        for sq in _iter_bits(bitboards[king]):
+            attacks |= KING_ATTACKS[sq]
+        for sq in _iter_bits(bitboards[rooks] | bitboards[queens]):
+            attacks |= rook_attacks(sq, occupied)
+        for sq in _iter_bits(bitboards[bishops] | bitboards[queens]):
+            attacks |= bishop_attacks(sq, occupied)
+        cache[by_white] = attacks
+        return attacks
+
+    def _attackers(self, sq, by_white, occupied) -> int:
+        """Bitboard of the pieces of one color that attack square index `sq`, given the occupied squares."""
+        bitboards = self._bitboards
+        if by_white:
+            pawns, knights, king, rooks, bishops, queens = (bitboards['P'], bitboards['N'], bitboards['K'],
+                                                            bitboards['R'], bitboards['B'], bitboards['Q'])
+            pawn_attacks = BLACK_PAWN_ATTACKS[sq]
+        else:
+            pawns, knights, king, rooks, bishops, queens = (bitboards['p'], bitboards['n'], bitboards['k'],
+                                                            bitboards['r'], bitboards['b'], bitboards['q'])
+            pawn_attacks = WHITE_PAWN_ATTACKS[sq]
+        attackers = (pawn_attacks & pawns) | (KNIGHT_ATTACKS[sq] & knights) | (KING_ATTACKS[sq] & king)
+        if ROOK_EMPTY_BOARD_ATTACKS[sq] & (rooks | queens):
+            attackers |= rook_attacks(sq, occupied) & (rooks | queens)
+        if BISHOP_EMPTY_BOARD_ATTACKS[sq] & (bishops | queens):
+            attackers |= bishop_attacks(sq, occupied) & (bishops | queens)
+        return attackers & occupied
+
+    def _pinned(self, king_sq, white, occupied) -> int:
+        """Bitboard of the pieces of the side to move that are pinned to its king."""
+        bitboards = self._bitboards
+        if white:
+            own = self._white
+            rooks, bishops, queens = bitboards['r'], bitboards['b'], bitboards['q']
+        else:
+            own = self._black
+            rooks, bishops, queens = bitboards['R'], bitboards['B'], bitboards['Q']
+        snipers = ((ROOK_EMPTY_BOARD_ATTACKS[king_sq] & (rooks | queens)) |
+                   (BISHOP_EMPTY_BOARD_ATTACKS[king_sq] & (bishops | queens)))
+        pinned = 0
+        between = BETWEEN[king_sq]
+        for sniper_sq in _iter_bits(snipers):
+            blockers = between[sniper_sq] & occupied
+            if blockers and not blockers & (blockers - 1) and blockers & own:
+                pinned |= blockers
+        return pinned
+
+    def legal_moves(self) -> List[Move]:
+        """
+        All legal moves in this position.
+
+        >>> len(Position().legal_moves())
+        20
+        """
+        moves_by_code = MOVES_BY_CODE
+        return [moves_by_code[code] for code in self._legal_move_codes()]
+
+    def _legal_move_codes(self, tactical=True, quiet=True) -> List[int]:
+        """
+        Codes of the legal moves in this position, packed as by encode_move(): the tactical ones (captures and
+        promotions), the quiet ones (all others), or both.
+
+        Checks are handled without trying moves out: in check, moves other than the king's must capture the checker or
+        block its line, and pinned pieces may only move along the line of their pin. Only en passant captures, which
+        take two pieces off a rank at once, are verified by looking at the resulting occupancy.
+        """
+        white = self._active_color == Color.WHITE
+        bitboards = self._bitboards
+        if white:
+            own, enemy = self._white, self._black
+            king_char, queen_char, rook_char, bishop_char, knight_char, pawn_char = WHITE_PIECE_CHARS
+            pawn_attack_table = WHITE_PAWN_ATTACKS
         else:
-            orig_x, orig_y = self.square_str_to_xy(possible_origins.pop())
-
-        if piece == Piece.PAWN:
-            # set en-passant targets if pawn moved 2
-            if orig_y == 6 and targ_y == 4 and self._active_color == Color.WHITE:
-                new_en_passant_target = self.square_xy_to_str(orig_x, orig_y - 1)
-            if orig_y == 1 and targ_y == 3 and self._active_color == Color.BLACK:
-                new_en_passant_target = self.square_xy_to_str(orig_x, orig_y + 1)
-            # all pawn moves reset halfmove clock
-            reset_halfmove_clock = True
-            # promotion
-            if targ_y in (0, 7) and parsed['promote'] is None:
-                # TODO implement promotion when it's actually specified
-                raise Exception('Illegal move: must promote upon advancing to final rank')
-
-        # create new position
-
-        new_board = [list(x) for x in self._board_array]
-        # move piece
-        new_board[orig_y][orig_x] = '.'
-        new_board[targ_y][targ_x] = piece.value.upper() if self._active_color == Color.WHITE else piece.value.lower()
-        # read pieces to FEN
-        new_fen_pieces = self.fen_pieces_from_board_array(new_board)
-        # switch color
-        new_active_color = 'b' if self._active_color == Color.WHITE else 'w'
-        # clear en passant if we didn't create new target
-        new_en_passant_target = new_en_passant_target or '-'
-        # increment numbers
-        new_halfmove_clock = 0 if reset_halfmove_clock else self._halfmove_clock + 1
-        new_fullmove_number = self._fullmove_number if self._active_color == Color.WHITE else self._fullmove_number + 1
-
-        if not remove_castling_availability:
-            new_castling_availability = self._castling_availability
+            own, enemy = self._black, self._white
+            king_char, queen_char, rook_char, bishop_char, knight_char, pawn_char = BLACK_PIECE_CHARS
+            pawn_attack_table = BLACK_PAWN_ATTACKS
+        occupied = own | enemy
+        king_sq = bitboards[king_char].bit_length() - 1
+        checkers = self._checkers()
+        tactical_mask = enemy if tactical else 0
+        stage_mask = tactical_mask | (~occupied & FULL_BB if quiet else 0)
+
+        moves = []
+
+        # the king may go anywhere not attacked, with the king itself taken off the board so that it cannot hide
+        # behind itself from a slider
+        occupied_without_king = occupied ^ (1 << king_sq)
+        for target in _iter_bits(KING_ATTACKS[king_sq] & stage_mask):
+            if not self._attackers(target, not white, occupied_without_king):
+                moves.append(king_sq | target << 6)
+
+        if checkers & (checkers - 1):  # double check, only the king can move
+            return moves
+
+        if checkers:
+            checker_sq = checkers.bit_length() - 1
+            check_mask = (checkers | BETWEEN[king_sq][checker_sq]) & ~own
         else:
-            raise NotImplementedError('Yet to figure out how castling is invalidated')
+            check_mask = ~own & FULL_BB
+            if quiet:
+                self._castling_moves(white, king_sq, occupied, moves)
+        target_mask = check_mask & stage_mask
+        # a pawn about to promote only makes tactical moves, pushes included
+        promotion_mask = check_mask if tactical else 0
+
+        pinned = self._pinned(king_sq, white, occupied)
+        line = LINE[king_sq]
+
+        for sq in _iter_bits(bitboards[knight_char] & ~pinned):  # a pinned knight can never move
+            for target in _iter_bits(KNIGHT_ATTACKS[sq] & target_mask):
+                moves.append(sq | target << 6)
+
+        for char, attacks in ((bishop_char, bishop_attacks), (rook_char, rook_attacks), (queen_char, queen_attacks)):
+            for sq in _iter_bits(bitboards[char]):
+                targets = attacks(sq, occupied) & target_mask
+                if pinned >> sq & 1:
+                    targets &= line[sq]
+                for target in _iter_bits(targets):
+                    moves.append(sq | target << 6)
+
+        en_passant_sq = self._en_passant_square
+        for sq in _iter_bits(bitboards[pawn_char]):
+            if white:
+                one = sq - 8
+                targets = 0 if occupied >> one & 1 else 1 << one
+                if targets and sq >= 48 and not occupied >> (one - 8) & 1:
+                    targets |= 1 << (one - 8)
+            else:
+                one = sq + 8
+                targets = 0 if occupied >> one & 1 else 1 << one
+                if targets and sq < 16 and not occupied >> (one + 8) & 1:
+                    targets |= 1 << (one + 8)
+            targets = (targets | pawn_attack_table[sq] & enemy) & (
+                promotion_mask if (sq < 16 if white else sq >= 48) else target_mask)
+            if pinned >> sq & 1:
+                targets &= line[sq]
+            for target in _iter_bits(targets):
+                if target < 8 or target >= 56:
+                    code = sq | target << 6  # promoting to a queen, rook, bishop or knight
+                    moves.extend((code | 0x1000, code | 0x2000, code | 0x3000, code | 0x4000))
+                else:
+                    moves.append(sq | target << 6)
+
+            if en_passant_sq is not None and tactical and pawn_attack_table[sq] >> en_passant_sq & 1:
+                captured_sq = en_passant_sq + 8 if white else en_passant_sq - 8
+                occupied_after = occupied ^ (1 << sq) ^ (1 << captured_sq) | (1 << en_passant_sq)
+                if not self._attackers(king_sq, not white, occupied_after):
+                    moves.append(sq | en_passant_sq << 6)
+
+        return moves
+
+    def _castling_moves(self, white, king_sq, occupied, moves):
+        """Append the codes of the castling moves available to a king that is not in check."""
+        if not self._castling_rights:
+            return
+        rooks = self._bitboards['R' if white else 'r']
+        for bit, rook_sq, empty, passed_sq, target_sq in (WHITE_CASTLING if white else BLACK_CASTLING):
+            if not self._castling_rights & bit or not rooks >> rook_sq & 1 or occupied & empty:
+                continue
+            if self._attackers(passed_sq, not white, occupied) or self._attackers(target_sq, not white, occupied):
+                continue
+            moves.append(king_sq | target_sq << 6)
+
+    def staged_moves(self, tt_move: Optional[Move] = None, killers: Iterable[Optional[Move]] = (),
+                     history: Optional[Callable[[Move], int]] = None, quiets: bool = True) -> 'StagedMoves':
+        """
+        Iterator over the legal moves in the order a search tries them, generating each stage only once the one before
+        it is used up, so that a cutoff on an early move saves generating the rest: `tt_move` if it is legal, captures
+        and promotions by most valuable victim and least valuable attacker, the legal quiet moves among `killers`, and
+        the other quiet moves, highest `history` first if given. Without `quiets` only captures and promotions.
 
-        # construct new FEN and create Position
-        new_fen = '{} {} {} {} {} {}'.format(new_fen_pieces, new_active_color, new_castling_availability,
-                                             new_en_passant_target, new_halfmove_clock, new_fullmove_number)
-        return Position(fen=new_fen)
+        The position may be changed between moves as long as it is restored, as a search does with push() and pop().
+
+        >>> position = Position('4k3/8/8/3p4/4P3/8/8/4K3 w - - 0 1')
+        >>> [m.uci() for m in position.staged_moves(killers=[Move.from_uci('e4e5')])][:2]
+        ['e4d5', 'e4e5']
+        """
+        return StagedMoves(self, tt_move, killers, history, quiets)
+
+    def _is_legal_code(self, code) -> bool:
+        """Is the move with this code legal here? For moves from elsewhere, like a hash table or a killer slot."""
+        origin = code & 63
+        target = code >> 6 & 63
+        char = self._squares[origin]
+        white = self._active_color == Color.WHITE
+        if char == '.' or char.isupper() != white:
+            return False
+        occupied = self._white | self._black
+        king_char = 'K' if white else 'k'
+        if char == king_char and (target - origin == 2 or origin - target == 2):
+            castling = []
+            if not self._checkers():
+                self._castling_moves(white, origin, occupied, castling)
+            return code in castling
+        if not self._candidate_targets_bb(origin, char) >> target & 1:
+            return False
+        pawn = char == 'P' or char == 'p'
+        if (pawn and (target < 8 or target >= 56)) != bool(code >> 12):
+            return False
+        # the king must not be attacked afterwards, by anything but the piece captured
+        occupied_after = occupied & ~(1 << origin) | 1 << target
+        if pawn and target == self._en_passant_square:
+            occupied_after ^= 1 << (target + 8 if white else target - 8)
+        king_sq = target if char == king_char else self._bitboards[king_char].bit_length() - 1
+        return not self._attackers(king_sq, not white, occupied_after) & ~(1 << target)
 
     @staticmethod
     def square_str_to_xy(square_str):
@@ -183,7 +1155,8 @@ class Position:
         >>> Position.square_str_to_xy('a1')
         (0, 7)
         """
-        return list('abcdefgh').index(square_str[0]), list('87654321').index(square_str[1])
+        sq = SQUARE_INDICES[square_str]
+        return sq % 8, sq // 8
 
     @staticmethod
     def square_xy_to_str(x, y):
@@ -191,7 +1164,7 @@ class Position:
         >>> Position.square_xy_to_str(7, 3)
         'h5'
         """
-        return 'abcdefgh'[x] + '87654321'[y]
+        return SQUARE_NAMES[y * 8 + x]
 
     def find_pieces_xy(self, piece: Piece, color: Color) -> FrozenSet[tuple]:
         """
@@ -200,7 +1173,7 @@ class Position:
         True
         """
         char = piece.value.upper() if color == Color.WHITE else piece.value.lower()
-        return frozenset((x, y) for x in range(8) for y in range(8) if self._board_array[y][x] == char)
+        return frozenset((sq % 8, sq // 8) for sq in _iter_bits(self._bitboards[char]))
 
     def find_pieces(self, piece: Piece, color: Color) -> FrozenSet[tuple]:
         """
@@ -208,28 +1181,27 @@ class Position:
         >>> ps == {'c1', 'f1'}
         True
         """
-        return frozenset(self.square_xy_to_str(*xy) for xy in self.find_pieces_xy(piece, color))
+        char = piece.value.upper() if color == Color.WHITE else piece.value.lower()
+        return frozenset(SQUARE_NAMES[sq] for sq in _iter_bits(self._bitboards[char]))
 
     def pieces_that_can_move_here(self, piece: Piece, target: str, color: Color) -> FrozenSet[str]:
         """Current locations of pieces that can move to target, not taking checks into account."""
-        origins = set()
-        candidate_origins = self.find_pieces(piece, color)
-        for co in candidate_origins:
-            if target in self.candidate_targets_from(co):
-                origins.add(co)
-        return frozenset(origins)
+        char = piece.value.upper() if color == Color.WHITE else piece.value.lower()
+        target_sq = SQUARE_INDICES[target]
+        return frozenset(SQUARE_NAMES[sq] for sq in _iter_bits(self._bitboards[char])
+                         if self._candidate_targets_bb(sq, char) >> target_sq & 1)
 
     def _look_xy(self, x, y) -> str:
         """Find character occupying xy"""
-        return self._board_array[y][x]
+        return self._squares[y * 8 + x]
 
     def _look_sq(self, square_str) -> str:
         """Find character occupying square"""
-        return self._look_xy(*self.square_str_to_xy(square_str))
+        return self._squares[SQUARE_INDICES[square_str]]
 
     def _empty_xy(self, x, y) -> bool:
         """Is xy empty?"""
-        return self._look_xy(x, y) == '.'
+        return self._squares[y * 8 + x] == '.'
 
     @staticmethod
     def _xy_on_board(x, y) -> bool:
@@ -243,156 +1215,297 @@ class Position:
 
         Empty origin square returns None, and a non-empty square with no targets returns an empty frozenset.
         """
-        char = self._look_sq(origin)
+        sq = SQUARE_INDICES[origin]
+        char = self._squares[sq]
         if char == '.':
             return
+        return frozenset(SQUARE_NAMES[t] for t in _iter_bits(self._candidate_targets_bb(sq, char)))
 
-        piece_type = Piece(char.upper())
-        color = Color.WHITE if char.isupper() else Color.BLACK
-
-        candidates = set()
-
-        x, y = self.square_str_to_xy(origin)
-
-        # chains of positions a bishop, rook or queen moves in a single direction
-        horizontal_pos = ((d, 0) for d in range(1, 8))
-        horizontal_neg = ((-d, 0) for d in range(1, 8))
-        vertical_pos = ((0, d) for d in range(1, 8))
-        vertical_neg = ((0, -d) for d in range(1, 8))
-        diagonal_pos_pos = ((d, d) for d in range(1, 8))
-        diagonal_pos_neg = ((d, -d) for d in range(1, 8))
-        diagonal_neg_pos = ((-d, d) for d in range(1, 8))
-        diagonal_neg_neg = ((-d, -d) for d in range(1, 8))
-
-        if piece_type == Piece.PAWN:
-            start_y = 6 if color == Color.WHITE else 1
-            dy = -1 if color == Color.WHITE else 1
-
-            # moves straight ahead
-            if self._empty_xy(x, y+dy):
-                candidates.add(self.square_xy_to_str(x, y+dy))
-                if y == start_y and self._empty_xy(x, y+2*dy):  # rank 2
-                    candidates.add(self.square_xy_to_str(x, y+2*dy))
-
-            # capturing moves
-            for pxy in ((x-1, y+dy), (x+1, y+dy)):
-                if self._xy_on_board(*pxy):
-                    if self._look_xy(*pxy).islower() and color == Color.WHITE:
-                        candidates.add(self.square_xy_to_str(*pxy))
-                    if self._look_xy(*pxy).isupper() and color == Color.BLACK:
-                        candidates.add(self.square_xy_to_str(*pxy))
-
-                if self._en_passant_target != '-' and pxy == self.square_str_to_xy(self._en_passant_target):
-                    candidates.add(self._en_passant_target)
-
-        elif piece_type == Piece.KNIGHT:
-            possible_xys = (
-                (x+1, y+2), (x+1, y-2),
-                (x+2, y+1), (x+2, y-1),
-                (x-1, y+2), (x-1, y-2),
-                (x-2, y+1), (x-2, y-1)
-            )
-            for pxy in possible_xys:
-                if not self._xy_on_board(*pxy):
-                    continue
-                if self._empty_xy(*pxy):
-                    candidates.add(self.square_xy_to_str(*pxy))
-                # capturing moves
-                elif (self._look_xy(*pxy).islower() and color == Color.WHITE) \
-                        or (self._look_xy(*pxy).isupper() and color == Color.BLACK):
-                    candidates.add(self.square_xy_to_str(*pxy))
-
-        elif piece_type == Piece.BISHOP:
-            for direction_displacement_seq in diagonal_pos_pos, diagonal_pos_neg, diagonal_neg_pos, diagonal_neg_neg:
-                for dx, dy in direction_displacement_seq:
-                    pxy = x+dx, y+dy
-                    if not self._xy_on_board(*pxy):
-                        break
-                    if self._empty_xy(*pxy):
-                        candidates.add(self.square_xy_to_str(*pxy))
-                    else:
-                        if (self._look_xy(*pxy).islower() and color == Color.WHITE) \
-                                or (self._look_xy(*pxy).isupper() and color == Color.BLACK):
-                            candidates.add(self.square_xy_to_str(*pxy))
-                        break
-
-        elif piece_type == Piece.ROOK:
-            for direction_displacement_seq in horizontal_pos, horizontal_neg, vertical_pos, vertical_neg:
-                for dx, dy in direction_displacement_seq:
-                    pxy = x+dx, y+dy
-                    if not self._xy_on_board(*pxy):
-                        break
-                    if self._empty_xy(*pxy):
-                        candidates.add(self.square_xy_to_str(*pxy))
-                    else:
-                        if (self._look_xy(*pxy).islower() and color == Color.WHITE) \
-                                or (self._look_xy(*pxy).isupper() and color == Color.BLACK):
-                            candidates.add(self.square_xy_to_str(*pxy))
-                        break
-
-        elif piece_type == Piece.QUEEN:
-            for direction_displacement_seq in horizontal_pos, horizontal_neg, vertical_pos, vertical_neg, \
-                                              diagonal_pos_pos, diagonal_pos_neg, diagonal_neg_pos, diagonal_neg_neg:
-                for dx, dy in direction_displacement_seq:
-                    pxy = x+dx, y+dy
-                    if not self._xy_on_board(*pxy):
-                        break
-                    if self._empty_xy(*pxy):
-                        candidates.add(self.square_xy_to_str(*pxy))
-                    else:
-                        if (self._look_xy(*pxy).islower() and color == Color.WHITE) \
-                                or (self._look_xy(*pxy).isupper() and color == Color.BLACK):
-                            candidates.add(self.square_xy_to_str(*pxy))
-                        break
+    def _candidate_targets_bb(self, sq, char):
+        """Bitboard of candidate targets for piece `char` standing on square index `sq`."""
+        white = char.isupper()
+        own, enemy = (self._white, self._black) if white else (self._black, self._white)
+        occupied = own | enemy
+        piece_type = char.upper()
 
-        elif piece_type == Piece.KING:
-            displacements = set(product((-1, 0, 1), repeat=2))
-            displacements.remove((0, 0))
-            for dx, dy in displacements:
-                pxy = x+dx, y+dy
-                if not self._xy_on_board(*pxy):
-                    continue
-                if self._empty_xy(*pxy):
-                    candidates.add(self.square_xy_to_str(*pxy))
-                # capturing moves
-                elif (self._look_xy(*pxy).islower() and color == Color.WHITE) \
-                        or (self._look_xy(*pxy).isupper() and color == Color.BLACK):
-                    candidates.add(self.square_xy_to_str(*pxy))
+        if piece_type == 'P':
+            if white:
+                single = (1 << sq >> 8) & ~occupied
+                targets = single
+                if sq >= 48:  # rank 2
+                    targets |= (single >> 8) & ~occupied
+                captures = WHITE_PAWN_ATTACKS[sq]
+            else:
+                single = (1 << sq << 8) & ~occupied
+                targets = single
+                if sq < 16:  # rank 7
+                    targets |= (single << 8) & ~occupied
+                captures = BLACK_PAWN_ATTACKS[sq]
+            targets |= captures & enemy
+            if self._en_passant_square is not None:
+                targets |= captures & (1 << self._en_passant_square)
+            return targets & FULL_BB
 
-        return frozenset(candidates)
+        if piece_type == 'N':
+            return KNIGHT_ATTACKS[sq] & ~own
+        if piece_type == 'K':
+            return KING_ATTACKS[sq] & ~own
+        if piece_type == 'B':
+            return bishop_attacks(sq, occupied) & ~own
+        if piece_type == 'R':
+            return rook_attacks(sq, occupied) & ~own
+        return queen_attacks(sq, occupied) & ~own
 
 
-# TODO: move most of these doctests elsewhere
-def parse_move(move_str: str) -> dict:
+class StagedMoves:
+    """
+    Iterator over the legal moves of a position in search order, made by Position.staged_moves(). `stage` is the
+    stage of the last move returned, 'tt', 'tactical', 'killers' or 'quiet', and `generated` counts the moves generated
+    so far, to compare against generating them all up front.
     """
-    Given a move in algebraic notation, return a dict describing it.
 
-    >>> parse_move('Qe5') == {
-    ...     'piece': 'Q', 'target': 'e5',
-    ...     'orig_rank': None, 'orig_file': None, 'capture': False, 'castle': None, 'check': False, 'checkmate': False,
-    ...     'promote': None
-    ... }
-    True
+    def __init__(self, position: Position, tt_move: Optional[Move] = None, killers: Iterable[Optional[Move]] = (),
+                 history: Optional[Callable[[Move], int]] = None, quiets: bool = True):
+        self.position = position
+        self.stage = None
+        self.generated = 0
+        self._moves = self._stages(tt_move, killers, history, quiets)
 
-    >>> parse_move('0-0-0')['castle']
-    'queenside'
+    def __iter__(self):
+        return self
 
-    >>> parse_move('O-O')['castle']
-    'kingside'
+    def __next__(self) -> Move:
+        return next(self._moves)
 
-    >>> m = parse_move('exd5')
-    >>> m['piece'], m['orig_file'], m['capture'], m['target']
-    ('P', 'e', True, 'd5')
+    def _stages(self, tt_move, killers, history, quiets):
+        position = self.position
+        squares = position._squares
+        moves_by_code = MOVES_BY_CODE
+        en_passant_sq = position._en_passant_square
 
-    >>> parse_move('Ze5') # doctest: +ELLIPSIS
-    Traceback (most recent call last):
-    ...
-    ValueError: ...
+        tt_code = encode_move(tt_move)
+        if tt_code and position._is_legal_code(tt_code):
+            self.stage = 'tt'
+            self.generated += 1
+            yield tt_move
 
-    >>> parse_move('dxe8=Q+') == {
-    ...     'piece': 'P', 'orig_file': 'd', 'capture': True, 'target': 'e8', 'promote': 'Q', 'check': True,
-    ...     'orig_rank': None, 'castle': None, 'checkmate': False}
-    True
+        def mvv_lva(code):
+            victim = squares[code >> 6 & 63]
+            if victim != '.':
+                value = 10 * PIECE_VALUES[victim.upper()]
+            elif code >> 12:
+                value = 0
+            else:  # en passant
+                value = 10 * PIECE_VALUES['P']
+            if code >> 12:
+                value += PIECE_VALUES[PROMOTIONS_BY_CODE[code >> 12].value]
+            return value - PIECE_VALUES[squares[code & 63].upper()]
+
+        # the tt move and killers were generated on their own already, so each stage counts only the others
+        codes = [code for code in position._legal_move_codes(quiet=False) if code != tt_code]
+        self.generated += len(codes)
+        self.stage = 'tactical'
+        for code in sorted(codes, key=mvv_lva, reverse=True):
+            yield moves_by_code[code]
+        if not quiets:
+            return
+
+        self.stage = 'killers'
+        killer_codes = [tt_code]
+        for killer in killers:
+            code = encode_move(killer)
+            target = code >> 6 & 63
+            if (not code or code in killer_codes or squares[target] != '.' or code >> 12 or
+                    target == en_passant_sq and squares[code & 63] in 'Pp' or not position._is_legal_code(code)):
+                continue
+            killer_codes.append(code)
+            self.generated += 1
+            yield killer
+
+        moves = [moves_by_code[code] for code in position._legal_move_codes(tactical=False) if code not in killer_codes]
+        self.generated += len(moves)
+        self.stage = 'quiet'
+        if history is not None:
+            moves.sort(key=history, reverse=True)
+        yield from moves
+
+
+# parsed FENs kept by _parse_fen(), about 1 kB each
+FEN_CACHE_SIZE = 1 << 14
+
+
+@lru_cache(maxsize=FEN_CACHE_SIZE)
+def _parse_fen(fen):
+    """Fields of the position for a FEN, see Position._parsed(), cached so that repeated FENs are parsed once"""
+    position = Position.__new__(Position)
+    position._parse(fen)
+    return position._parsed()
+
+
+def pack_positions(positions: Iterable['Position']) -> bytearray:
+    """
+    Positions packed back to back into one buffer of POSITION_BYTES each, see Position.to_bytes()
+
+    >>> len(pack_positions([Position(), Position().move('e4')]))
+    64
+    """
+    positions = list(positions)
+    buffer = bytearray(POSITION_BYTES * len(positions))
+    for i, position in enumerate(positions):
+        position._pack_into(buffer, i * POSITION_BYTES)
+    return buffer
+
+
+def unpack_positions(buffer) -> Iterator['Position']:
+    """
+    Positions from a buffer written by pack_positions(), decoded one at a time
+
+    >>> [p.fen() for p in unpack_positions(pack_positions([Position()]))]
+    ['rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1']
+    """
+    if len(buffer) % POSITION_BYTES:
+        raise ValueError('Buffer length {} is not a multiple of {}'.format(len(buffer), POSITION_BYTES))
+    new = Position.__new__
+    for fields in POSITION_STRUCT.iter_unpack(buffer):
+        position = new(Position)
+        position._unpack(fields)
+        yield position
+
+
+def position_array(buffer):
+    """
+    NumPy structured array viewing a buffer written by pack_positions() without copying it, with the fields of
+    POSITION_DTYPE. Requires NumPy.
+    """
+    if np is None:
+        raise ImportError('position_array() requires numpy')
+    return np.frombuffer(buffer, dtype=POSITION_DTYPE)
+
+
+class ParsedMove(NamedTuple):
+    """A move in standard algebraic notation, broken into its parts"""
+    piece: Optional[str]
+    orig_rank: Optional[str]
+    orig_file: Optional[str]
+    capture: bool
+    target: Optional[str]
+    castle: Optional[str]
+    check: bool
+    checkmate: bool
+    promote: Optional[str]
+
+
+_SAN_PATTERN = re.compile(r'''
+    (?: (?P<piece>[KQRBNP]) | (?=[a-h]) )  # piece letter, or a pawn move starting with a file
+    (?P<orig_file>[a-h])?
+    (?P<orig_rank>[1-8])?
+    (?P<capture>x)?
+    (?P<target>[a-h][1-8])
+    (?: =(?P<promote>[KQRBN]) )?
+    (?P<suffix>[+#])?
+    \Z''', re.VERBOSE)
+
+_CASTLING_SAN = {'O-O': 'kingside', '0-0': 'kingside', 'O-O-O': 'queenside', '0-0-0': 'queenside'}
+
+
+def _common_san_records():
+    """
+    ParsedMove records of the most common tokens: piece moves and captures with no disambiguation, pawn pushes and
+    pawn captures without promotion, each with no suffix, check or checkmate
+    """
+    records = {}
+    for target in SQUARE_NAMES:
+        for suffix in ('', '+', '#'):
+            check, checkmate = suffix == '+', suffix == '#'
+            records[target + suffix] = ParsedMove('P', None, None, False, target, None, check, checkmate, None)
+            for file in 'abcdefgh':
+                records[file + 'x' + target + suffix] = ParsedMove('P', None, file, True, target, None, check,
+                                                                   checkmate, None)
+            for piece in 'KQRBN':
+                for capture in ('', 'x'):
+                    records[piece + capture + target + suffix] = ParsedMove(piece, None, None, bool(capture), target,
+                                                                            None, check, checkmate, None)
+    return records
+
+
+# looked up before the pattern is tried, as most tokens in game records are one of these
+_COMMON_SAN_RECORDS = _common_san_records()
+
+
+@lru_cache(maxsize=1 << 16)
+def parse_san(move_str: str) -> ParsedMove:
+    """
+    Parse a move in standard algebraic notation into a ParsedMove. Results are memoized, as game records use a
+    small set of distinct move strings over and over.
+
+    >>> parse_san('Nbxd7+')
+    ParsedMove(piece='N', orig_rank=None, orig_file='b', capture=True, target='d7', castle=None, check=True, \
+checkmate=False, promote=None)
+    >>> parse_san('O-O-O#').castle
+    'queenside'
+    """
+    if not isinstance(move_str, str):
+        raise TypeError('Expected string')
+    record = _COMMON_SAN_RECORDS.get(move_str)
+    if record is not None:
+        return record
+
+    castle = _CASTLING_SAN.get(move_str.rstrip('+#'))
+    if castle is not None:
+        suffix = move_str[len(move_str.rstrip('+#')):]
+        if suffix not in ('', '+', '#'):
+            raise ValueError('Unable to parse this one')
+        return ParsedMove(None, None, None, False, None, castle, suffix == '+', suffix == '#', None)
+
+    match = _SAN_PATTERN.match(move_str)
+    if match is None:
+        raise ValueError('Unable to parse this one')
+    piece, orig_file, orig_rank, capture, target, promote, suffix = match.groups()
+    return ParsedMove(piece or 'P', orig_rank, orig_file, capture is not None, target, None, suffix == '+',
+                      suffix == '#', promote)
+
+
+def parse_moves(move_strs: Iterable[str]) -> List[ParsedMove]:
+    """
+    Parse many moves in standard algebraic notation at once
+
+    >>> [m.target for m in parse_moves(['e4', 'e5', 'Nf3'])]
+    ['e4', 'e5', 'f3']
+    """
+    return list(map(parse_san, move_strs))
+
+
+# TODO: move most of these doctests elsewhere
+def parse_move(move_str: str) -> dict:
+    """
+    Given a move in algebraic notation, return a dict describing it. See parse_san() for a faster, immutable record.
+
+    >>> parse_move('Qe5') == {
+    ...     'piece': 'Q', 'target': 'e5',
+    ...     'orig_rank': None, 'orig_file': None, 'capture': False, 'castle': None, 'check': False, 'checkmate': False,
+    ...     'promote': None
+    ... }
+    True
+
+    >>> parse_move('0-0-0')['castle']
+    'queenside'
+
+    >>> parse_move('O-O')['castle']
+    'kingside'
+
+    >>> m = parse_move('exd5')
+    >>> m['piece'], m['orig_file'], m['capture'], m['target']
+    ('P', 'e', True, 'd5')
+
+    >>> parse_move('Ze5') # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    ValueError: ...
+
+    >>> parse_move('dxe8=Q+') == {
+    ...     'piece': 'P', 'orig_file': 'd', 'capture': True, 'target': 'e8', 'promote': 'Q', 'check': True,
+    ...     'orig_rank': None, 'castle': None, 'checkmate': False}
+    True
 
     >>> m = parse_move('Be3xd4+')
     >>> m['piece'], m['orig_file'], m['orig_rank'], m['capture'], m['target'], m['check']
@@ -470,90 +1583,2847 @@ def parse_move(move_str: str) -> dict:
     True
     """
 
-    d = dict(piece=None, orig_rank=None, orig_file=None, capture=False,
-             target=None, castle=None, check=False, checkmate=False, promote=None)
+    return parse_san(move_str)._asdict()
 
-    # let's make sure you don't pass lists or something stupid here
-    if not isinstance(move_str, str):
-        raise TypeError('Expected string')
 
-    # castling
-    if move_str[0] in 'O0':
-        if move_str in ('O-O', '0-0'):
-            castle_side = 'kingside'
-        elif move_str in ('O-O-O', '0-0-0'):
-            castle_side = 'queenside'
-        else:
-            raise ValueError('Unable to parse this one')
-        d['castle'] = castle_side
-        return d
-
-    # get piece
-    if move_str[0] in 'KQRBNP':
-        d['piece'] = move_str[0]
-        move_str = move_str[1:]
-    elif move_str[0] in 'abcdefgh':
-        d['piece'] = 'P'
+_TAG_PATTERN = re.compile(r'\[\s*(\w+)\s+"((?:[^"\\]|\\.)*)"\s*\]')
+_MOVETEXT_TOKEN_PATTERN = re.compile(r'''
+      (?P<comment> \{[^}]*\} | ;[^\n]* )
+    | (?P<open> \( )
+    | (?P<close> \) )
+    | (?P<result> (?:1-0|0-1|1/2-1/2|\*)(?=\s|$) )
+    | (?P<skip> \$\d+ | \d+\.+ )
+    | (?P<san> [^\s{};()$]+ )
+''', re.VERBOSE)
+
+
+class PGNGame:
+    """
+    One game read from a PGN stream.
+
+    Only the raw text is kept; the tag pairs are parsed on first access and the moves only when asked for, so
+    skipping a game costs next to nothing.
+    """
+
+    def __init__(self, tag_text: str, movetext: str):
+        self.tag_text = tag_text
+        self.movetext = movetext
+        self._tags = None
+
+    def __repr__(self):
+        return '{}({} vs {})'.format(self.__class__.__name__, self.tags.get('White', '?'), self.tags.get('Black', '?'))
+
+    @property
+    def tags(self) -> Dict[str, str]:
+        if self._tags is None:
+            self._tags = {name: value.replace('\\"', '"').replace('\\\\', '\\')
+                          for name, value in _TAG_PATTERN.findall(self.tag_text)}
+        return self._tags
+
+    @property
+    def result(self) -> str:
+        """Result tag, or else the termination marker at the end of the movetext"""
+        if 'Result' in self.tags:
+            return self.tags['Result']
+        for match in _MOVETEXT_TOKEN_PATTERN.finditer(self.movetext):
+            if match.lastgroup == 'result':
+                return match.group()
+        return '*'
+
+    def starting_position(self) -> Position:
+        return Position(self.tags['FEN']) if 'FEN' in self.tags else Position()
+
+    def moves(self) -> List[str]:
+        """SAN moves of the main line, without comments, variations, NAGs, move numbers and annotation marks"""
+        moves = []
+        depth = 0
+        for match in _MOVETEXT_TOKEN_PATTERN.finditer(self.movetext):
+            kind = match.lastgroup
+            if kind == 'open':
+                depth += 1
+            elif kind == 'close':
+                depth -= 1
+            elif kind == 'san' and depth == 0:
+                moves.append(match.group().rstrip('!?'))
+        return moves
+
+    def positions(self) -> Iterator[Position]:
+        """
+        Replay the game and yield the position after each ply. The positions yielded are independent copies;
+        iterate over fens() when FEN strings are all that is needed.
+        """
+        for position in self._replay():
+            yield position.copy()
+
+    def fens(self) -> Iterator[str]:
+        """Replay the game and yield the FEN after each ply"""
+        for position in self._replay():
+            yield position.fen()
+
+    def _replay(self):
+        position = self.starting_position()
+        for san in parse_moves(self.moves()):
+            position.push(position._move_from_parsed(san))
+            yield position
+
+
+def read_games(source) -> Iterator[PGNGame]:
+    """
+    Stream the games of a PGN file one at a time, holding no more than one game's text in memory.
+
+    `source` is a path, a text or binary file object, or a buffer such as bytes or an mmap. A path is memory-mapped.
+
+    >>> pgn = b'[White "A"]\\n[Black "B"]\\n\\n1. e4 {best by test} e5 (1... c5) 2. Nf3 1-0\\n'
+    >>> game = next(read_games(pgn))
+    >>> game.tags['White'], game.moves(), game.result
+    ('A', ['e4', 'e5', 'Nf3'], '1-0')
+    >>> list(game.fens())[-1]
+    'rnbqkbnr/pppp1ppp/8/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R b KQkq - 1 2'
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                yield from _games_from_lines(iter(buffer.readline, b''))
+        return
+    if isinstance(source, (bytes, bytearray, memoryview, mmap.mmap)):
+        yield from _games_from_lines(io.BytesIO(source))
+        return
+    yield from _games_from_lines(source)
+
+
+def _games_from_lines(lines):
+    tag_lines = []
+    movetext_lines = []
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', errors='replace')
+        stripped = line.strip()
+        if stripped.startswith('[') and not stripped.startswith('[%'):
+            if movetext_lines:
+                yield PGNGame(''.join(tag_lines), ''.join(movetext_lines))
+                tag_lines, movetext_lines = [], []
+            tag_lines.append(line)
+        elif stripped:
+            movetext_lines.append(line)
+    if tag_lines or movetext_lines:
+        yield PGNGame(''.join(tag_lines), ''.join(movetext_lines))
+
+
+def replay_game(game: PGNGame) -> int:
+    """Replay a game, raising if a move is illegal, and return the number of plies"""
+    plies = 0
+    for _ in game.fens():
+        plies += 1
+    return plies
+
+
+def check_game(game: PGNGame) -> Optional[str]:
+    """Replay a game and return a description of the first problem found, or None if it replays cleanly"""
+    try:
+        replay_game(game)
+    except Exception as e:
+        return '{}: {}'.format(game, e)
+    return None
+
+
+def check_fen(fen: str) -> Optional[str]:
+    """
+    Return a description of what is wrong with a FEN, or None if it describes a position that can be played from
+
+    >>> check_fen('8/8/8/8/8/8/8/K6k w - - 0 1') is None
+    True
+    >>> check_fen('8/8/8/8/8/8/8/K5Qk w - - 0 1')
+    'side not to move is in check'
+    """
+    fields = fen.split()
+    if len(fields) != 6:
+        return 'expected 6 fields'
+    ranks = fields[0].split('/')
+    if len(ranks) != 8 or any(sum(int(c) if c.isdigit() else 1 for c in rank) != 8 for rank in ranks):
+        return 'expected 8 ranks of 8 squares'
+    if any(not c.isdigit() and c not in PIECE_CHARS for c in fields[0].replace('/', '')):
+        return 'unexpected piece character'
+    try:
+        position = Position(fen)
+    except (KeyError, ValueError) as e:
+        return str(e)
+    if bin(position._bitboards['K']).count('1') != 1 or bin(position._bitboards['k']).count('1') != 1:
+        return 'expected one king of each color'
+    white = position._active_color == Color.WHITE
+    enemy_king_sq = position._bitboards['k' if white else 'K'].bit_length() - 1
+    if position._attackers(enemy_king_sq, white, position._white | position._black):
+        return 'side not to move is in check'
+    return None
+
+
+class WorkerStats(NamedTuple):
+    items: int
+    seconds: float
+
+    @property
+    def items_per_second(self) -> float:
+        return self.items / self.seconds if self.seconds else 0.0
+
+
+_PGN_GAME_BOUNDARY = re.compile(rb'\n[ \t\r]*\n(?=\[)')
+
+
+def corpus_chunks(path, kind: str, chunk_bytes: int = 1 << 20) -> List[Tuple[int, int]]:
+    """
+    Split a PGN or FEN file into (start, end) byte ranges of roughly `chunk_bytes`, cut at game or line boundaries
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+    offsets = [0]
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        position = chunk_bytes
+        while position < size:
+            if kind == 'fen':
+                newline = buffer.find(b'\n', position)
+                boundary = -1 if newline == -1 else newline + 1
+            else:
+                match = _PGN_GAME_BOUNDARY.search(buffer, position)
+                boundary = -1 if match is None else match.end()
+            if boundary == -1 or boundary >= size:
+                break
+            offsets.append(boundary)
+            position = boundary + chunk_bytes
+    offsets.append(size)
+    return list(zip(offsets, offsets[1:]))
+
+
+def _process_chunk(path, start, end, kind, func):
+    """Worker side of process_corpus: apply func to every game or FEN line in a byte range of the file"""
+    started = time.perf_counter()
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        chunk = buffer[start:end]
+    if kind == 'fen':
+        items = (line.strip() for line in chunk.decode('utf-8', errors='replace').splitlines())
+        results = [func(line) for line in items if line]
     else:
-        raise ValueError('Unable to parse this one')
+        results = [func(game) for game in read_games(chunk)]
+    return results, os.getpid(), time.perf_counter() - started
 
-    # captures
-    if 'x' in move_str:
-        if move_str.count('x') != 1:
-            raise ValueError('Unable to parse this one')
-        d['capture'] = True
-        move_str = move_str.replace('x', '')
-
-    # find last 12345678 from string; that should be the target rank
-    target_rank_index = None
-    for i, c in reversed(tuple(enumerate(move_str))):
-        if c in '12345678':
-            target_rank_index = i
-            break
-    if target_rank_index is None:
-        raise ValueError('Unable to parse this one')
-    d['target'] = move_str[target_rank_index-1:target_rank_index+1]
 
-    before_target, after_target = move_str[:target_rank_index-1], move_str[target_rank_index+1:]
+class CorpusProcessor:
+    """
+    Replays or validates a PGN or FEN corpus in a pool of worker processes.
+
+    The file is cut into chunks at game or line boundaries; workers memory-map the file and read their own chunks,
+    so only byte offsets and results cross process boundaries. Results come back in file order. A bounded number of
+    chunks is in flight at a time, so memory does not grow with the size of the corpus.
 
-    # disambiguating origin before target
-    if before_target == '':
-        pass
-    elif len(before_target) == 1:
-        if before_target in 'abcdefgh':
-            d['orig_file'] = before_target
-        elif before_target in '12345678':
-            d['orig_rank'] = before_target
+    `func` is applied to every PGNGame (for PGN) or FEN line (for FEN) and has to be picklable, i.e. a module-level
+    function; by default games and FENs are checked with check_game() and check_fen().
+    """
+
+    def __init__(self, workers: Optional[int] = None, chunk_bytes: int = 1 << 20):
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_bytes = chunk_bytes
+        self.worker_stats = {}  # type: Dict[int, WorkerStats]
+        self.seconds = 0.0
+
+    def map(self, path, func=None, kind: Optional[str] = None) -> Iterator:
+        """Yield func's result for every game or FEN line of the file, in order"""
+        kind = kind or ('fen' if str(path).lower().endswith(('.fen', '.epd', '.txt')) else 'pgn')
+        if func is None:
+            func = check_fen if kind == 'fen' else check_game
+        self.worker_stats = {}
+        started = time.perf_counter()
+        chunks = corpus_chunks(path, kind, self.chunk_bytes)
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            pending = deque()
+            chunk_iter = iter(chunks)
+            for start, end in islice(chunk_iter, 2 * self.workers):
+                pending.append(executor.submit(_process_chunk, path, start, end, kind, func))
+            while pending:
+                results, pid, seconds = pending.popleft().result()
+                for start, end in islice(chunk_iter, 1):
+                    pending.append(executor.submit(_process_chunk, path, start, end, kind, func))
+                stats = self.worker_stats.get(pid, WorkerStats(0, 0.0))
+                self.worker_stats[pid] = WorkerStats(stats.items + len(results), stats.seconds + seconds)
+                yield from results
+        self.seconds = time.perf_counter() - started
+
+    def report(self) -> str:
+        """Throughput of every worker and of the whole run"""
+        lines = ['worker {}: {} items in {:.2f} s, {:.1f} items/s'.format(pid, s.items, s.seconds, s.items_per_second)
+                 for pid, s in sorted(self.worker_stats.items())]
+        total = sum(s.items for s in self.worker_stats.values())
+        lines.append('total: {} items in {:.2f} s, {:.1f} items/s'.format(
+            total, self.seconds, total / self.seconds if self.seconds else 0.0))
+        return '\n'.join(lines)
+
+
+def perft(position: Position, depth: int) -> int:
+    """
+    Number of leaf nodes of the legal move tree of the given depth, for verifying and timing move generation
+
+    >>> perft(Position(), 2)
+    400
+    """
+    if depth == 0:
+        return 1
+    codes = position._legal_move_codes()
+    if depth == 1:
+        return len(codes)
+    nodes = 0
+    moves_by_code = MOVES_BY_CODE
+    for code in codes:
+        position.push(moves_by_code[code])
+        nodes += perft(position, depth - 1)
+        position.pop()
+    return nodes
+
+
+def perft_divide(position: Position, depth: int) -> Dict[str, int]:
+    """
+    Perft node counts split by the first move, keyed by the move in UCI notation
+
+    >>> perft_divide(Position('4k3/8/8/8/8/8/8/4K2R w K - 0 1'), 1)['e1g1']
+    1
+    """
+    counts = {}
+    for move in position.legal_moves():
+        position.push(move)
+        counts[move.uci()] = perft(position, depth - 1)
+        position.pop()
+    return counts
+
+
+class Bound(Enum):
+    """How a stored score relates to the true score of the position"""
+    EXACT = 1
+    LOWER = 2  # the search failed high, the true score is at least this
+    UPPER = 3  # the search failed low, the true score is at most this
+
+
+class Replacement(Enum):
+    """Which entry a transposition table store overwrites"""
+    ALWAYS = 'always'  # always replace the entry in the slot
+    DEPTH_PREFERRED = 'depth-preferred'  # keep deeper entries from the current search
+    TWO_TIER = 'two-tier'  # buckets of a depth-preferred slot and an always-replace slot
+
+
+class TTEntry(NamedTuple):
+    depth: int
+    bound: Bound
+    score: int
+    move: Optional[Move]
+
+
+class TranspositionTable:
+    """
+    Fixed-size hash table of search results, keyed by Zobrist key.
+
+    Entries live in two arrays of unsigned 64-bit integers, one with the packed data and one with the full keys
+    xor-ed with their data words, so the memory used is 16 bytes per entry, however many are stored. The data word
+    holds the encoded best move in bits 0-15, the depth in bits 16-23, the bound in bits 24-25, the search
+    generation in bits 26-31 and the score, offset to be unsigned, in bits 32-63. A data word of 0 is an empty slot.
+
+    With `shared`, the arrays live in shared memory and the table is shared with the child processes started after
+    it, as ParallelSearcher does. Processes write entries without locking; the xor-ed key makes an entry whose two
+    words come from different writes look like a miss.
+
+    >>> tt = TranspositionTable(size_mb=1)
+    >>> tt.store(Position().zobrist_key(), 3, Bound.EXACT, 25, Move.from_uci('e2e4'))
+    >>> tt.probe(Position().zobrist_key())
+    TTEntry(depth=3, bound=<Bound.EXACT: 1>, score=25, move=Move(origin=52, target=36, promotion=None))
+    """
+    ENTRY_BYTES = 16
+
+    def __init__(self, size_mb: float = 16, replacement: Replacement = Replacement.DEPTH_PREFERRED,
+                 shared: bool = False):
+        self.replacement = Replacement(replacement)
+        self.size = max(2, int(size_mb * 2 ** 20) // self.ENTRY_BYTES)
+        if self.replacement == Replacement.TWO_TIER:
+            self.size -= self.size % 2
+        self._shared = (RawArray('Q', self.size), RawArray('Q', self.size)) if shared else None
+        self.clear()
+
+    def __len__(self):
+        return self.size
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self._shared is not None:
+            del state['_keys'], state['_data']  # views of the shared arrays, made again on the other side
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._shared is not None:
+            self._keys, self._data = (memoryview(raw).cast('B').cast('Q') for raw in self._shared)
+
+    def clear(self):
+        """Empty the table and reset the counters"""
+        if self._shared is not None:
+            self._keys, self._data = (memoryview(raw).cast('B').cast('Q') for raw in self._shared)
+            for words in self._keys, self._data:
+                words.cast('B')[:] = bytes(8 * self.size)
         else:
-            raise ValueError('Unable to parse this one')
-    elif len(before_target) == 2:
-        d['orig_file'], d['orig_rank'] = before_target
-    else:
-        raise ValueError('Unable to parse this one')
+            self._keys = array('Q', bytes(8 * self.size))
+            self._data = array('Q', bytes(8 * self.size))
+        self._generation = 0
+        self.hits = self.misses = self.collisions = self.stores = self.overwrites = 0
 
-    # whatever happens after the target square
-    if after_target == '':
-        pass
-    elif after_target[0] in '+#=':
-        # promotion
-        if after_target[0] == '=':
-            if after_target[1] in 'KQRBN':
-                d['promote'] = after_target[1]
-            else:
-                raise ValueError('Unable to parse this one')
-            remains = after_target[2:]
+    def new_search(self):
+        """Start a new search generation; entries from earlier ones are the first to be replaced"""
+        self._generation = (self._generation + 1) & 63
+
+    def _slots(self, key):
+        if self.replacement == Replacement.TWO_TIER:
+            first = (key % (self.size // 2)) * 2
+            return first, first + 1
+        return key % self.size,
+
+    def probe(self, key: int) -> Optional[TTEntry]:
+        """Stored entry for the key, or None"""
+        keys, data = self._keys, self._data
+        collided = False
+        for slot in self._slots(key):
+            word = data[slot]
+            if not word:
+                continue
+            if keys[slot] ^ word == key:
+                self.hits += 1
+                return TTEntry(word >> 16 & 255, Bound(word >> 24 & 3), (word >> 32) - 2 ** 31,
+                               decode_move(word & 0xffff))
+            collided = True
+        self.misses += 1
+        if collided:
+            self.collisions += 1
+        return None
+
+    def store(self, key: int, depth: int, bound: Bound, score: int, move: Optional[Move] = None):
+        """Store a search result, if the replacement scheme lets it overwrite what is in its slot"""
+        keys, data = self._keys, self._data
+        slots = self._slots(key)
+        slot = slots[0]
+        word = data[slot]
+        if self.replacement == Replacement.DEPTH_PREFERRED or self.replacement == Replacement.TWO_TIER:
+            if (word and keys[slot] ^ word != key and (word >> 26 & 63) == self._generation and
+                    depth < (word >> 16 & 255)):
+                if self.replacement == Replacement.DEPTH_PREFERRED:
+                    return
+                slot = slots[1]
+                word = data[slot]
+        same_key = keys[slot] ^ word == key
+        if word and same_key and move is None:
+            move_code = word & 0xffff  # keep the best move found by an earlier search
         else:
-            remains = after_target
-        # check/mate
-        if remains == '+':
-            d['check'] = True
-        elif remains == '#':
-            d['checkmate'] = True
-        elif remains == '':
-            pass
+            move_code = encode_move(move)
+        if word and not same_key:
+            self.overwrites += 1
+        self.stores += 1
+        word = (move_code | min(depth, 255) << 16 | bound.value << 24 | self._generation << 26 |
+                (score + 2 ** 31) << 32)
+        keys[slot] = key ^ word
+        data[slot] = word
+
+    def hashfull(self) -> int:
+        """Permille of the first thousand slots that hold entries from the current search, as reported in UCI"""
+        sample = min(1000, self.size)
+        generation = self._generation
+        used = sum(1 for word in self._data[:sample] if word and (word >> 26 & 63) == generation)
+        return used * 1000 // sample
+
+    def stats(self) -> Dict[str, int]:
+        """Counters for sizing the table: probes that hit, missed and missed on an occupied slot, and stores"""
+        return {'size': self.size, 'hits': self.hits, 'misses': self.misses, 'collisions': self.collisions,
+                'stores': self.stores, 'overwrites': self.overwrites, 'hashfull': self.hashfull()}
+
+
+class PositionRecord(NamedTuple):
+    """What a position database holds for one position"""
+    games: int
+    white_wins: int
+    draws: int
+    black_wins: int
+    best_move: Optional[Move]
+    score: Optional[int]
+
+
+class PositionDB:
+    """
+    Write-once, memory-mapped store of per-position records, keyed by the Zobrist key.
+
+    The file is a header followed by an open-addressing hash table of fixed-size records, at most half full, so a
+    lookup reads a slot or two straight from the mapping and never loads the file into memory. Write it with
+    PositionDB.write() or PositionDB.build().
+
+    >>> import tempfile
+    >>> pgn = b'[Result "1-0"]\\n\\n1. e4 e5 2. Nf3 1-0\\n\\n[Result "0-1"]\\n\\n1. e4 c5 0-1\\n'
+    >>> with tempfile.TemporaryDirectory() as directory:
+    ...     with PositionDB.build(os.path.join(directory, 'positions.db'), read_games(pgn)) as db:
+    ...         record = db[Position()]
+    >>> record.games, record.white_wins, record.draws, record.black_wins, record.best_move.uci()
+    (2, 1, 0, 1, 'e2e4')
+    """
+    MAGIC = b'DEEPESDB'
+    VERSION = 1
+    HEADER = struct.Struct('<8sIIQ8x')
+    # key, games, white wins, draws, black wins, encoded best move, score (NO_SCORE for none), padding
+    RECORD = struct.Struct('<QIIIIHh4x')
+    NO_SCORE = -2 ** 15
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        try:
+            self._buffer = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file
+            self._file.close()
+            raise ValueError('{} is not a position database'.format(path))
+        magic, version, slot_bits, self._count = self.HEADER.unpack_from(self._buffer)
+        if magic != self.MAGIC or version != self.VERSION:
+            self.close()
+            raise ValueError('{} is not a position database'.format(path))
+        self._mask = (1 << slot_bits) - 1
+
+    def close(self):
+        self._buffer.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, position):
+        return self.get(position) is not None
+
+    def __getitem__(self, position) -> PositionRecord:
+        record = self.get(position)
+        if record is None:
+            raise KeyError(position)
+        return record
+
+    def get(self, position) -> Optional[PositionRecord]:
+        """Record for a Position, or for a Zobrist key, or None"""
+        key = position if isinstance(position, int) else position.zobrist_key()
+        buffer = self._buffer
+        unpack_from = self.RECORD.unpack_from
+        header_size = self.HEADER.size
+        record_size = self.RECORD.size
+        mask = self._mask
+        slot = key & mask
+        while True:
+            stored_key, games, white_wins, draws, black_wins, move_code, score = unpack_from(
+                buffer, header_size + slot * record_size)
+            if not games:
+                return None
+            if stored_key == key:
+                return PositionRecord(games, white_wins, draws, black_wins, decode_move(move_code),
+                                      None if score == self.NO_SCORE else score)
+            slot = (slot + 1) & mask
+
+    @classmethod
+    def write(cls, path, records: Dict[int, PositionRecord]):
+        """Write records keyed by Zobrist key to a new database file. Every record must have at least one game."""
+        slot_bits = max(1, (2 * len(records) - 1).bit_length())
+        mask = (1 << slot_bits) - 1
+        record_size = cls.RECORD.size
+        table = bytearray(record_size << slot_bits)
+        occupied = bytearray(1 << slot_bits)
+        for key, record in records.items():
+            if record.games < 1:
+                raise ValueError('Record for key {:#x} has no games'.format(key))
+            slot = key & mask
+            while occupied[slot]:
+                slot = (slot + 1) & mask
+            occupied[slot] = 1
+            cls.RECORD.pack_into(table, slot * record_size, key, record.games, record.white_wins, record.draws,
+                                 record.black_wins, encode_move(record.best_move),
+                                 cls.NO_SCORE if record.score is None else record.score)
+        with open(path, 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, slot_bits, len(records)))
+            f.write(table)
+
+    @classmethod
+    def build(cls, path, games: Iterable[PGNGame], max_plies: Optional[int] = None,
+              score: Optional[Callable[[Position], int]] = None) -> 'PositionDB':
+        """
+        Replay games and write a database of every position reached in their main lines, up to `max_plies` into each
+        game, counting games and results and taking the most played move as the best move. If given, `score` is
+        called once for each new position, e.g. with evaluate. Returns the database opened for reading.
+        """
+        stats = {}
+        for game in games:
+            outcome = _RESULT_COLUMNS.get(game.result)
+            position = game.starting_position()
+            seen = set()
+            for ply, san in enumerate(parse_moves(game.moves())):
+                if max_plies is not None and ply >= max_plies:
+                    break
+                move = position._move_from_parsed(san)
+                moves = _count_position(stats, seen, position, outcome, score)[4]
+                moves[move] = moves.get(move, 0) + 1
+                position.push(move)
+            else:
+                _count_position(stats, seen, position, outcome, score)
+        records = {key: PositionRecord(games, white_wins, draws, black_wins,
+                                       max(moves, key=moves.get) if moves else None, position_score)
+                   for key, (games, white_wins, draws, black_wins, moves, position_score) in stats.items()}
+        cls.write(path, records)
+        return cls(path)
+
+
+# index of the win/draw/loss counter in the position statistics for each game result
+_RESULT_COLUMNS = {'1-0': 1, '1/2-1/2': 2, '0-1': 3}
+
+
+def _count_position(stats, seen, position, outcome, score):
+    """Count a game reaching the position, once per game even if the position repeats, and return its statistics"""
+    key = position.zobrist_key()
+    entry = stats.get(key)
+    if entry is None:
+        entry = stats[key] = [0, 0, 0, 0, {}, None if score is None else score(position)]
+    if key not in seen:
+        seen.add(key)
+        entry[0] += 1
+        if outcome is not None:
+            entry[outcome] += 1
+    return entry
+
+
+# The 781 random numbers of the Polyglot opening book format: 768 for the pieces, 4 for castling rights, 8 for en
+# passant files and 1 for white to move. Books keyed with them can be shared with other engines.
+POLYGLOT_RANDOM_64 = (
+    0x9D39247E33776D41, 0x2AF7398005AAA5C7, 0x44DB015024623547, 0x9C15F73E62A76AE2,
+    0x75834465489C0C89, 0x3290AC3A203001BF, 0x0FBBAD1F61042279, 0xE83A908FF2FB60CA,
+    0x0D7E765D58755C10, 0x1A083822CEAFE02D, 0x9605D5F0E25EC3B0, 0xD021FF5CD13A2ED5,
+    0x40BDF15D4A672E32, 0x011355146FD56395, 0x5DB4832046F3D9E5, 0x239F8B2D7FF719CC,
+    0x05D1A1AE85B49AA1, 0x679F848F6E8FC971, 0x7449BBFF801FED0B, 0x7D11CDB1C3B7ADF0,
+    0x82C7709E781EB7CC, 0xF3218F1C9510786C, 0x331478F3AF51BBE6, 0x4BB38DE5E7219443,
+    0xAA649C6EBCFD50FC, 0x8DBD98A352AFD40B, 0x87D2074B81D79217, 0x19F3C751D3E92AE1,
+    0xB4AB30F062B19ABF, 0x7B0500AC42047AC4, 0xC9452CA81A09D85D, 0x24AA6C514DA27500,
+    0x4C9F34427501B447, 0x14A68FD73C910841, 0xA71B9B83461CBD93, 0x03488B95B0F1850F,
+    0x637B2B34FF93C040, 0x09D1BC9A3DD90A94, 0x3575668334A1DD3B, 0x735E2B97A4C45A23,
+    0x18727070F1BD400B, 0x1FCBACD259BF02E7, 0xD310A7C2CE9B6555, 0xBF983FE0FE5D8244,
+    0x9F74D14F7454A824, 0x51EBDC4AB9BA3035, 0x5C82C505DB9AB0FA, 0xFCF7FE8A3430B241,
+    0x3253A729B9BA3DDE, 0x8C74C368081B3075, 0xB9BC6C87167C33E7, 0x7EF48F2B83024E20,
+    0x11D505D4C351BD7F, 0x6568FCA92C76A243, 0x4DE0B0F40F32A7B8, 0x96D693460CC37E5D,
+    0x42E240CB63689F2F, 0x6D2BDCDAE2919661, 0x42880B0236E4D951, 0x5F0F4A5898171BB6,
+    0x39F890F579F92F88, 0x93C5B5F47356388B, 0x63DC359D8D231B78, 0xEC16CA8AEA98AD76,
+    0x5355F900C2A82DC7, 0x07FB9F855A997142, 0x5093417AA8A7ED5E, 0x7BCBC38DA25A7F3C,
+    0x19FC8A768CF4B6D4, 0x637A7780DECFC0D9, 0x8249A47AEE0E41F7, 0x79AD695501E7D1E8,
+    0x14ACBAF4777D5776, 0xF145B6BECCDEA195, 0xDABF2AC8201752FC, 0x24C3C94DF9C8D3F6,
+    0xBB6E2924F03912EA, 0x0CE26C0B95C980D9, 0xA49CD132BFBF7CC4, 0xE99D662AF4243939,
+    0x27E6AD7891165C3F, 0x8535F040B9744FF1, 0x54B3F4FA5F40D873, 0x72B12C32127FED2B,
+    0xEE954D3C7B411F47, 0x9A85AC909A24EAA1, 0x70AC4CD9F04F21F5, 0xF9B89D3E99A075C2,
+    0x87B3E2B2B5C907B1, 0xA366E5B8C54F48B8, 0xAE4A9346CC3F7CF2, 0x1920C04D47267BBD,
+    0x87BF02C6B49E2AE9, 0x092237AC237F3859, 0xFF07F64EF8ED14D0, 0x8DE8DCA9F03CC54E,
+    0x9C1633264DB49C89, 0xB3F22C3D0B0B38ED, 0x390E5FB44D01144B, 0x5BFEA5B4712768E9,
+    0x1E1032911FA78984, 0x9A74ACB964E78CB3, 0x4F80F7A035DAFB04, 0x6304D09A0B3738C4,
+    0x2171E64683023A08, 0x5B9B63EB9CEFF80C, 0x506AACF489889342, 0x1881AFC9A3A701D6,
+    0x6503080440750644, 0xDFD395339CDBF4A7, 0xEF927DBCF00C20F2, 0x7B32F7D1E03680EC,
+    0xB9FD7620E7316243, 0x05A7E8A57DB91B77, 0xB5889C6E15630A75, 0x4A750A09CE9573F7,
+    0xCF464CEC899A2F8A, 0xF538639CE705B824, 0x3C79A0FF5580EF7F, 0xEDE6C87F8477609D,
+    0x799E81F05BC93F31, 0x86536B8CF3428A8C, 0x97D7374C60087B73, 0xA246637CFF328532,
+    0x043FCAE60CC0EBA0, 0x920E449535DD359E, 0x70EB093B15B290CC, 0x73A1921916591CBD,
+    0x56436C9FE1A1AA8D, 0xEFAC4B70633B8F81, 0xBB215798D45DF7AF, 0x45F20042F24F1768,
+    0x930F80F4E8EB7462, 0xFF6712FFCFD75EA1, 0xAE623FD67468AA70, 0xDD2C5BC84BC8D8FC,
+    0x7EED120D54CF2DD9, 0x22FE545401165F1C, 0xC91800E98FB99929, 0x808BD68E6AC10365,
+    0xDEC468145B7605F6, 0x1BEDE3A3AEF53302, 0x43539603D6C55602, 0xAA969B5C691CCB7A,
+    0xA87832D392EFEE56, 0x65942C7B3C7E11AE, 0xDED2D633CAD004F6, 0x21F08570F420E565,
+    0xB415938D7DA94E3C, 0x91B859E59ECB6350, 0x10CFF333E0ED804A, 0x28AED140BE0BB7DD,
+    0xC5CC1D89724FA456, 0x5648F680F11A2741, 0x2D255069F0B7DAB3, 0x9BC5A38EF729ABD4,
+    0xEF2F054308F6A2BC, 0xAF2042F5CC5C2858, 0x480412BAB7F5BE2A, 0xAEF3AF4A563DFE43,
+    0x19AFE59AE451497F, 0x52593803DFF1E840, 0xF4F076E65F2CE6F0, 0x11379625747D5AF3,
+    0xBCE5D2248682C115, 0x9DA4243DE836994F, 0x066F70B33FE09017, 0x4DC4DE189B671A1C,
+    0x51039AB7712457C3, 0xC07A3F80C31FB4B4, 0xB46EE9C5E64A6E7C, 0xB3819A42ABE61C87,
+    0x21A007933A522A20, 0x2DF16F761598AA4F, 0x763C4A1371B368FD, 0xF793C46702E086A0,
+    0xD7288E012AEB8D31, 0xDE336A2A4BC1C44B, 0x0BF692B38D079F23, 0x2C604A7A177326B3,
+    0x4850E73E03EB6064, 0xCFC447F1E53C8E1B, 0xB05CA3F564268D99, 0x9AE182C8BC9474E8,
+    0xA4FC4BD4FC5558CA, 0xE755178D58FC4E76, 0x69B97DB1A4C03DFE, 0xF9B5B7C4ACC67C96,
+    0xFC6A82D64B8655FB, 0x9C684CB6C4D24417, 0x8EC97D2917456ED0, 0x6703DF9D2924E97E,
+    0xC547F57E42A7444E, 0x78E37644E7CAD29E, 0xFE9A44E9362F05FA, 0x08BD35CC38336615,
+    0x9315E5EB3A129ACE, 0x94061B871E04DF75, 0xDF1D9F9D784BA010, 0x3BBA57B68871B59D,
+    0xD2B7ADEEDED1F73F, 0xF7A255D83BC373F8, 0xD7F4F2448C0CEB81, 0xD95BE88CD210FFA7,
+    0x336F52F8FF4728E7, 0xA74049DAC312AC71, 0xA2F61BB6E437FDB5, 0x4F2A5CB07F6A35B3,
+    0x87D380BDA5BF7859, 0x16B9F7E06C453A21, 0x7BA2484C8A0FD54E, 0xF3A678CAD9A2E38C,
+    0x39B0BF7DDE437BA2, 0xFCAF55C1BF8A4424, 0x18FCF680573FA594, 0x4C0563B89F495AC3,
+    0x40E087931A00930D, 0x8CFFA9412EB642C1, 0x68CA39053261169F, 0x7A1EE967D27579E2,
+    0x9D1D60E5076F5B6F, 0x3810E399B6F65BA2, 0x32095B6D4AB5F9B1, 0x35CAB62109DD038A,
+    0xA90B24499FCFAFB1, 0x77A225A07CC2C6BD, 0x513E5E634C70E331, 0x4361C0CA3F692F12,
+    0xD941ACA44B20A45B, 0x528F7C8602C5807B, 0x52AB92BEB9613989, 0x9D1DFA2EFC557F73,
+    0x722FF175F572C348, 0x1D1260A51107FE97, 0x7A249A57EC0C9BA2, 0x04208FE9E8F7F2D6,
+    0x5A110C6058B920A0, 0x0CD9A497658A5698, 0x56FD23C8F9715A4C, 0x284C847B9D887AAE,
+    0x04FEABFBBDB619CB, 0x742E1E651C60BA83, 0x9A9632E65904AD3C, 0x881B82A13B51B9E2,
+    0x506E6744CD974924, 0xB0183DB56FFC6A79, 0x0ED9B915C66ED37E, 0x5E11E86D5873D484,
+    0xF678647E3519AC6E, 0x1B85D488D0F20CC5, 0xDAB9FE6525D89021, 0x0D151D86ADB73615,
+    0xA865A54EDCC0F019, 0x93C42566AEF98FFB, 0x99E7AFEABE000731, 0x48CBFF086DDF285A,
+    0x7F9B6AF1EBF78BAF, 0x58627E1A149BBA21, 0x2CD16E2ABD791E33, 0xD363EFF5F0977996,
+    0x0CE2A38C344A6EED, 0x1A804AADB9CFA741, 0x907F30421D78C5DE, 0x501F65EDB3034D07,
+    0x37624AE5A48FA6E9, 0x957BAF61700CFF4E, 0x3A6C27934E31188A, 0xD49503536ABCA345,
+    0x088E049589C432E0, 0xF943AEE7FEBF21B8, 0x6C3B8E3E336139D3, 0x364F6FFA464EE52E,
+    0xD60F6DCEDC314222, 0x56963B0DCA418FC0, 0x16F50EDF91E513AF, 0xEF1955914B609F93,
+    0x565601C0364E3228, 0xECB53939887E8175, 0xBAC7A9A18531294B, 0xB344C470397BBA52,
+    0x65D34954DAF3CEBD, 0xB4B81B3FA97511E2, 0xB422061193D6F6A7, 0x071582401C38434D,
+    0x7A13F18BBEDC4FF5, 0xBC4097B116C524D2, 0x59B97885E2F2EA28, 0x99170A5DC3115544,
+    0x6F423357E7C6A9F9, 0x325928EE6E6F8794, 0xD0E4366228B03343, 0x565C31F7DE89EA27,
+    0x30F5611484119414, 0xD873DB391292ED4F, 0x7BD94E1D8E17DEBC, 0xC7D9F16864A76E94,
+    0x947AE053EE56E63C, 0xC8C93882F9475F5F, 0x3A9BF55BA91F81CA, 0xD9A11FBB3D9808E4,
+    0x0FD22063EDC29FCA, 0xB3F256D8ACA0B0B9, 0xB03031A8B4516E84, 0x35DD37D5871448AF,
+    0xE9F6082B05542E4E, 0xEBFAFA33D7254B59, 0x9255ABB50D532280, 0xB9AB4CE57F2D34F3,
+    0x693501D628297551, 0xC62C58F97DD949BF, 0xCD454F8F19C5126A, 0xBBE83F4ECC2BDECB,
+    0xDC842B7E2819E230, 0xBA89142E007503B8, 0xA3BC941D0A5061CB, 0xE9F6760E32CD8021,
+    0x09C7E552BC76492F, 0x852F54934DA55CC9, 0x8107FCCF064FCF56, 0x098954D51FFF6580,
+    0x23B70EDB1955C4BF, 0xC330DE426430F69D, 0x4715ED43E8A45C0A, 0xA8D7E4DAB780A08D,
+    0x0572B974F03CE0BB, 0xB57D2E985E1419C7, 0xE8D9ECBE2CF3D73F, 0x2FE4B17170E59750,
+    0x11317BA87905E790, 0x7FBF21EC8A1F45EC, 0x1725CABFCB045B00, 0x964E915CD5E2B207,
+    0x3E2B8BCBF016D66D, 0xBE7444E39328A0AC, 0xF85B2B4FBCDE44B7, 0x49353FEA39BA63B1,
+    0x1DD01AAFCD53486A, 0x1FCA8A92FD719F85, 0xFC7C95D827357AFA, 0x18A6A990C8B35EBD,
+    0xCCCB7005C6B9C28D, 0x3BDBB92C43B17F26, 0xAA70B5B4F89695A2, 0xE94C39A54A98307F,
+    0xB7A0B174CFF6F36E, 0xD4DBA84729AF48AD, 0x2E18BC1AD9704A68, 0x2DE0966DAF2F8B1C,
+    0xB9C11D5B1E43A07E, 0x64972D68DEE33360, 0x94628D38D0C20584, 0xDBC0D2B6AB90A559,
+    0xD2733C4335C6A72F, 0x7E75D99D94A70F4D, 0x6CED1983376FA72B, 0x97FCAACBF030BC24,
+    0x7B77497B32503B12, 0x8547EDDFB81CCB94, 0x79999CDFF70902CB, 0xCFFE1939438E9B24,
+    0x829626E3892D95D7, 0x92FAE24291F2B3F1, 0x63E22C147B9C3403, 0xC678B6D860284A1C,
+    0x5873888850659AE7, 0x0981DCD296A8736D, 0x9F65789A6509A440, 0x9FF38FED72E9052F,
+    0xE479EE5B9930578C, 0xE7F28ECD2D49EECD, 0x56C074A581EA17FE, 0x5544F7D774B14AEF,
+    0x7B3F0195FC6F290F, 0x12153635B2C0CF57, 0x7F5126DBBA5E0CA7, 0x7A76956C3EAFB413,
+    0x3D5774A11D31AB39, 0x8A1B083821F40CB4, 0x7B4A38E32537DF62, 0x950113646D1D6E03,
+    0x4DA8979A0041E8A9, 0x3BC36E078F7515D7, 0x5D0A12F27AD310D1, 0x7F9D1A2E1EBE1327,
+    0xDA3A361B1C5157B1, 0xDCDD7D20903D0C25, 0x36833336D068F707, 0xCE68341F79893389,
+    0xAB9090168DD05F34, 0x43954B3252DC25E5, 0xB438C2B67F98E5E9, 0x10DCD78E3851A492,
+    0xDBC27AB5447822BF, 0x9B3CDB65F82CA382, 0xB67B7896167B4C84, 0xBFCED1B0048EAC50,
+    0xA9119B60369FFEBD, 0x1FFF7AC80904BF45, 0xAC12FB171817EEE7, 0xAF08DA9177DDA93D,
+    0x1B0CAB936E65C744, 0xB559EB1D04E5E932, 0xC37B45B3F8D6F2BA, 0xC3A9DC228CAAC9E9,
+    0xF3B8B6675A6507FF, 0x9FC477DE4ED681DA, 0x67378D8ECCEF96CB, 0x6DD856D94D259236,
+    0xA319CE15B0B4DB31, 0x073973751F12DD5E, 0x8A8E849EB32781A5, 0xE1925C71285279F5,
+    0x74C04BF1790C0EFE, 0x4DDA48153C94938A, 0x9D266D6A1CC0542C, 0x7440FB816508C4FE,
+    0x13328503DF48229F, 0xD6BF7BAEE43CAC40, 0x4838D65F6EF6748F, 0x1E152328F3318DEA,
+    0x8F8419A348F296BF, 0x72C8834A5957B511, 0xD7A023A73260B45C, 0x94EBC8ABCFB56DAE,
+    0x9FC10D0F989993E0, 0xDE68A2355B93CAE6, 0xA44CFE79AE538BBE, 0x9D1D84FCCE371425,
+    0x51D2B1AB2DDFB636, 0x2FD7E4B9E72CD38C, 0x65CA5B96B7552210, 0xDD69A0D8AB3B546D,
+    0x604D51B25FBF70E2, 0x73AA8A564FB7AC9E, 0x1A8C1E992B941148, 0xAAC40A2703D9BEA0,
+    0x764DBEAE7FA4F3A6, 0x1E99B96E70A9BE8B, 0x2C5E9DEB57EF4743, 0x3A938FEE32D29981,
+    0x26E6DB8FFDF5ADFE, 0x469356C504EC9F9D, 0xC8763C5B08D1908C, 0x3F6C6AF859D80055,
+    0x7F7CC39420A3A545, 0x9BFB227EBDF4C5CE, 0x89039D79D6FC5C5C, 0x8FE88B57305E2AB6,
+    0xA09E8C8C35AB96DE, 0xFA7E393983325753, 0xD6B6D0ECC617C699, 0xDFEA21EA9E7557E3,
+    0xB67C1FA481680AF8, 0xCA1E3785A9E724E5, 0x1CFC8BED0D681639, 0xD18D8549D140CAEA,
+    0x4ED0FE7E9DC91335, 0xE4DBF0634473F5D2, 0x1761F93A44D5AEFE, 0x53898E4C3910DA55,
+    0x734DE8181F6EC39A, 0x2680B122BAA28D97, 0x298AF231C85BAFAB, 0x7983EED3740847D5,
+    0x66C1A2A1A60CD889, 0x9E17E49642A3E4C1, 0xEDB454E7BADC0805, 0x50B704CAB602C329,
+    0x4CC317FB9CDDD023, 0x66B4835D9EAFEA22, 0x219B97E26FFC81BD, 0x261E4E4C0A333A9D,
+    0x1FE2CCA76517DB90, 0xD7504DFA8816EDBB, 0xB9571FA04DC089C8, 0x1DDC0325259B27DE,
+    0xCF3F4688801EB9AA, 0xF4F5D05C10CAB243, 0x38B6525C21A42B0E, 0x36F60E2BA4FA6800,
+    0xEB3593803173E0CE, 0x9C4CD6257C5A3603, 0xAF0C317D32ADAA8A, 0x258E5A80C7204C4B,
+    0x8B889D624D44885D, 0xF4D14597E660F855, 0xD4347F66EC8941C3, 0xE699ED85B0DFB40D,
+    0x2472F6207C2D0484, 0xC2A1E7B5B459AEB5, 0xAB4F6451CC1D45EC, 0x63767572AE3D6174,
+    0xA59E0BD101731A28, 0x116D0016CB948F09, 0x2CF9C8CA052F6E9F, 0x0B090A7560A968E3,
+    0xABEEDDB2DDE06FF1, 0x58EFC10B06A2068D, 0xC6E57A78FBD986E0, 0x2EAB8CA63CE802D7,
+    0x14A195640116F336, 0x7C0828DD624EC390, 0xD74BBE77E6116AC7, 0x804456AF10F5FB53,
+    0xEBE9EA2ADF4321C7, 0x03219A39EE587A30, 0x49787FEF17AF9924, 0xA1E9300CD8520548,
+    0x5B45E522E4B1B4EF, 0xB49C3B3995091A36, 0xD4490AD526F14431, 0x12A8F216AF9418C2,
+    0x001F837CC7350524, 0x1877B51E57A764D5, 0xA2853B80F17F58EE, 0x993E1DE72D36D310,
+    0xB3598080CE64A656, 0x252F59CF0D9F04BB, 0xD23C8E176D113600, 0x1BDA0492E7E4586E,
+    0x21E0BD5026C619BF, 0x3B097ADAF088F94E, 0x8D14DEDB30BE846E, 0xF95CFFA23AF5F6F4,
+    0x3871700761B3F743, 0xCA672B91E9E4FA16, 0x64C8E531BFF53B55, 0x241260ED4AD1E87D,
+    0x106C09B972D2E822, 0x7FBA195410E5CA30, 0x7884D9BC6CB569D8, 0x0647DFEDCD894A29,
+    0x63573FF03E224774, 0x4FC8E9560F91B123, 0x1DB956E450275779, 0xB8D91274B9E9D4FB,
+    0xA2EBEE47E2FBFCE1, 0xD9F1F30CCD97FB09, 0xEFED53D75FD64E6B, 0x2E6D02C36017F67F,
+    0xA9AA4D20DB084E9B, 0xB64BE8D8B25396C1, 0x70CB6AF7C2D5BCF0, 0x98F076A4F7A2322E,
+    0xBF84470805E69B5F, 0x94C3251F06F90CF3, 0x3E003E616A6591E9, 0xB925A6CD0421AFF3,
+    0x61BDD1307C66E300, 0xBF8D5108E27E0D48, 0x240AB57A8B888B20, 0xFC87614BAF287E07,
+    0xEF02CDD06FFDB432, 0xA1082C0466DF6C0A, 0x8215E577001332C8, 0xD39BB9C3A48DB6CF,
+    0x2738259634305C14, 0x61CF4F94C97DF93D, 0x1B6BACA2AE4E125B, 0x758F450C88572E0B,
+    0x959F587D507A8359, 0xB063E962E045F54D, 0x60E8ED72C0DFF5D1, 0x7B64978555326F9F,
+    0xFD080D236DA814BA, 0x8C90FD9B083F4558, 0x106F72FE81E2C590, 0x7976033A39F7D952,
+    0xA4EC0132764CA04B, 0x733EA705FAE4FA77, 0xB4D8F77BC3E56167, 0x9E21F4F903B33FD9,
+    0x9D765E419FB69F6D, 0xD30C088BA61EA5EF, 0x5D94337FBFAF7F5B, 0x1A4E4822EB4D7A59,
+    0x6FFE73E81B637FB3, 0xDDF957BC36D8B9CA, 0x64D0E29EEA8838B3, 0x08DD9BDFD96B9F63,
+    0x087E79E5A57D1D13, 0xE328E230E3E2B3FB, 0x1C2559E30F0946BE, 0x720BF5F26F4D2EAA,
+    0xB0774D261CC609DB, 0x443F64EC5A371195, 0x4112CF68649A260E, 0xD813F2FAB7F5C5CA,
+    0x660D3257380841EE, 0x59AC2C7873F910A3, 0xE846963877671A17, 0x93B633ABFA3469F8,
+    0xC0C0F5A60EF4CDCF, 0xCAF21ECD4377B28C, 0x57277707199B8175, 0x506C11B9D90E8B1D,
+    0xD83CC2687A19255F, 0x4A29C6465A314CD1, 0xED2DF21216235097, 0xB5635C95FF7296E2,
+    0x22AF003AB672E811, 0x52E762596BF68235, 0x9AEBA33AC6ECC6B0, 0x944F6DE09134DFB6,
+    0x6C47BEC883A7DE39, 0x6AD047C430A12104, 0xA5B1CFDBA0AB4067, 0x7C45D833AFF07862,
+    0x5092EF950A16DA0B, 0x9338E69C052B8E7B, 0x455A4B4CFE30E3F5, 0x6B02E63195AD0CF8,
+    0x6B17B224BAD6BF27, 0xD1E0CCD25BB9C169, 0xDE0C89A556B9AE70, 0x50065E535A213CF6,
+    0x9C1169FA2777B874, 0x78EDEFD694AF1EED, 0x6DC93D9526A50E68, 0xEE97F453F06791ED,
+    0x32AB0EDB696703D3, 0x3A6853C7E70757A7, 0x31865CED6120F37D, 0x67FEF95D92607890,
+    0x1F2B1D1F15F6DC9C, 0xB69E38A8965C6B65, 0xAA9119FF184CCCF4, 0xF43C732873F24C13,
+    0xFB4A3D794A9A80D2, 0x3550C2321FD6109C, 0x371F77E76BB8417E, 0x6BFA9AAE5EC05779,
+    0xCD04F3FF001A4778, 0xE3273522064480CA, 0x9F91508BFFCFC14A, 0x049A7F41061A9E60,
+    0xFCB6BE43A9F2FE9B, 0x08DE8A1C7797DA9B, 0x8F9887E6078735A1, 0xB5B4071DBFC73A66,
+    0x230E343DFBA08D33, 0x43ED7F5A0FAE657D, 0x3A88A0FBBCB05C63, 0x21874B8B4D2DBC4F,
+    0x1BDEA12E35F6A8C9, 0x53C065C6C8E63528, 0xE34A1D250E7A8D6B, 0xD6B04D3B7651DD7E,
+    0x5E90277E7CB39E2D, 0x2C046F22062DC67D, 0xB10BB459132D0A26, 0x3FA9DDFB67E2F199,
+    0x0E09B88E1914F7AF, 0x10E8B35AF3EEAB37, 0x9EEDECA8E272B933, 0xD4C718BC4AE8AE5F,
+    0x81536D601170FC20, 0x91B534F885818A06, 0xEC8177F83F900978, 0x190E714FADA5156E,
+    0xB592BF39B0364963, 0x89C350C893AE7DC1, 0xAC042E70F8B383F2, 0xB49B52E587A1EE60,
+    0xFB152FE3FF26DA89, 0x3E666E6F69AE2C15, 0x3B544EBE544C19F9, 0xE805A1E290CF2456,
+    0x24B33C9D7ED25117, 0xE74733427B72F0C1, 0x0A804D18B7097475, 0x57E3306D881EDB4F,
+    0x4AE7D6A36EB5DBCB, 0x2D8D5432157064C8, 0xD1E649DE1E7F268B, 0x8A328A1CEDFE552C,
+    0x07A3AEC79624C7DA, 0x84547DDC3E203C94, 0x990A98FD5071D263, 0x1A4FF12616EEFC89,
+    0xF6F7FD1431714200, 0x30C05B1BA332F41C, 0x8D2636B81555A786, 0x46C9FEB55D120902,
+    0xCCEC0A73B49C9921, 0x4E9D2827355FC492, 0x19EBB029435DCB0F, 0x4659D2B743848A2C,
+    0x963EF2C96B33BE31, 0x74F85198B05A2E7D, 0x5A0F544DD2B1FB18, 0x03727073C2E134B1,
+    0xC7F6AA2DE59AEA61, 0x352787BAA0D7C22F, 0x9853EAB63B5E0B35, 0xABBDCDD7ED5C0860,
+    0xCF05DAF5AC8D77B0, 0x49CAD48CEBF4A71E, 0x7A4C10EC2158C4A6, 0xD9E92AA246BF719E,
+    0x13AE978D09FE5557, 0x730499AF921549FF, 0x4E4B705B92903BA4, 0xFF577222C14F0A3A,
+    0x55B6344CF97AAFAE, 0xB862225B055B6960, 0xCAC09AFBDDD2CDB4, 0xDAF8E9829FE96B5F,
+    0xB5FDFC5D3132C498, 0x310CB380DB6F7503, 0xE87FBB46217A360E, 0x2102AE466EBB1148,
+    0xF8549E1A3AA5E00D, 0x07A69AFDCC42261A, 0xC4C118BFE78FEAAE, 0xF9F4892ED96BD438,
+    0x1AF3DBE25D8F45DA, 0xF5B4B0B0D2DEEEB4, 0x962ACEEFA82E1C84, 0x046E3ECAAF453CE9,
+    0xF05D129681949A4C, 0x964781CE734B3C84, 0x9C2ED44081CE5FBD, 0x522E23F3925E319E,
+    0x177E00F9FC32F791, 0x2BC60A63A6F3B3F2, 0x222BBFAE61725606, 0x486289DDCC3D6780,
+    0x7DC7785B8EFDFC80, 0x8AF38731C02BA980, 0x1FAB64EA29A2DDF7, 0xE4D9429322CD065A,
+    0x9DA058C67844F20C, 0x24C0E332B70019B0, 0x233003B5A6CFE6AD, 0xD586BD01C5C217F6,
+    0x5E5637885F29BC2B, 0x7EBA726D8C94094B, 0x0A56A5F0BFE39272, 0xD79476A84EE20D06,
+    0x9E4C1269BAA4BF37, 0x17EFEE45B0DEE640, 0x1D95B0A5FCF90BC6, 0x93CBE0B699C2585D,
+    0x65FA4F227A2B6D79, 0xD5F9E858292504D5, 0xC2B5A03F71471A6F, 0x59300222B4561E00,
+    0xCE2F8642CA0712DC, 0x7CA9723FBB2E8988, 0x2785338347F2BA08, 0xC61BB3A141E50E8C,
+    0x150F361DAB9DEC26, 0x9F6A419D382595F4, 0x64A53DC924FE7AC9, 0x142DE49FFF7A7C3D,
+    0x0C335248857FA9E7, 0x0A9C32D5EAE45305, 0xE6C42178C4BBB92E, 0x71F1CE2490D20B07,
+    0xF1BCC3D275AFE51A, 0xE728E8C83C334074, 0x96FBF83A12884624, 0x81A1549FD6573DA5,
+    0x5FA7867CAF35E149, 0x56986E2EF3ED091B, 0x917F1DD5F8886C61, 0xD20D8C88C8FFE65F,
+    0x31D71DCE64B2C310, 0xF165B587DF898190, 0xA57E6339DD2CF3A0, 0x1EF6E6DBB1961EC9,
+    0x70CC73D90BC26E24, 0xE21A6B35DF0C3AD7, 0x003A93D8B2806962, 0x1C99DED33CB890A1,
+    0xCF3145DE0ADD4289, 0xD0E4427A5514FB72, 0x77C621CC9FB3A483, 0x67A34DAC4356550B,
+    0xF8D626AAAF278509,
+)
+
+# piece keys by piece character and square; Polyglot numbers the pieces black pawn, white pawn, black knight, ... and
+# the squares from a1, rank by rank
+POLYGLOT_PIECE_KEYS = {char: tuple(POLYGLOT_RANDOM_64[64 * kind + (sq ^ 56)] for sq in range(64))
+                       for kind, char in enumerate('pPnNbBrRqQkK')}
+POLYGLOT_CASTLING_KEYS = tuple(_xor_all(POLYGLOT_RANDOM_64[768 + i] for i in range(4) if rights >> i & 1)
+                               for rights in range(16))
+POLYGLOT_EN_PASSANT_KEYS = POLYGLOT_RANDOM_64[772:780]
+POLYGLOT_WHITE_TO_MOVE_KEY = POLYGLOT_RANDOM_64[780]
+POLYGLOT_PROMOTION_CODES = {None: 0, Piece.KNIGHT: 1, Piece.BISHOP: 2, Piece.ROOK: 3, Piece.QUEEN: 4}
+POLYGLOT_PROMOTIONS_BY_CODE = (None, Piece.KNIGHT, Piece.BISHOP, Piece.ROOK, Piece.QUEEN)
+
+
+def polyglot_key(position: Position) -> int:
+    """
+    Key of the position in Polyglot opening books. Unlike the Zobrist key it counts an en passant target only if a
+    pawn of the side to move could capture there.
+
+    >>> '{:x}'.format(polyglot_key(Position()))
+    '463b96181691fc9c'
+    """
+    key = POLYGLOT_CASTLING_KEYS[position._castling_rights]
+    for sq, char in enumerate(position._squares):
+        if char != '.':
+            key ^= POLYGLOT_PIECE_KEYS[char][sq]
+    white = position._active_color == Color.WHITE
+    en_passant_square = position._en_passant_square
+    if en_passant_square is not None:
+        # the squares from which a pawn of the side to move attacks the target are those that an opposing pawn on the
+        # target attacks
+        if white and BLACK_PAWN_ATTACKS[en_passant_square] & position._bitboards['P'] or \
+                not white and WHITE_PAWN_ATTACKS[en_passant_square] & position._bitboards['p']:
+            key ^= POLYGLOT_EN_PASSANT_KEYS[en_passant_square % 8]
+    if white:
+        key ^= POLYGLOT_WHITE_TO_MOVE_KEY
+    return key
+
+
+def encode_polyglot_move(position: Position, move: Move) -> int:
+    """
+    Move in Polyglot's 16 bits: target file and rank in bits 0-5, origin file and rank in bits 6-11, promotion in
+    bits 12-14. Castling is written as the king taking its own rook.
+    """
+    target = move.target
+    if position._squares[move.origin] in 'Kk' and move.target in CASTLING_ROOK_MOVES:
+        if abs(move.target - move.origin) == 2:
+            target = CASTLING_ROOK_MOVES[move.target][0]
+    return (target ^ 56) | (move.origin ^ 56) << 6 | POLYGLOT_PROMOTION_CODES[move.promotion] << 12
+
+
+def decode_polyglot_move(position: Position, code: int) -> Move:
+    """Inverse of encode_polyglot_move"""
+    origin = (code >> 6 & 63) ^ 56
+    target = (code & 63) ^ 56
+    char = position._squares[origin]
+    if char in 'Kk' and position._squares[target] == ('R' if char == 'K' else 'r'):
+        target = origin + 2 if target > origin else origin - 2
+    return Move(origin, target, POLYGLOT_PROMOTIONS_BY_CODE[code >> 12 & 7])
+
+
+class BookEntry(NamedTuple):
+    """A book move with its weight, and the learning field Polyglot books carry"""
+    move: Move
+    weight: int
+    learn: int
+
+
+class OpeningBook:
+    """
+    Opening book in the Polyglot format: 16-byte big-endian entries of key, move, weight and learning data, sorted by
+    key. The file is memory-mapped and searched by bisection, so probing costs a few microseconds at any size.
+
+    >>> import tempfile
+    >>> pgn = b'[Round "1"]\\n\\n1. e4 e5 1-0\\n\\n[Round "2"]\\n\\n1. e4 c5 0-1\\n\\n[Round "3"]\\n\\n1. d4 d5 *\\n'
+    >>> with tempfile.TemporaryDirectory() as directory:
+    ...     with OpeningBook.build(os.path.join(directory, 'book.bin'), read_games(pgn)) as book:
+    ...         [(entry.move.uci(), entry.weight) for entry in book.entries(Position())]
+    [('e2e4', 2), ('d2d4', 1)]
+    """
+    ENTRY = struct.Struct('>QHHI')
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        if os.fstat(self._file.fileno()).st_size:
+            self._buffer = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
         else:
-            raise ValueError('Unable to parse this one')
-    else:
-        raise ValueError('Unable to parse this one')
+            self._buffer = b''
+        self._size = len(self._buffer) // self.ENTRY.size
+
+    def close(self):
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self._size
+
+    def entries(self, position: Position) -> List[BookEntry]:
+        """Book moves for the position, heaviest first, as stored"""
+        key = polyglot_key(position)
+        buffer = self._buffer
+        unpack_from = self.ENTRY.unpack_from
+        entry_size = self.ENTRY.size
+        low, high = 0, self._size
+        while low < high:
+            middle = (low + high) // 2
+            if unpack_from(buffer, middle * entry_size)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        entries = []
+        for index in range(low, self._size):
+            entry_key, code, weight, learn = unpack_from(buffer, index * entry_size)
+            if entry_key != key:
+                break
+            entries.append(BookEntry(decode_polyglot_move(position, code), weight, learn))
+        return entries
+
+    def _legal_entries(self, position):
+        entries = self.entries(position)
+        if not entries:
+            return entries
+        # a key collision or a broken book must never make the engine play an illegal move
+        legal = set(position.legal_moves())
+        return [entry for entry in entries if entry.move in legal and entry.weight]
+
+    def best_move(self, position: Position) -> Optional[Move]:
+        """Heaviest legal book move, or None when out of book"""
+        entries = self._legal_entries(position)
+        return max(entries, key=lambda entry: entry.weight).move if entries else None
+
+    def weighted_move(self, position: Position, rng: Optional[random.Random] = None) -> Optional[Move]:
+        """Legal book move picked at random in proportion to the weights, or None when out of book"""
+        entries = self._legal_entries(position)
+        if not entries:
+            return None
+        return (rng or random).choices([entry.move for entry in entries], [entry.weight for entry in entries])[0]
+
+    @classmethod
+    def write(cls, path, weights: Dict[int, Dict[int, int]]):
+        """
+        Write a book from weights keyed by Polyglot key and then by Polyglot move code. Weights of a position are
+        scaled down together if any exceeds the 16 bits they are stored in.
+        """
+        pack = cls.ENTRY.pack
+        with open(path, 'wb') as f:
+            for key in sorted(weights):
+                moves = weights[key]
+                scale = max(1, -(-max(moves.values()) // 0xffff))
+                for code, weight in sorted(moves.items(), key=lambda item: (-item[1], item[0])):
+                    f.write(pack(key, code, max(weight // scale, 1), 0))
+
+    @classmethod
+    def build(cls, path, games: Iterable[PGNGame], max_plies: int = 20, min_games: int = 1) -> 'OpeningBook':
+        """
+        Replay the first `max_plies` plies of each game and write a book weighting every move by how often it was
+        played, leaving out moves played in fewer than `min_games` games. Returns the book opened for reading.
+        """
+        weights = {}
+        for game in games:
+            position = game.starting_position()
+            for san in islice(parse_moves(game.moves()), max_plies):
+                move = position._move_from_parsed(san)
+                moves = weights.setdefault(polyglot_key(position), {})
+                code = encode_polyglot_move(position, move)
+                moves[code] = moves.get(code, 0) + 1
+                position.push(move)
+        if min_games > 1:
+            weights = {key: {code: count for code, count in moves.items() if count >= min_games}
+                       for key, moves in weights.items()}
+            weights = {key: moves for key, moves in weights.items() if moves}
+        cls.write(path, weights)
+        return cls(path)
+
+
+TABLEBASE_MAX_PIECES = 4
+# order of the pieces of a side in material names such as 'KQvKR', and of the axes of a table
+_TABLEBASE_PIECE_ORDER = 'KQRBNP'
+# squares the white king is kept on in a table; positions with it on files e-h are stored mirrored
+TABLEBASE_KING_SQUARES = tuple(sq for sq in range(64) if sq % 8 < 4)
+_TABLEBASE_KING_INDICES = {sq: i for i, sq in enumerate(TABLEBASE_KING_SQUARES)}
+# a table holds one byte per position: 0 for a draw, 255 for an illegal position and otherwise the plies to mate plus
+# one, odd when the side to move loses and even when it wins
+_TABLEBASE_ILLEGAL = 255
+
+
+class TablebaseEntry(NamedTuple):
+    """Result of a tablebase probe, from the side to move's point of view"""
+    wdl: int  # 1 win, 0 draw, -1 loss
+    dtm: Optional[int]  # plies to mate with best play from both sides, None for a draw
+
+
+def _split_material(material):
+    """'KQvKR' -> ('KQ', 'KR'), with the pieces of each side in table order"""
+    white, separator, black = material.partition('v')
+    if (not separator or white.count('K') != 1 or black.count('K') != 1 or
+            set(white + black) - set(_TABLEBASE_PIECE_ORDER) or len(white + black) > TABLEBASE_MAX_PIECES):
+        raise ValueError('Unsupported material {}, expected e.g. KQvK with at most {} pieces'.format(
+            material, TABLEBASE_MAX_PIECES))
+    return _sorted_side(white), _sorted_side(black)
+
+
+def _sorted_side(pieces):
+    return ''.join(sorted(pieces, key=_TABLEBASE_PIECE_ORDER.index))
+
+
+def _canonical_material(white, black):
+    """Name of the table that holds a material balance, and whether the colors are swapped in it"""
+    def strength(side):
+        return -len(side), [_TABLEBASE_PIECE_ORDER.index(char) for char in side]
+
+    if strength(black) < strength(white):
+        return '{}v{}'.format(black, white), True
+    return '{}v{}'.format(white, black), False
+
+
+def _successor_materials(white, black):
+    """Names of the tables that captures and promotions lead to from a material set"""
+    successors = set()
+    for side, other in ((white, black), (black, white)):
+        for i, char in enumerate(side):
+            if char != 'K':  # captured
+                successors.add(_canonical_material(side[:i] + side[i + 1:], other)[0])
+            if char == 'P':  # promoted, possibly capturing
+                for promotion in 'QRBN':
+                    promoted = _sorted_side(side[:i] + promotion + side[i + 1:])
+                    for j, victim in enumerate(other):
+                        successors.add(_canonical_material(promoted, other if victim == 'K' else
+                                                           other[:j] + other[j + 1:])[0])
+    return sorted(successors)
+
+
+def _tablebase_axis_key(piece):
+    char, _ = piece
+    return char.islower(), _TABLEBASE_PIECE_ORDER.index(char.upper())
+
+
+class Tablebases:
+    """
+    Endgame tablebases with the distance to mate of every position of material sets of up to TABLEBASE_MAX_PIECES
+    pieces, kings included, generated by retrograde analysis.
+
+    Each table is a file in `directory` named after its material, such as 'KQvK.dtm': a header and then one byte per
+    position, indexed by side to move, white king square (files a-d only, other positions are stored mirrored) and
+    the square of every other piece, white pieces before black ones. Tables are memory-mapped when first probed, so
+    probing needs neither NumPy nor memory for the whole table. Castling and en passant are not covered and the
+    fifty-move rule is not taken into account.
+    """
+    HEADER = struct.Struct('<8sI16s')
+    MAGIC = b'DEEPESTB'
+    VERSION = 1
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._tables = {}
+
+    def close(self):
+        for table in self._tables.values():
+            if table is not None:
+                table[1].close()
+                table[0].close()
+        self._tables = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def path(self, material: str) -> str:
+        """Path of the file holding the table for a material set such as 'KQvK' or 'KvKQ'"""
+        return os.path.join(self.directory, _canonical_material(*_split_material(material))[0] + '.dtm')
+
+    def _table(self, name):
+        if name not in self._tables:
+            path = os.path.join(self.directory, name + '.dtm')
+            table = None
+            if os.path.exists(path):
+                f = open(path, 'rb')
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                magic, version, stored_name = self.HEADER.unpack_from(buffer)
+                if magic != self.MAGIC or version != self.VERSION or stored_name.rstrip(b'\0').decode() != name:
+                    buffer.close()
+                    f.close()
+                    raise ValueError('{} is not a tablebase for {}'.format(path, name))
+                table = (f, buffer)
+            self._tables[name] = table
+        return self._tables[name]
+
+    def probe(self, position: Position) -> Optional[TablebaseEntry]:
+        """
+        Win, draw or loss and distance to mate for the side to move, or None if the position has castling rights or
+        a legal en passant capture, or if there is no table for its material in the directory
+        """
+        if position._castling_rights:
+            return None
+        en_passant_square = position._en_passant_square
+        if en_passant_square is not None:
+            # the target is set after every double push, but only a capture that can be made changes the position
+            white = position._active_color == Color.WHITE
+            pawn = 'P' if white else 'p'
+            attacks = BLACK_PAWN_ATTACKS if white else WHITE_PAWN_ATTACKS
+            if attacks[en_passant_square] & position._bitboards[pawn] and any(
+                    move.target == en_passant_square and position._squares[move.origin] == pawn
+                    for move in position.legal_moves()):
+                return None
+        occupied = position._white | position._black
+        if bin(occupied).count('1') > TABLEBASE_MAX_PIECES:
+            return None
+        squares = position._squares
+        pieces = [(squares[sq], sq) for sq in _iter_bits(occupied)]
+        name, flipped = _canonical_material(_sorted_side(char for char, _ in pieces if char.isupper()),
+                                            _sorted_side(char.upper() for char, _ in pieces if char.islower()))
+        table = self._table(name)
+        if table is None:
+            return None
+        black = position._active_color == Color.BLACK
+        if flipped:
+            pieces = [(char.swapcase(), sq ^ 56) for char, sq in pieces]
+            black = not black
+        pieces.sort(key=_tablebase_axis_key)
+        mirror = 7 if pieces[0][1] % 8 >= 4 else 0
+        index = black * 32 + _TABLEBASE_KING_INDICES[pieces[0][1] ^ mirror]
+        for _, sq in pieces[1:]:
+            index = index * 64 + (sq ^ mirror)
+        value = table[1][self.HEADER.size + index]
+        if value == _TABLEBASE_ILLEGAL:
+            return None
+        if not value:
+            return TablebaseEntry(0, None)
+        return TablebaseEntry(-1 if value & 1 else 1, value - 1)
+
+    def generate(self, material: str, progress: Optional[Callable[[str, float], None]] = None) -> str:
+        """
+        Generate the table for a material set such as 'KQvKR' in the directory, after the tables it can turn into
+        by captures and promotions. Tables already in the directory are read instead of generated again. `progress`
+        is called with the name and the seconds taken of every table generated. Returns the path of the table.
+        Requires NumPy.
+        """
+        name, _ = _canonical_material(*_split_material(material))
+        if np is None:
+            raise ImportError('Tablebases.generate() requires numpy')
+        os.makedirs(self.directory, exist_ok=True)
+        _TablebaseGenerator(self.directory, progress).table(name)
+        # forget tables that were missing before
+        self._tables = {name: table for name, table in self._tables.items() if table is not None}
+        return os.path.join(self.directory, name + '.dtm')
+
+
+@lru_cache(maxsize=None)
+def _tablebase_arrays():
+    """Attack and between tables as NumPy boolean arrays, and the mirroring permutations of the squares"""
+    attack_tables = {'K': KING_ATTACKS, 'Q': tuple(r | b for r, b in zip(ROOK_EMPTY_BOARD_ATTACKS,
+                                                                         BISHOP_EMPTY_BOARD_ATTACKS)),
+                     'R': ROOK_EMPTY_BOARD_ATTACKS, 'B': BISHOP_EMPTY_BOARD_ATTACKS, 'N': KNIGHT_ATTACKS,
+                     'P': WHITE_PAWN_ATTACKS, 'p': BLACK_PAWN_ATTACKS}
+    attacks = {char: np.array([[bb >> sq & 1 for sq in range(64)] for bb in table], dtype=bool)
+               for char, table in attack_tables.items()}
+    between = np.array([[[bb >> sq & 1 for sq in range(64)] for bb in row] for row in BETWEEN], dtype=bool)
+    squares = np.arange(64)
+    return attacks, between, squares ^ 7, squares ^ 56
+
+
+def _tablebase_moves(char, origin):
+    """
+    Moves of a piece from `origin` on an otherwise empty board, as (target, squares that must be empty on the way,
+    whether the target may be empty, whether it may hold an enemy piece, whether the move promotes)
+    """
+    if char in 'Pp':
+        step, start_rank, last_rank, attacks = (-8, 6, 0, WHITE_PAWN_ATTACKS) if char == 'P' else \
+            (8, 1, 7, BLACK_PAWN_ATTACKS)
+        moves = [(origin + step, (), True, False, (origin + step) // 8 == last_rank)]
+        if origin // 8 == start_rank:
+            moves.append((origin + 2 * step, (origin + step,), True, False, False))
+        moves.extend((target, (), False, True, target // 8 == last_rank) for target in _iter_bits(attacks[origin]))
+        return moves
+    attacks = {'K': KING_ATTACKS, 'N': KNIGHT_ATTACKS, 'R': ROOK_EMPTY_BOARD_ATTACKS,
+               'B': BISHOP_EMPTY_BOARD_ATTACKS}.get(char.upper())
+    targets = attacks[origin] if attacks else ROOK_EMPTY_BOARD_ATTACKS[origin] | BISHOP_EMPTY_BOARD_ATTACKS[origin]
+    return [(target, tuple(_iter_bits(BETWEEN[origin][target])), True, True, False) for target in _iter_bits(targets)]
+
+
+def _tablebase_unmoves(char, target):
+    """Squares a piece now on `target` can have come from without capturing, with the squares passed on the way"""
+    if char in 'Pp':
+        step, double_rank = (8, 4) if char == 'P' else (-8, 3)
+        unmoves = []
+        if 1 <= (target + step) // 8 <= 6:
+            unmoves.append((target + step, ()))
+        if target // 8 == double_rank:
+            unmoves.append((target + 2 * step, (target + step,)))
+        return unmoves
+    return [(origin, path) for origin, path, _, _, _ in _tablebase_moves(char, target)]
+
+
+def _expand(values, axes, ndim):
+    """Reshape an array whose dimensions are the given axes of an `ndim`-dimensional array, to broadcast with it"""
+    order = sorted(range(len(axes)), key=axes.__getitem__)
+    values = np.transpose(values, order)
+    shape = [1] * ndim
+    for axis, size in zip(sorted(axes), values.shape):
+        shape[axis] = size
+    return values.reshape(shape)
+
+
+def _permuted(values, permutation, axes):
+    for axis in axes:
+        values = np.take(values, permutation, axis=axis)
+    return values
+
+
+class _TablebaseGenerator:
+    """
+    Retrograde analysis over whole tables at once with NumPy. A table is an array with an axis for the side to move
+    and one per piece, so a move of one piece between two squares is an operation on two slices of it.
+    """
+
+    def __init__(self, directory, progress=None):
+        self.directory = directory
+        self.progress = progress
+        self._tables = {}
+        self._views = {}
+        self._attacks, self._between, self._mirror, self._flip = _tablebase_arrays()
+
+    def table(self, name):
+        """Table of a canonical material set, read from the directory or else generated and written there"""
+        if name not in self._tables:
+            white, black = name.split('v')
+            shape = (2, 32) + (64,) * (len(white) + len(black) - 1)
+            path = os.path.join(self.directory, name + '.dtm')
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    f.seek(Tablebases.HEADER.size)
+                    table = np.fromfile(f, dtype=np.uint8).reshape(shape)
+            else:
+                for successor in _successor_materials(white, black):
+                    self.table(successor)
+                start = time.perf_counter()
+                table = self._generate(white, black)
+                with open(path + '.tmp', 'wb') as f:
+                    f.write(Tablebases.HEADER.pack(Tablebases.MAGIC, Tablebases.VERSION, name.encode()))
+                    f.write(table.tobytes())
+                os.replace(path + '.tmp', path)
+                if self.progress is not None:
+                    self.progress(name, time.perf_counter() - start)
+            self._tables[name] = table
+        return self._tables[name]
+
+    def view(self, pieces):
+        """
+        Table of the material of `pieces` with every white king square and an axis per piece in the order given,
+        whatever the colors of the table it comes from
+        """
+        if pieces not in self._views:
+            white = _sorted_side(char for char in pieces if char.isupper())
+            black = _sorted_side(char.upper() for char in pieces if char.islower())
+            name, flipped = _canonical_material(white, black)
+            table = self.table(name)
+            full = np.empty((2,) + (64,) * len(pieces), dtype=np.uint8)
+            full[:, list(TABLEBASE_KING_SQUARES)] = table
+            full[:, [sq ^ 7 for sq in TABLEBASE_KING_SQUARES]] = _permuted(table, self._mirror, range(2, table.ndim))
+            axes = list(name.split('v')[0]) + list(name.split('v')[1].lower())
+            if flipped:
+                full = _permuted(full[::-1], self._flip, range(1, full.ndim))
+                axes = [char.swapcase() for char in axes]
+            order = []
+            for char in pieces:
+                order.append(next(axis for axis, other in enumerate(axes) if other == char and axis not in order))
+            self._views[pieces] = np.transpose(full, [0] + [1 + axis for axis in order])
+        return self._views[pieces]
+
+    def _generate(self, white, black):
+        pieces = tuple(white) + tuple(black.lower())
+        n = len(pieces)
+        sides = [0 if char.isupper() else 1 for char in pieces]
+        kings = (0, len(white))
+        coords = [np.array(TABLEBASE_KING_SQUARES)] + [np.arange(64)] * (n - 1)
+        shape = (2, 32) + (64,) * (n - 1)
+
+        placed = np.ones(shape[1:], dtype=bool)
+        for a in range(n):
+            for b in range(a + 1, n):
+                placed = placed & _expand(coords[a][:, None] != coords[b][None, :], [a, b], n)
+            if pieces[a] in 'Pp':
+                placed = placed & _expand((coords[a] // 8 % 7) != 0, [a], n)
+        in_check = np.stack([self._attacked(pieces, coords, sides, kings[0]),
+                             self._attacked(pieces, coords, sides, kings[1])])
+        valid = np.stack([placed & ~in_check[1], placed & ~in_check[0]])
+
+        self._count = np.zeros(shape, dtype=np.uint8)
+        self._has_moves = np.zeros(shape, dtype=bool)
+        self._scheduled = np.full(shape, 255, dtype=np.uint8)
+        self._external_loss = np.zeros(shape, dtype=np.uint8)
+        self._valid = valid
+        self._forward(pieces, coords, sides)
+
+        has_moves, count, scheduled = self._has_moves, self._count, self._scheduled
+        scheduled[valid & ~has_moves & in_check] = 0
+        doomed = valid & has_moves & (count == 0) & (scheduled == 255)
+        scheduled[doomed] = self._external_loss[doomed] + 1
+
+        table = np.where(valid, 0, _TABLEBASE_ILLEGAL).astype(np.uint8)
+        level = 0
+        while True:
+            frontier = scheduled == level
+            if frontier.any():
+                table[frontier] = level + 1
+                self._retract(pieces, coords, sides, frontier, level)
+                if level % 2:
+                    doomed = valid & has_moves & (count == 0) & (scheduled == 255)
+                    scheduled[doomed] = np.maximum(self._external_loss[doomed], level) + 1
+            elif not ((scheduled > level) & (scheduled != 255)).any():
+                break
+            level += 1
+            if level >= _TABLEBASE_ILLEGAL - 1:
+                raise ValueError('Distance to mate too long for the table format')
+        self._views = {}
+        del self._count, self._has_moves, self._scheduled, self._external_loss, self._valid
+        return table
+
+    def _attacked(self, pieces, coords, sides, king):
+        """Whether the king on axis `king` is attacked, for every placement of the pieces"""
+        n = len(pieces)
+        attacked = np.zeros((1,) * n, dtype=bool)
+        for i, char in enumerate(pieces):
+            if sides[i] == sides[king]:
+                continue
+            hits = _expand(self._attacks[char if char in 'Pp' else char.upper()][np.ix_(coords[i], coords[king])],
+                           [i, king], n)
+            for m in range(n):
+                if m not in (i, king):
+                    hits = hits & _expand(~self._between[np.ix_(coords[i], coords[king], coords[m])], [i, king, m], n)
+            attacked = attacked | hits
+        return np.broadcast_to(attacked, tuple(len(c) for c in coords))
+
+    @staticmethod
+    def _index(side, axis, value, n):
+        index = [side] + [slice(None)] * n
+        index[1 + axis] = value
+        return tuple(index)
+
+    def _free(self, coords, axes, squares, ndim):
+        """Mask of the placements of the pieces on `axes` that leave all of `squares` empty"""
+        mask = np.ones((1,) * ndim, dtype=bool)
+        for position, axis in enumerate(axes):
+            mask = mask & _expand(~np.isin(coords[axis], squares), [position], ndim)
+        return mask
+
+    def _forward(self, pieces, coords, sides):
+        """Count the legal moves within the table and score those leaving it, for every position"""
+        n = len(pieces)
+        valid = self._valid
+        for side in (0, 1):
+            for i in range(n):
+                if sides[i] != side:
+                    continue
+                rest = [m for m in range(n) if m != i]
+                # kings are never captured: in a legal position the side not to move is not in check
+                victims = [m for m in rest if sides[m] != side and pieces[m] not in 'Kk']
+                own = [m for m in rest if sides[m] == side]
+                enemies = [m for m in rest if sides[m] != side]
+                for fi, origin in enumerate(coords[i]):
+                    origin = int(origin)
+                    source = valid[self._index(side, i, fi, n)]
+                    if not source.any():
+                        continue
+                    for target, path, to_empty, to_enemy, promotes in _tablebase_moves(pieces[i], origin):
+                        base = source & self._free(coords, rest, path, n - 1) & \
+                            self._free_axes(coords, rest, own, target, n - 1)
+                        if to_empty:
+                            quiet = base & self._free_axes(coords, rest, enemies, target, n - 1)
+                            if promotes:
+                                for promotion in ('QRBN' if side == 0 else 'qrbn'):
+                                    self._external(side, i, fi, target, quiet, pieces, coords, None, promotion)
+                            else:
+                                self._internal(side, i, fi, target, quiet, n)
+                        if to_enemy:
+                            promotions = ('QRBN' if side == 0 else 'qrbn') if promotes else (None,)
+                            for j in victims:
+                                capture = base.take(target, axis=rest.index(j))
+                                for promotion in promotions:
+                                    self._external(side, i, fi, target, capture, pieces, coords, j, promotion)
+
+    def _free_axes(self, coords, rest, axes, square, ndim):
+        """Mask of the placements in which none of the pieces on `axes` stands on `square`"""
+        mask = np.ones((1,) * ndim, dtype=bool)
+        for axis in axes:
+            mask = mask & _expand(coords[axis] != square, [rest.index(axis)], ndim)
+        return mask
+
+    def _internal(self, side, i, fi, target, moves, n):
+        """Count moves of piece `i` from its `fi`th square to `target` that stay in the table"""
+        valid = self._valid[1 - side]
+        if i == 0 and target % 8 >= 4:
+            legal = moves & _permuted(valid[_TABLEBASE_KING_INDICES[target ^ 7]], self._mirror, range(n - 1))
+        else:
+            legal = moves & valid.take(_TABLEBASE_KING_INDICES[target] if i == 0 else target, axis=i)
+        index = self._index(side, i, fi, n)
+        self._count[index] += legal
+        self._has_moves[index] |= legal
+
+    def _external(self, side, i, fi, target, moves, pieces, coords, captured, promotion):
+        """Score moves of piece `i` that capture the piece on axis `captured` or promote, leaving the table"""
+        n = len(pieces)
+        after = list(pieces)
+        if promotion is not None:
+            after[i] = promotion
+        kept = [m for m in range(n) if m != captured]
+        values = self.view(tuple(after[m] for m in kept))[1 - side]
+        values = values.take(target, axis=kept.index(i))
+        if i != 0:
+            values = values.take(list(TABLEBASE_KING_SQUARES), axis=0)
+        values = np.where(moves, values, _TABLEBASE_ILLEGAL)
+        index = [side] + [slice(None)] * n
+        index[1 + i] = fi
+        if captured is not None:
+            index[1 + captured] = target
+        index = tuple(index)
+        legal = values != _TABLEBASE_ILLEGAL
+        self._has_moves[index] |= legal
+        self._count[index] += values == 0
+        wins = legal & (values & 1 == 1)
+        np.minimum(self._scheduled[index], np.where(wins, values, 255).astype(np.uint8), out=self._scheduled[index])
+        losses = legal & (values != 0) & (values & 1 == 0)
+        np.maximum(self._external_loss[index], np.where(losses, values - 1, 0).astype(np.uint8),
+                   out=self._external_loss[index])
+
+    def _retract(self, pieces, coords, sides, frontier, level):
+        """
+        Take back the moves into the positions decided at `level`: positions that can move into a loss win at the
+        next level, and positions whose moves have all turned out to lose are counted down
+        """
+        n = len(pieces)
+        for side in (0, 1):
+            decided = frontier[side]
+            if not decided.any():
+                continue
+            mover = 1 - side
+            for i in range(n):
+                if sides[i] != mover:
+                    continue
+                rest = [m for m in range(n) if m != i]
+                present = decided.any(axis=tuple(rest))
+                for ti in np.flatnonzero(present):
+                    target = int(coords[i][ti])
+                    reached = decided.take(ti, axis=i)
+                    for origin, path in _tablebase_unmoves(pieces[i], target):
+                        moves = reached & self._free(coords, rest, path + (origin,), n - 1)
+                        if i == 0 and origin % 8 >= 4:
+                            moves = _permuted(moves, self._mirror, range(n - 1))
+                            index = self._index(mover, 0, _TABLEBASE_KING_INDICES[origin ^ 7], n)
+                        else:
+                            index = self._index(mover, i, _TABLEBASE_KING_INDICES[origin] if i == 0 else origin, n)
+                        moves = moves & self._valid[index]
+                        if level % 2:
+                            self._count[index] -= moves
+                        else:
+                            np.minimum(self._scheduled[index], np.where(moves, level + 1, 255).astype(np.uint8),
+                                       out=self._scheduled[index])
+
+
+PIECE_VALUES = {'K': 0, 'Q': 900, 'R': 500, 'B': 330, 'N': 320, 'P': 100}
+
+# Piece-square bonuses from white's point of view, in board array order (a8 first). For black the board is mirrored.
+PIECE_SQUARE_BONUSES = {
+    'P': (0, 0, 0, 0, 0, 0, 0, 0,
+          50, 50, 50, 50, 50, 50, 50, 50,
+          10, 10, 20, 30, 30, 20, 10, 10,
+          5, 5, 10, 25, 25, 10, 5, 5,
+          0, 0, 0, 20, 20, 0, 0, 0,
+          5, -5, -10, 0, 0, -10, -5, 5,
+          5, 10, 10, -20, -20, 10, 10, 5,
+          0, 0, 0, 0, 0, 0, 0, 0),
+    'N': (-50, -40, -30, -30, -30, -30, -40, -50,
+          -40, -20, 0, 0, 0, 0, -20, -40,
+          -30, 0, 10, 15, 15, 10, 0, -30,
+          -30, 5, 15, 20, 20, 15, 5, -30,
+          -30, 0, 15, 20, 20, 15, 0, -30,
+          -30, 5, 10, 15, 15, 10, 5, -30,
+          -40, -20, 0, 5, 5, 0, -20, -40,
+          -50, -40, -30, -30, -30, -30, -40, -50),
+    'B': (-20, -10, -10, -10, -10, -10, -10, -20,
+          -10, 0, 0, 0, 0, 0, 0, -10,
+          -10, 0, 5, 10, 10, 5, 0, -10,
+          -10, 5, 5, 10, 10, 5, 5, -10,
+          -10, 0, 10, 10, 10, 10, 0, -10,
+          -10, 10, 10, 10, 10, 10, 10, -10,
+          -10, 5, 0, 0, 0, 0, 5, -10,
+          -20, -10, -10, -10, -10, -10, -10, -20),
+    'R': (0, 0, 0, 0, 0, 0, 0, 0,
+          5, 10, 10, 10, 10, 10, 10, 5,
+          -5, 0, 0, 0, 0, 0, 0, -5,
+          -5, 0, 0, 0, 0, 0, 0, -5,
+          -5, 0, 0, 0, 0, 0, 0, -5,
+          -5, 0, 0, 0, 0, 0, 0, -5,
+          -5, 0, 0, 0, 0, 0, 0, -5,
+          0, 0, 0, 5, 5, 0, 0, 0),
+    'Q': (-20, -10, -10, -5, -5, -10, -10, -20,
+          -10, 0, 0, 0, 0, 0, 0, -10,
+          -10, 0, 5, 5, 5, 5, 0, -10,
+          -5, 0, 5, 5, 5, 5, 0, -5,
+          0, 0, 5, 5, 5, 5, 0, -5,
+          -10, 5, 5, 5, 5, 5, 0, -10,
+          -10, 0, 5, 0, 0, 0, 0, -10,
+          -20, -10, -10, -5, -5, -10, -10, -20),
+    'K': (-30, -40, -40, -50, -50, -40, -40, -30,
+          -30, -40, -40, -50, -50, -40, -40, -30,
+          -30, -40, -40, -50, -50, -40, -40, -30,
+          -30, -40, -40, -50, -50, -40, -40, -30,
+          -20, -30, -30, -40, -40, -30, -30, -20,
+          -10, -20, -20, -20, -20, -20, -20, -10,
+          20, 20, 0, 0, 0, 0, 20, 20,
+          20, 30, 10, 0, 0, 10, 30, 20),
+}
+
+
+def _piece_square_values():
+    values = {}
+    for piece, bonuses in PIECE_SQUARE_BONUSES.items():
+        values[piece] = tuple(PIECE_VALUES[piece] + bonus for bonus in bonuses)
+        values[piece.lower()] = tuple(-(PIECE_VALUES[piece] + bonuses[sq ^ 56]) for sq in range(64))
+    return values
+
+
+# material plus piece-square bonus of each piece on each square, positive for white and negative for black
+PIECE_SQUARE_VALUES = _piece_square_values()
+
+
+DOUBLED_PAWN_PENALTY = 10  # for each pawn on a file beyond the first
+ISOLATED_PAWN_PENALTY = 15  # for each pawn with no friendly pawns on the adjacent files
+# bonus for a passed pawn by the rank it stands on, counted from its own side (index 1 is the second rank)
+PASSED_PAWN_BONUSES = (0, 5, 10, 20, 35, 60, 100, 0)
+
+FILE_MASKS = tuple(FILE_A_BB << x for x in range(8))
+_ADJACENT_FILE_MASKS = tuple((FILE_MASKS[x - 1] if x > 0 else 0) | (FILE_MASKS[x + 1] if x < 7 else 0)
+                             for x in range(8))
+# squares ahead of a pawn on its own and the adjacent files; it is passed when no enemy pawn stands on them
+_PASSED_PAWN_MASKS = {
+    color: tuple(sum(1 << (y * 8 + x) for y in (range(sq // 8) if color == Color.WHITE else range(sq // 8 + 1, 8))
+                     for x in range(max(sq % 8 - 1, 0), min(sq % 8 + 1, 7) + 1)) for sq in range(64))
+    for color in Color}
+
+
+def evaluate_pawns(white_pawns: int, black_pawns: int) -> int:
+    """
+    Pawn-structure score in centipawns from white's point of view, given the bitboards of both sides' pawns:
+    penalties for doubled and isolated pawns and bonuses for passed pawns, growing as they advance.
+
+    >>> evaluate_pawns(Position()._bitboards['P'], Position()._bitboards['p'])
+    0
+    >>> evaluate_pawns(Position('4k3/8/8/8/8/P7/P7/4K3 w - - 0 1')._bitboards['P'], 0)  # doubled, isolated, passed
+    -25
+    """
+    score = 0
+    for x in range(8):
+        white = bin(white_pawns & FILE_MASKS[x]).count('1')
+        if white:
+            score -= (white - 1) * DOUBLED_PAWN_PENALTY
+            if not white_pawns & _ADJACENT_FILE_MASKS[x]:
+                score -= white * ISOLATED_PAWN_PENALTY
+        black = bin(black_pawns & FILE_MASKS[x]).count('1')
+        if black:
+            score += (black - 1) * DOUBLED_PAWN_PENALTY
+            if not black_pawns & _ADJACENT_FILE_MASKS[x]:
+                score += black * ISOLATED_PAWN_PENALTY
+    masks = _PASSED_PAWN_MASKS[Color.WHITE]
+    for sq in _iter_bits(white_pawns):
+        if not black_pawns & masks[sq]:
+            score += PASSED_PAWN_BONUSES[7 - sq // 8]
+    masks = _PASSED_PAWN_MASKS[Color.BLACK]
+    for sq in _iter_bits(black_pawns):
+        if not white_pawns & masks[sq]:
+            score -= PASSED_PAWN_BONUSES[sq // 8]
+    return score
+
+
+class PawnHashTable:
+    """
+    Fixed-size cache of pawn-structure scores, keyed by Position.pawn_key(). The pawns rarely change between nodes
+    of a search, so most evaluations find their pawn score here instead of computing it.
+
+    Like TranspositionTable, entries live in two arrays of unsigned 64-bit integers, full keys and data words. A data
+    word holds the score, offset to be unsigned, in bits 0-31 and a set bit 32; a data word of 0 is an empty slot.
+
+    >>> table = PawnHashTable(size_mb=1)
+    >>> table.score(Position()), table.score(Position().move('Nf3'))
+    (0, 0)
+    >>> table.hits, table.misses
+    (1, 1)
+    """
+    ENTRY_BYTES = 16
+
+    def __init__(self, size_mb: float = 1):
+        self.size = max(1, int(size_mb * 2 ** 20) // self.ENTRY_BYTES)
+        self.clear()
+
+    def __len__(self):
+        return self.size
+
+    def clear(self):
+        """Empty the table and reset the counters"""
+        self._keys = array('Q', bytes(8 * self.size))
+        self._data = array('Q', bytes(8 * self.size))
+        self.hits = self.misses = 0
+
+    def score(self, position: Position) -> int:
+        """evaluate_pawns() of the position, from the table or computed and stored"""
+        key = position._pawn_key
+        slot = key % self.size
+        word = self._data[slot]
+        if word and self._keys[slot] == key:
+            self.hits += 1
+            return (word & 0xffffffff) - 2 ** 31
+        self.misses += 1
+        bitboards = position._bitboards
+        score = evaluate_pawns(bitboards['P'], bitboards['p'])
+        self._keys[slot] = key
+        self._data[slot] = 1 << 32 | (score + 2 ** 31)
+        return score
+
+    def stats(self) -> Dict[str, float]:
+        """Counters for sizing the table: lookups that hit and missed, and the hit rate"""
+        lookups = self.hits + self.misses
+        return {'size': self.size, 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
+
+# recompute every evaluation from scratch and check it against the incrementally updated one; slow, for debugging
+DEBUG_EVALUATION = False
+
+
+def evaluate(position: Position, pawn_table: Optional[PawnHashTable] = None) -> int:
+    """
+    Static evaluation in centipawns from the point of view of the side to move: material plus piece-square bonuses,
+    which Position.push() and pop() keep up to date, and the pawn structure, looked up in `pawn_table` if given.
+
+    >>> evaluate(Position())
+    0
+    """
+    if pawn_table is not None:
+        pawns = pawn_table.score(position)
+    else:
+        pawns = evaluate_pawns(position._bitboards['P'], position._bitboards['p'])
+    if DEBUG_EVALUATION:
+        _check_evaluation(position, pawns)
+    score = position._score + pawns
+    return score if position._active_color == Color.WHITE else -score
+
+
+def _check_evaluation(position, pawns):
+    expected = (_evaluate_from_scratch(position), position._compute_pawn_key(),
+                evaluate_pawns(position._bitboards['P'], position._bitboards['p']))
+    if (position._score, position._pawn_key, pawns) != expected:
+        raise AssertionError('Incremental evaluation (score, pawn key, pawns) {} differs from {} in {}'.format(
+            (position._score, position._pawn_key, pawns), expected, position.fen()))
+
+
+def _evaluate_from_scratch(position):
+    """Material plus piece-square values of all pieces from white's point of view"""
+    score = 0
+    for char, bb in position._bitboards.items():
+        values = PIECE_SQUARE_VALUES[char]
+        for sq in _iter_bits(bb):
+            score += values[sq]
+    return score
+
+
+# PIECE_SQUARE_VALUES as a (12, 64) array, pieces in PIECE_CHARS order
+PIECE_SQUARE_ARRAY = None if np is None else np.array([PIECE_SQUARE_VALUES[char] for char in PIECE_CHARS],
+                                                      dtype=np.int32)
+
+
+def _batch_tensor(positions):
+    """position_tensor() of positions or packed positions, and whether black is to move in each (N,)"""
+    pieces = np.arange(len(PIECE_CHARS), dtype=np.uint8)[None, :, None]
+    if isinstance(positions, (bytes, bytearray, memoryview)):
+        positions = position_array(positions)
+    if isinstance(positions, np.ndarray):
+        occupied = np.unpackbits(positions['occupied'].astype('<u8').view(np.uint8).reshape(-1, 8), axis=1,
+                                 bitorder='little').astype(bool)
+        packed = positions['pieces']
+        codes = np.empty((len(positions), 32), dtype=np.uint8)
+        codes[:, 0::2] = packed & 15
+        codes[:, 1::2] = packed >> 4
+        # the k-th occupied square holds the k-th code
+        rank = np.maximum(np.cumsum(occupied, axis=1) - 1, 0)
+        squares = np.where(occupied, np.take_along_axis(codes, rank, axis=1), len(PIECE_CHARS))
+        return (squares[:, None, :] == pieces).astype(np.uint8), (positions['state'] & 1).astype(bool)
+    positions = list(positions)
+    bitboards = np.array([[position._bitboards[char] for char in PIECE_CHARS] for position in positions],
+                         dtype='<u8').reshape(-1, len(PIECE_CHARS))
+    tensor = np.unpackbits(bitboards.view(np.uint8).reshape(-1, len(PIECE_CHARS), 8), axis=2, bitorder='little')
+    black = np.array([position._active_color == Color.BLACK for position in positions], dtype=bool)
+    return tensor, black
+
+
+def position_tensor(positions) -> 'np.ndarray':
+    """
+    One-hot (N, 12, 64) uint8 array of the pieces of N positions: element [i, p, sq] is 1 when PIECE_CHARS[p] stands
+    on square sq of the i-th position. `positions` is an iterable of Position objects, or a buffer or array of
+    packed positions from pack_positions(). Requires NumPy.
+
+    >>> position_tensor([Position()]).sum(axis=2).tolist()
+    [[1, 1, 2, 2, 2, 8, 1, 1, 2, 2, 2, 8]]
+    """
+    if np is None:
+        raise ImportError('position_tensor() requires numpy')
+    return _batch_tensor(positions)[0]
+
+
+def evaluate_batch(positions) -> 'np.ndarray':
+    """
+    evaluate() for many positions in one vectorized pass, as an int32 array. `positions` is an iterable of Position
+    objects, or a buffer or array of packed positions from pack_positions(). Requires NumPy.
+
+    >>> evaluate_batch([Position(), Position().move('e4')]).tolist()
+    [0, -40]
+    """
+    if np is None:
+        raise ImportError('evaluate_batch() requires numpy')
+    tensor, black = _batch_tensor(positions)
+    scores = np.einsum('ipq,pq->i', tensor, PIECE_SQUARE_ARRAY)
+    scores += _evaluate_pawns_batch(tensor[:, PIECE_CODES['P']].reshape(-1, 8, 8).astype(np.int32),
+                                    tensor[:, PIECE_CODES['p']].reshape(-1, 8, 8).astype(np.int32))
+    return np.where(black, -scores, scores).astype(np.int32)
+
+
+def _evaluate_pawns_batch(white, black):
+    """evaluate_pawns() of (N, 8, 8) arrays of white and black pawns, indexed by rank from the 8th and by file"""
+    bonuses = np.array(PASSED_PAWN_BONUSES, dtype=np.int32)
+    scores = np.zeros(len(white), dtype=np.int32)
+    for pawns, sign in ((white, 1), (black, -1)):
+        files = pawns.sum(axis=1)
+        padded = np.pad(files, ((0, 0), (1, 1)))
+        isolated = files * ((padded[:, :-2] + padded[:, 2:]) == 0)
+        scores -= sign * (np.maximum(files - 1, 0).sum(axis=1) * DOUBLED_PAWN_PENALTY +
+                          isolated.sum(axis=1) * ISOLATED_PAWN_PENALTY)
+    # a white pawn is passed when the black pawns of its and the adjacent files are all on its rank or behind it,
+    # that is on a row index no less than its own, and the other way around for black
+    rows = np.arange(8)[None, :, None]
+    foremost_black = np.where(black, rows, 8).min(axis=1)
+    foremost_black = np.pad(foremost_black, ((0, 0), (1, 1)), constant_values=8)
+    foremost_black = np.minimum(np.minimum(foremost_black[:, :-2], foremost_black[:, 1:-1]), foremost_black[:, 2:])
+    passed = white * (foremost_black[:, None, :] >= rows)
+    scores += (passed * bonuses[::-1][None, :, None]).sum(axis=(1, 2))
+    foremost_white = np.where(white, rows, -1).max(axis=1)
+    foremost_white = np.pad(foremost_white, ((0, 0), (1, 1)), constant_values=-1)
+    foremost_white = np.maximum(np.maximum(foremost_white[:, :-2], foremost_white[:, 1:-1]), foremost_white[:, 2:])
+    passed = black * (foremost_white[:, None, :] <= rows)
+    scores -= (passed * bonuses[None, :, None]).sum(axis=(1, 2))
+    return scores
+
+
+MATE_SCORE = 30000
+MAX_PLY = 128
+INFINITE_SCORE = MATE_SCORE + 1
+ASPIRATION_WINDOW = 50
+
+
+class SearchResult(NamedTuple):
+    move: Optional[Move]
+    score: int
+    depth: int
+    nodes: int
+    seconds: float
+    pv: List[Move]
+
+
+class _SearchStopped(Exception):
+    """Raised inside the search when its node or time budget runs out"""
+
+
+class Searcher:
+    """
+    Negamax alpha-beta search with iterative deepening, aspiration windows and quiescence search.
+
+    Moves are ordered transposition table move first, then captures by most valuable victim and least valuable
+    attacker, then killer moves, then quiet moves by history score. With `staged` they are generated in these stages
+    as the search gets to them, see Position.staged_moves(), otherwise all at once and sorted; stats() tells the
+    difference. The transposition table, killers and history are kept between searches, so one Searcher should be
+    reused for the positions of a game.
+
+    >>> Searcher().search(Position('6k1/5ppp/8/8/8/8/5PPP/R5K1 w - - 0 1'), max_depth=2).move.uci()
+    'a1a8'
+    """
+
+    def __init__(self, tt_size_mb: float = 16, tt: Optional[TranspositionTable] = None,
+                 tablebases: Optional[Tablebases] = None, pawn_table: Optional[PawnHashTable] = None,
+                 staged: bool = True):
+        self.tt = tt if tt is not None else TranspositionTable(size_mb=tt_size_mb)
+        # pawn-structure scores do not depend on the search, so the table is kept for the whole game and beyond
+        self.pawn_table = pawn_table if pawn_table is not None else PawnHashTable()
+        # positions found in the tablebases are scored from them instead of being searched
+        self.tablebases = tablebases
+        self.tablebase_hits = 0
+        self._killers = [[None, None] for _ in range(MAX_PLY)]
+        self._history = [0] * (2 * 64 * 64)
+        self.staged = staged
+        self.nodes = 0
+        self.moves_generated = 0
+        self.cutoffs = 0
+        self.first_move_cutoffs = 0
+        self._max_nodes = None
+        self._deadline = None
+        self._stop_requested = False
+
+    def stop(self):
+        """Ask a running search, e.g. in another thread, to return as soon as possible"""
+        self._stop_requested = True
+
+    def new_game(self):
+        """Forget what earlier searches learned: the transposition table, killers and history. Pawn scores stay."""
+        self.tt.clear()
+        self._killers = [[None, None] for _ in range(MAX_PLY)]
+        self._history = [0] * (2 * 64 * 64)
+
+    def close(self):
+        """Release what the searcher holds besides memory; nothing for a search in a single process"""
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Move generation and ordering counters of the last search: moves generated per node, beta cutoffs and the share
+        of them caused by the first move tried
+        """
+        return {'nodes': self.nodes, 'moves_generated': self.moves_generated,
+                'moves_per_node': self.moves_generated / self.nodes if self.nodes else 0.0, 'cutoffs': self.cutoffs,
+                'first_move_cutoff_rate': self.first_move_cutoffs / self.cutoffs if self.cutoffs else 0.0}
+
+    def search(self, position: Position, max_depth: Optional[int] = None, max_nodes: Optional[int] = None,
+               time_limit: Optional[float] = None, info=None) -> SearchResult:
+        """
+        Search the position until one of the budgets runs out: `max_depth` plies, `max_nodes` nodes or `time_limit`
+        seconds of wall-clock time. With no budget at all the search stops at depth 64.
+
+        The result is the best move of the deepest completed iteration, or of the interrupted one if it had already
+        found a better move than the previous iteration. `info`, if given, is called with the SearchResult of every
+        completed iteration.
+        """
+        try:
+            return self._iterative_deepening(position, max_depth, max_nodes, time_limit, info)
+        finally:
+            self._stop_requested = False
+
+    def _iterative_deepening(self, position, max_depth, max_nodes, time_limit, info):
+        start = time.perf_counter()
+        # search a copy, a stopped search leaves its position in the middle of a line
+        position = position.copy()
+        max_depth = min(64 if max_depth is None else max(max_depth, 1), MAX_PLY - 1)
+        self.nodes = 0
+        self.moves_generated = 0
+        self.cutoffs = 0
+        self.first_move_cutoffs = 0
+        self.tablebase_hits = 0
+        self._max_nodes = max_nodes
+        self._deadline = None if time_limit is None else start + time_limit
+        self._stopped_move = None
+        self.tt.new_search()
+        self._history = [h >> 2 for h in self._history]
+        self._killers = [[None, None] for _ in range(MAX_PLY)]
+
+        moves = position.legal_moves()
+        if not moves:
+            score = -MATE_SCORE if position._in_check() else 0
+            return SearchResult(None, score, 0, 0, time.perf_counter() - start, [])
+
+        result = SearchResult(moves[0], evaluate(position, self.pawn_table), 0, 0, 0.0, [moves[0]])
+        score = result.score
+        for depth in range(1, max_depth + 1):
+            try:
+                score = self._aspiration(position, depth, score)
+            except _SearchStopped:
+                if self._stopped_move is not None:
+                    result = result._replace(move=self._stopped_move, nodes=self.nodes,
+                                             seconds=time.perf_counter() - start)
+                break
+            pv = self._principal_variation(position, depth)
+            result = SearchResult(pv[0] if pv else moves[0], score, depth, self.nodes, time.perf_counter() - start,
+                                  pv)
+            if info is not None:
+                info(result)
+            if abs(score) >= MATE_SCORE - MAX_PLY:
+                break  # found a forced mate, deeper searches will not change the outcome
+            if self._deadline is not None and time.perf_counter() - start > (self._deadline - start) / 2:
+                break  # the next iteration would most likely not finish in time
+        return result._replace(nodes=self.nodes, seconds=time.perf_counter() - start)
+
+    def _aspiration(self, position, depth, previous_score):
+        if depth < 3:
+            return self._root(position, depth, -INFINITE_SCORE, INFINITE_SCORE)
+        delta = ASPIRATION_WINDOW
+        alpha, beta = previous_score - delta, previous_score + delta
+        while True:
+            score = self._root(position, depth, alpha, beta)
+            if score <= alpha:
+                alpha = max(score - delta, -INFINITE_SCORE)
+            elif score >= beta:
+                beta = min(score + delta, INFINITE_SCORE)
+            else:
+                return score
+            delta *= 2
+
+    def _root(self, position, depth, alpha, beta):
+        self._stopped_move = None
+        best_score = -INFINITE_SCORE
+        best_move = None
+        original_alpha = alpha
+        entry = self.tt.probe(position._zobrist)
+        # the root needs every move whether staged or not, and counts them like any other node
+        moves = position.legal_moves()
+        self.moves_generated += len(moves)
+        for move in self._ordered(position, moves, entry.move if entry else None, 0):
+            position.push(move)
+            score = -self._negamax(position, depth - 1, -beta, -alpha, 1)
+            position.pop()
+            if score > best_score:
+                best_score, best_move = score, move
+                if score > alpha:
+                    alpha = score
+                    self._stopped_move = move
+                    if score >= beta:
+                        break
+        bound = Bound.LOWER if best_score >= beta else Bound.UPPER if best_score <= original_alpha else Bound.EXACT
+        self.tt.store(position._zobrist, depth, bound, best_score, best_move)
+        return best_score
+
+    def _check_budget(self):
+        if self._stop_requested:
+            raise _SearchStopped
+        if self._max_nodes is not None and self.nodes >= self._max_nodes:
+            raise _SearchStopped
+        if self._deadline is not None and not self.nodes & 255 and time.perf_counter() >= self._deadline:
+            raise _SearchStopped
+
+    def _negamax(self, position, depth, alpha, beta, ply):
+        self.nodes += 1
+        self._check_budget()
+
+        if position._halfmove_clock >= 100 or _is_repetition(position):
+            return 0
+
+        if self.tablebases is not None and bin(position._white | position._black).count('1') <= TABLEBASE_MAX_PIECES:
+            entry = self.tablebases.probe(position)
+            if entry is not None:
+                self.tablebase_hits += 1
+                return entry.wdl * (MATE_SCORE - ply - entry.dtm) if entry.wdl else 0
+
+        in_check = position._in_check()
+        if in_check:
+            depth += 1  # check extension
+        if depth <= 0 or ply >= MAX_PLY - 1:
+            return self._quiescence(position, alpha, beta, ply)
+
+        key = position._zobrist
+        entry = self.tt.probe(key)
+        tt_move = None
+        if entry is not None:
+            tt_move = entry.move
+            if entry.depth >= depth:
+                score = _score_from_tt(entry.score, ply)
+                if entry.bound == Bound.EXACT:
+                    return score
+                if entry.bound == Bound.LOWER and score >= beta:
+                    return score
+                if entry.bound == Bound.UPPER and score <= alpha:
+                    return score
+
+        original_alpha = alpha
+        best_score = -INFINITE_SCORE
+        best_move = None
+        squares = position._squares
+        moves = self._moves(position, tt_move, ply)
+        for index, move in enumerate(moves):
+            quiet = squares[move.target] == '.' and move.promotion is None
+            position.push(move)
+            score = -self._negamax(position, depth - 1, -beta, -alpha, ply + 1)
+            position.pop()
+            if score > best_score:
+                best_score, best_move = score, move
+                if score > alpha:
+                    alpha = score
+                    if score >= beta:
+                        self._count_cutoff(index)
+                        if quiet:
+                            self._record_cutoff(position, move, depth, ply)
+                        break
+        if self.staged:
+            self.moves_generated += moves.generated
+        if best_move is None:
+            return -MATE_SCORE + ply if in_check else 0
+
+        bound = Bound.LOWER if best_score >= beta else Bound.UPPER if best_score <= original_alpha else Bound.EXACT
+        self.tt.store(key, depth, bound, _score_to_tt(best_score, ply), best_move)
+        return best_score
+
+    def _quiescence(self, position, alpha, beta, ply):
+        self.nodes += 1
+        self._check_budget()
+
+        # no standing pat in check, every evasion has to be looked at
+        in_check = position._in_check()
+        if not in_check:
+            stand_pat = evaluate(position, self.pawn_table)
+            if stand_pat >= beta:
+                return stand_pat
+            if stand_pat > alpha:
+                alpha = stand_pat
+        if ply >= MAX_PLY - 1:
+            return evaluate(position, self.pawn_table)
+
+        moves = self._moves(position, None, ply, quiets=in_check)
+        searched = False
+        for index, move in enumerate(moves):
+            searched = True
+            position.push(move)
+            score = -self._quiescence(position, -beta, -alpha, ply + 1)
+            position.pop()
+            if score > alpha:
+                alpha = score
+                if score >= beta:
+                    self._count_cutoff(index)
+                    break
+        if self.staged:
+            self.moves_generated += moves.generated
+        if in_check and not searched:
+            return -MATE_SCORE + ply
+        return alpha
+
+    def _moves(self, position, tt_move, ply, quiets=True):
+        """The moves of a node in the order to search them, only captures and promotions without `quiets`"""
+        if self.staged:
+            history = self._history
+            side = 0 if position._active_color == Color.WHITE else 4096
+            return position.staged_moves(tt_move, self._killers[ply],
+                                         lambda move: history[side + move.origin * 64 + move.target], quiets)
+        moves = position.legal_moves()
+        self.moves_generated += len(moves)
+        if not quiets:
+            moves = [m for m in moves if _is_capture(position, m) or m.promotion is not None]
+        return self._ordered(position, moves, tt_move, ply)
+
+    def _count_cutoff(self, index):
+        self.cutoffs += 1
+        if not index:
+            self.first_move_cutoffs += 1
+
+    def _ordered(self, position, moves, tt_move, ply):
+        squares = position._squares
+        killers = self._killers[ply]
+        history = self._history
+        side = 0 if position._active_color == Color.WHITE else 4096
+
+        def priority(move):
+            if move == tt_move:
+                return 1 << 30
+            victim = squares[move.target]
+            if victim != '.':
+                return (1 << 20) + 10 * PIECE_VALUES[victim.upper()] - PIECE_VALUES[squares[move.origin].upper()]
+            if move.promotion is not None:
+                return (1 << 20) + PIECE_VALUES[move.promotion.value]
+            if move == killers[0]:
+                return (1 << 19) + 1
+            if move == killers[1]:
+                return 1 << 19
+            return history[side + move.origin * 64 + move.target]
+
+        return sorted(moves, key=priority, reverse=True)
+
+    def _record_cutoff(self, position, move, depth, ply):
+        killers = self._killers[ply]
+        if killers[0] != move:
+            killers[1] = killers[0]
+            killers[0] = move
+        side = 0 if position._active_color == Color.WHITE else 4096
+        self._history[side + move.origin * 64 + move.target] += depth * depth
+
+    def _principal_variation(self, position, depth):
+        pv = []
+        seen = set()
+        for _ in range(depth):
+            entry = self.tt.probe(position._zobrist)
+            if entry is None or entry.move is None or position._zobrist in seen:
+                break
+            if entry.move not in position.legal_moves():
+                break
+            seen.add(position._zobrist)
+            pv.append(entry.move)
+            position.push(entry.move)
+        for _ in pv:
+            position.pop()
+        return pv
+
+
+class ParallelSearcher(Searcher):
+    """
+    Lazy SMP search in `workers` processes: this one and `workers` - 1 helpers search the same position with one
+    transposition table in shared memory. Each process mostly finds what the others have already searched in the
+    table and moves on to other parts of the tree, so together they reach a depth sooner than one process. Helpers
+    with an odd index aim a ply deeper than asked, which spreads them over more depths. The result is the one of
+    this process, with the nodes of all of them; `max_nodes` counts the nodes of this process only.
+
+    The helpers start with the first search and keep running between searches until close().
+
+    >>> with ParallelSearcher(workers=2, tt_size_mb=1) as searcher:
+    ...     searcher.search(Position('6k1/5ppp/8/8/8/8/5PPP/R5K1 w - - 0 1'), max_depth=2).move.uci()
+    'a1a8'
+    """
+
+    def __init__(self, workers: Optional[int] = None, tt_size_mb: float = 16, tablebases: Optional[Tablebases] = None,
+                 pawn_table: Optional[PawnHashTable] = None):
+        super().__init__(tt=TranspositionTable(size_mb=tt_size_mb, shared=True), tablebases=tablebases,
+                         pawn_table=pawn_table)
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.helper_nodes = 0
+        # what went wrong in helpers during the last search; its results are those of the helpers that remain
+        self.helper_errors = []  # type: List[str]
+        self._helpers = []  # (process, job queue)
+        self._results = None
+        self._stop_helpers = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _start_helpers(self):
+        self._results = multiprocessing.Queue()
+        self._stop_helpers = multiprocessing.Event()
+        for _ in range(self.workers - 1):
+            jobs = multiprocessing.Queue()
+            process = multiprocessing.Process(target=_lazy_smp_helper, args=(self.tt, jobs, self._results,
+                                                                              self._stop_helpers), daemon=True)
+            process.start()
+            self._helpers.append((process, jobs))
+
+    def search(self, position: Position, max_depth: Optional[int] = None, max_nodes: Optional[int] = None,
+               time_limit: Optional[float] = None, info=None) -> SearchResult:
+        if self.workers > 1 and not self._helpers:
+            self._start_helpers()
+        self.helper_nodes = 0
+        self.helper_errors = []
+        if not self._helpers:
+            return super().search(position, max_depth, max_nodes, time_limit, info)
+        self._stop_helpers.clear()
+        directory = self.tablebases.directory if self.tablebases is not None else None
+        for index, (_, jobs) in enumerate(self._helpers, 1):
+            jobs.put((position, None if max_depth is None else max_depth + index % 2, directory))
+        try:
+            result = super().search(position, max_depth, max_nodes, time_limit, info)
+        finally:
+            self._stop_helpers.set()
+            self._collect_helper_results()
+        return result._replace(nodes=result.nodes + self.helper_nodes)
+
+    def _collect_helper_results(self):
+        """Wait for the nodes of every helper, dropping helpers whose process has died instead of waiting forever"""
+        pending = len(self._helpers)
+        while pending:
+            try:
+                nodes, error = self._results.get(timeout=0.1)
+            except queue.Empty:
+                dead = [process for process, _ in self._helpers if not process.is_alive()]
+                for process in dead:
+                    self.helper_errors.append('helper process exited with code {}'.format(process.exitcode))
+                self._helpers = [(process, jobs) for process, jobs in self._helpers if process.is_alive()]
+                pending = max(pending - len(dead), 0)
+                continue
+            pending -= 1
+            self.helper_nodes += nodes
+            if error is not None:
+                self.helper_errors.append(error)
+
+    def close(self):
+        """Stop the helper processes"""
+        for process, jobs in self._helpers:
+            jobs.put(None)
+        for process, _ in self._helpers:
+            process.join()
+        self._helpers = []
+
+
+def _lazy_smp_helper(tt, jobs, results, stop):
+    """Helper process of ParallelSearcher: search each job in the shared table until told to stop"""
+    searcher = Searcher(tt=tt)
+    for position, max_depth, tablebase_directory in iter(jobs.get, None):
+        # every job must be answered, or the searcher waits for this helper forever
+        error = None
+        searcher.nodes = 0
+        try:
+            if tablebase_directory != (searcher.tablebases.directory if searcher.tablebases is not None else None):
+                if searcher.tablebases is not None:
+                    searcher.tablebases.close()
+                searcher.tablebases = None
+                if tablebase_directory is not None:
+                    searcher.tablebases = Tablebases(tablebase_directory)
+            searcher._stop_requested = False
+            # stop the search when this process is told to, or if it finishes first, wait to be told to
+            watcher = threading.Thread(target=lambda: (stop.wait(), searcher.stop()), daemon=True)
+            watcher.start()
+            try:
+                searcher.search(position, max_depth=max_depth)
+            finally:
+                watcher.join()
+        except Exception as e:
+            error = '{}: {}'.format(type(e).__name__, e)
+        results.put((searcher.nodes, error))
+
+
+def _is_capture(position, move):
+    return position._squares[move.target] != '.' or (
+        move.target == position._en_passant_square and position._squares[move.origin] in 'Pp')
+
+
+def _is_repetition(position):
+    """Has the position occurred before since the last capture or pawn move?"""
+    key = position._zobrist
+    stack = position._stack
+    for plies_ago in range(4, min(position._halfmove_clock, len(stack)) + 1, 2):
+        if stack[-plies_ago].zobrist == key:
+            return True
+    return False
+
+
+def _score_to_tt(score, ply):
+    """Mate scores are stored relative to the node rather than the root"""
+    if score >= MATE_SCORE - MAX_PLY:
+        return score + ply
+    if score <= -MATE_SCORE + MAX_PLY:
+        return score - ply
+    return score
+
+
+def _score_from_tt(score, ply):
+    if score >= MATE_SCORE - MAX_PLY:
+        return score - ply
+    if score <= -MATE_SCORE + MAX_PLY:
+        return score + ply
+    return score
+
+
+class UCIEngine:
+    """
+    Universal Chess Interface front-end for a long-lived engine process.
+
+    Commands are read line by line from `input_stream` and answers written to `output_stream`. The Searcher, and
+    with it the transposition table, lives as long as the engine, so it stays warm across position/go commands.
+    Searches run in a background thread so that stop and isready are answered while searching; any other command
+    waits for a running search to finish first, which keeps piped sessions deterministic.
+
+    >>> import io
+    >>> out = io.StringIO()
+    >>> session = 'uci\\nisready\\nposition startpos moves e2e4 e7e5 f1c4 b8c6 d1h5 g8f6\\ngo depth 2\\n'
+    >>> UCIEngine(io.StringIO(session), out).run()
+    >>> [line for line in out.getvalue().splitlines() if not line.startswith(('id ', 'option ', 'info '))]
+    ['uciok', 'readyok', 'bestmove h5f7']
+    """
+    NAME = 'deepES'
+    DEFAULT_HASH_MB = 16
+    MAX_HASH_MB = 4096
+    DEFAULT_PAWN_HASH_MB = 1
+    MAX_THREADS = 256
+    MOVE_OVERHEAD = 0.05  # seconds kept in reserve for communication when playing on a clock
+
+    def __init__(self, input_stream=None, output_stream=None):
+        self.input_stream = input_stream if input_stream is not None else sys.stdin
+        self.output_stream = output_stream if output_stream is not None else sys.stdout
+        self.hash_mb = self.DEFAULT_HASH_MB
+        self.threads = 1
+        self.searcher = Searcher(tt_size_mb=self.hash_mb)
+        self.position = Position()
+        self.own_book = False
+        self.book = None
+        self._search_thread = None
+        self._infinite = False
+        self._output_lock = threading.Lock()
+
+    def send(self, line):
+        with self._output_lock:
+            self.output_stream.write(line + '\n')
+            self.output_stream.flush()
+
+    def run(self):
+        """Process commands until quit or the end of the input"""
+        for line in self.input_stream:
+            if not self.handle(line):
+                return
+        # end of input: let a limited search finish and report, but don't wait forever for an infinite one
+        if self._infinite:
+            self.searcher.stop()
+        self._wait_for_search()
+        self.searcher.close()
+
+    def handle(self, line) -> bool:
+        """Process one command line. Returns False when the engine should quit."""
+        tokens = line.split()
+        if not tokens:
+            return True
+        command, args = tokens[0], tokens[1:]
+        if command == 'quit':
+            self.searcher.stop()
+            self._wait_for_search()
+            self.searcher.close()
+            return False
+        if command == 'stop':
+            self.searcher.stop()
+            self._wait_for_search()
+        elif command == 'isready':
+            self.send('readyok')
+        else:
+            self._wait_for_search()
+            handler = getattr(self, '_uci_' + command, None)
+            if handler is None:
+                self.send('info string unknown command {}'.format(command))
+            else:
+                # a malformed command from the GUI must not end the engine
+                try:
+                    handler(args)
+                except (KeyError, ValueError) as e:
+                    self.send('info string error in {}: {}'.format(command, e))
+        return True
+
+    def _wait_for_search(self):
+        if self._search_thread is not None:
+            self._search_thread.join()
+            self._search_thread = None
+
+    def _uci_uci(self, args):
+        self.send('id name {}'.format(self.NAME))
+        self.send('id author deepES authors')
+        self.send('option name Hash type spin default {} min 1 max {}'.format(self.DEFAULT_HASH_MB, self.MAX_HASH_MB))
+        self.send('option name OwnBook type check default false')
+        self.send('option name BookFile type string default <empty>')
+        self.send('option name TablebasePath type string default <empty>')
+        self.send('option name Threads type spin default 1 min 1 max {}'.format(self.MAX_THREADS))
+        self.send('option name PawnHash type spin default {} min 1 max {}'.format(self.DEFAULT_PAWN_HASH_MB,
+                                                                                 self.MAX_HASH_MB))
+        self.send('uciok')
+
+    def _uci_debug(self, args):
+        global DEBUG_EVALUATION
+        DEBUG_EVALUATION = args[:1] == ['on']
+
+    def _uci_ucinewgame(self, args):
+        self.searcher.new_game()
+
+    def _new_searcher(self):
+        """Replace the searcher after a change of hash size or threads, keeping its tablebases and pawn table"""
+        old = self.searcher
+        if self.threads > 1:
+            self.searcher = ParallelSearcher(workers=self.threads, tt_size_mb=self.hash_mb,
+                                             tablebases=old.tablebases, pawn_table=old.pawn_table)
+        else:
+            self.searcher = Searcher(tt_size_mb=self.hash_mb, tablebases=old.tablebases, pawn_table=old.pawn_table)
+        old.close()
+
+    def _uci_setoption(self, args):
+        # setoption name <id> [value <x>]
+        text = ' '.join(args)
+        name, _, value = text.partition(' value ')
+        name = name.replace('name ', '', 1).strip().lower()
+        if name == 'hash':
+            self.hash_mb = min(max(int(value), 1), self.MAX_HASH_MB)
+            self._new_searcher()
+        elif name == 'threads':
+            self.threads = min(max(int(value), 1), self.MAX_THREADS)
+            self._new_searcher()
+        elif name == 'pawnhash':
+            self.searcher.pawn_table = PawnHashTable(size_mb=min(max(int(value), 1), self.MAX_HASH_MB))
+        elif name == 'tablebasepath':
+            if self.searcher.tablebases is not None:
+                self.searcher.tablebases.close()
+            path = value.strip()
+            self.searcher.tablebases = Tablebases(path) if path and path != '<empty>' else None
+        elif name == 'ownbook':
+            self.own_book = value.strip().lower() == 'true'
+        elif name == 'bookfile':
+            if self.book is not None:
+                self.book.close()
+                self.book = None
+            path = value.strip()
+            if path and path != '<empty>':
+                try:
+                    self.book = OpeningBook(path)
+                except OSError as e:
+                    self.send('info string cannot open book {}: {}'.format(path, e))
+        else:
+            self.send('info string unknown option {}'.format(name))
+
+    def _uci_position(self, args):
+        if not args:
+            return
+        if 'moves' in args:
+            split = args.index('moves')
+            setup, moves = args[:split], args[split + 1:]
+        else:
+            setup, moves = args, []
+        if not setup:
+            self.send('info string expected startpos or fen')
+            return
+        if setup[0] == 'startpos':
+            position = Position()
+        elif setup[0] == 'fen':
+            fen = ' '.join(setup[1:])
+            problem = check_fen(fen)
+            if problem is not None:
+                raise ValueError(problem)
+            position = Position(fen)
+        else:
+            self.send('info string expected startpos or fen')
+            return
+        for uci in moves:
+            move = Move.from_uci(uci)
+            if move not in position.legal_moves():
+                self.send('info string illegal move {}'.format(uci))
+                break
+            position.push(move)
+        self.position = position
+
+    def _uci_go(self, args):
+        options = {}
+        flags = {'infinite', 'ponder'}
+        tokens = iter(args)
+        for token in tokens:
+            if token in flags:
+                options[token] = True
+            elif token == 'searchmoves':
+                break
+            else:
+                value = next(tokens, None)
+                if value is None:
+                    raise ValueError('missing value for {}'.format(token))
+                options[token] = int(value)
+                if token in ('depth', 'nodes') and options[token] < 1:
+                    raise ValueError('{} must be positive'.format(token))
+
+        time_limit = None
+        if 'movetime' in options:
+            time_limit = options['movetime'] / 1000
+        else:
+            white = self.position._active_color == Color.WHITE
+            remaining = options.get('wtime' if white else 'btime')
+            if remaining is not None:
+                increment = options.get('winc' if white else 'binc', 0)
+                moves_to_go = options.get('movestogo', 30)
+                budget = remaining / max(moves_to_go, 1) + increment * 0.8
+                time_limit = max(min(budget, remaining * 0.8) / 1000 - self.MOVE_OVERHEAD, 0.01)
+        self._infinite = bool(options.get('infinite') or options.get('ponder'))
+
+        if self.own_book and self.book is not None and not self._infinite:
+            move = self.book.weighted_move(self.position)
+            if move is not None:
+                self.send('info string book move')
+                self.send('bestmove {}'.format(move.uci()))
+                return
+
+        limits = dict(max_depth=options.get('depth'), max_nodes=options.get('nodes'), time_limit=time_limit)
+        if self._infinite:
+            limits = dict(max_depth=None, max_nodes=None, time_limit=None)
+        position = self.position.copy()
+        self._search_thread = threading.Thread(target=self._search, args=(position, limits), daemon=True)
+        self._search_thread.start()
+
+    def _search(self, position, limits):
+        # the GUI waits for a bestmove, so one must follow even a failed search
+        move = None
+        try:
+            move = self.searcher.search(position, info=self._send_info, **limits).move
+        except Exception as e:
+            self.send('info string error in search: {}'.format(e))
+        for error in getattr(self.searcher, 'helper_errors', ()):
+            self.send('info string error in search helper: {}'.format(error))
+        self.send('bestmove {}'.format(move.uci() if move is not None else '0000'))
+
+    def _send_info(self, result):
+        if abs(result.score) >= MATE_SCORE - MAX_PLY:
+            plies = MATE_SCORE - abs(result.score)
+            score = 'mate {}'.format((plies + 1) // 2 if result.score > 0 else -((plies + 1) // 2))
+        else:
+            score = 'cp {}'.format(result.score)
+        self.send('info depth {} score {} nodes {} nps {} time {} hashfull {} pv {}'.format(
+            result.depth, score, result.nodes, int(result.nodes / result.seconds) if result.seconds else 0,
+            int(result.seconds * 1000), self.searcher.tt.hashfull(), ' '.join(m.uci() for m in result.pv)))
+
+
+# searcher of an analysis worker process, kept warm between requests
+_analysis_searcher = None  # type: Optional[Searcher]
+
+
+def _init_analysis_worker(tt_size_mb):
+    global _analysis_searcher
+    _analysis_searcher = Searcher(tt_size_mb=tt_size_mb)
+
+
+def _analyse_batch(requests):
+    """Answer a batch of AnalysisServer requests, each with its deadline in time.time() seconds, in a worker"""
+    return [_analyse(request, deadline) for request, deadline in requests]
+
+
+def _analyse(request, deadline):
+    response = {'id': request.get('id')}
+    try:
+        fen = request.get('fen', 'startpos')
+        position = Position(None if fen == 'startpos' else fen)
+        for uci in request.get('moves', ()):
+            move = Move.from_uci(uci)
+            if move not in position.legal_moves():
+                raise ValueError('illegal move {}'.format(uci))
+            position.push(move)
+        op = request.get('op', 'search')
+        if op == 'moves':
+            response['moves'] = [move.uci() for move in position.legal_moves()]
+        elif op == 'evaluate':
+            response['score'] = evaluate(position, _analysis_searcher.pawn_table)
+        elif op == 'search':
+            # leave a little of the deadline for sending the answer back
+            time_limit = max(deadline - time.time() - AnalysisServer.DEADLINE_MARGIN, 0.001)
+            if request.get('movetime') is not None:
+                time_limit = min(time_limit, request['movetime'] / 1000)
+            result = _analysis_searcher.search(position, max_depth=request.get('depth'),
+                                               max_nodes=request.get('nodes'), time_limit=time_limit)
+            response.update(bestmove=result.move.uci() if result.move is not None else None, score=result.score,
+                            depth=result.depth, nodes=result.nodes, pv=[move.uci() for move in result.pv])
+        else:
+            raise ValueError('unknown op {!r}, expected moves, evaluate or search'.format(op))
+    except Exception as e:
+        response['error'] = str(e) or type(e).__name__
+    return response
+
+
+class AnalysisServer:
+    """
+    Asyncio server answering analysis requests over TCP or a Unix socket, one JSON object per line each way.
+
+    A request has an optional `id`, echoed in its response, an `op` of 'moves' (the legal moves), 'evaluate' (the
+    static evaluation) or 'search' (the default), a `fen` ('startpos' by default) with optional `moves` in UCI
+    notation played from it, and for searches optional `depth`, `nodes` and `movetime` (ms) limits. `deadline`
+    (ms, default `deadline` seconds) is how long the client waits: a search stops in time to answer before it, and
+    a request still queued when it passes is answered with an error. Responses carry the request's id and the
+    results, or an `error`, and come back in the order they are ready rather than the order of the requests.
+
+    Requests arriving together are batched, up to `max_batch` of them or what arrives within `batch_wait` seconds,
+    and handed to a pool of `workers` processes that keep a Searcher and its tables warm. Searches go to workers
+    one at a time, as they take much longer than the rest. At most `max_pending` requests wait for a worker; when
+    that many do, the server stops reading from its connections until some are done, so clients that send faster
+    than the workers answer are slowed down instead of filling memory.
+
+    `stats` counts the requests, the batches handed to workers and the error responses, and of those the ones for
+    requests past their deadline.
+    """
+    DEADLINE_MARGIN = 0.02  # seconds before the deadline that searches stop
+    DEADLINE_EXCEEDED = 'deadline exceeded'
+
+    def __init__(self, workers: Optional[int] = None, max_batch: int = 64, batch_wait: float = 0.002,
+                 max_pending: int = 1024, deadline: float = 10.0, tt_size_mb: float = 16):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_batch = max_batch
+        self.batch_wait = batch_wait
+        self.max_pending = max_pending
+        self.deadline = deadline
+        self.tt_size_mb = tt_size_mb
+        self.stats = {'requests': 0, 'batches': 0, 'expired': 0, 'errors': 0}
+        self._queue = None
+        self._executor = None
+        self._server = None
+        self._batcher = None
+        self._jobs = set()
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0, path: Optional[str] = None):
+        """Start the worker pool and listen on the TCP host and port, or on the Unix socket at `path`"""
+        loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(self.max_pending)
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_analysis_worker,
+                                             initargs=(self.tt_size_mb,))
+        # start the workers now rather than with the first requests
+        await asyncio.gather(*(loop.run_in_executor(self._executor, _analyse_batch, [])
+                               for _ in range(self.workers)))
+        self._batcher = asyncio.ensure_future(self._batch_requests())
+        if path is not None:
+            self._server = await asyncio.start_unix_server(self._serve_connection, path)
+        else:
+            self._server = await asyncio.start_server(self._serve_connection, host, port)
+        return self._server
+
+    @property
+    def address(self):
+        """Address the server listens on: (host, port) or the path of its Unix socket"""
+        return self._server.sockets[0].getsockname()
+
+    async def serve_forever(self):
+        await self._server.serve_forever()
+
+    async def close(self):
+        """Stop listening and shut the worker pool down"""
+        self._server.close()
+        await self._server.wait_closed()
+        self._batcher.cancel()
+        for job in list(self._jobs):
+            job.cancel()
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    async def _serve_connection(self, reader, writer):
+        responses = set()
+        lock = asyncio.Lock()
+
+        async def respond(future, request_id, deadline):
+            try:
+                response = await asyncio.wait_for(asyncio.shield(future), deadline - time.time())
+            except asyncio.TimeoutError:
+                response = {'id': request_id, 'error': self.DEADLINE_EXCEEDED}
+            if 'error' in response:
+                self.stats['errors'] += 1
+                if response['error'] == self.DEADLINE_EXCEEDED:
+                    self.stats['expired'] += 1
+            async with lock:
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                self.stats['requests'] += 1
+                deadline = time.time() + self.deadline
+                request = None
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError('expected a JSON object')
+                    if request.get('deadline') is not None:
+                        deadline = time.time() + float(request['deadline']) / 1000
+                except (ValueError, TypeError) as e:
+                    request = {'id': request.get('id') if isinstance(request, dict) else None,
+                               'error': 'bad request: {}'.format(e)}
+                future = asyncio.get_running_loop().create_future()
+                if 'error' in request:
+                    future.set_result(request)
+                else:
+                    # waits while max_pending requests are queued, which stops reading from this connection
+                    await self._queue.put((request, deadline, future))
+                task = asyncio.ensure_future(respond(future, request.get('id'), deadline))
+                responses.add(task)
+                task.add_done_callback(responses.discard)
+            await asyncio.gather(*responses)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            for task in responses:
+                task.cancel()
+            writer.close()
+
+    async def _batch_requests(self):
+        loop = asyncio.get_running_loop()
+        # at most two jobs per worker in flight, the rest of the requests wait in the queue
+        slots = asyncio.Semaphore(2 * self.workers)
+        while True:
+            batch = [await self._queue.get()]
+            cutoff = loop.time() + self.batch_wait
+            while len(batch) < self.max_batch:
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                timeout = cutoff - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            now = time.time()
+            live = []
+            for request, deadline, future in batch:
+                if deadline <= now:
+                    future.set_result({'id': request.get('id'), 'error': self.DEADLINE_EXCEEDED})
+                else:
+                    live.append((request, deadline, future))
+            searches = [item for item in live if item[0].get('op', 'search') == 'search']
+            others = [item for item in live if item[0].get('op', 'search') != 'search']
+            for job in [[item] for item in searches] + ([others] if others else []):
+                await slots.acquire()
+                self.stats['batches'] += 1
+                task = asyncio.ensure_future(self._run_job(job, slots))
+                self._jobs.add(task)
+                task.add_done_callback(self._jobs.discard)
+
+    async def _run_job(self, job, slots):
+        try:
+            payload = [(request, deadline) for request, deadline, _ in job]
+            try:
+                responses = await asyncio.get_running_loop().run_in_executor(self._executor, _analyse_batch, payload)
+            except Exception as e:
+                responses = [{'id': request.get('id'), 'error': 'worker failed: {}'.format(e)}
+                             for request, _ in payload]
+            for (_, _, future), response in zip(job, responses):
+                if not future.done():
+                    future.set_result(response)
+        finally:
+            slots.release()
+
+
+def _corpus_command(args):
+    processor = CorpusProcessor(workers=args.workers, chunk_bytes=args.chunk_kb * 1024)
+    problems = 0
+    for index, problem in enumerate(processor.map(args.path, kind=args.kind)):
+        if problem is not None:
+            problems += 1
+            print('{}: {}'.format(index, problem))
+    print(processor.report())
+    print('problems: {}'.format(problems))
+
+
+def _positions_command(args):
+    start = time.perf_counter()
+    with PositionDB.build(args.output, read_games(args.pgn), max_plies=args.max_plies) as db:
+        print('positions: {}'.format(len(db)))
+    print('time: {:.3f} s'.format(time.perf_counter() - start))
+
+
+def _book_command(args):
+    start = time.perf_counter()
+    with OpeningBook.build(args.output, read_games(args.pgn), max_plies=args.max_plies,
+                           min_games=args.min_games) as book:
+        print('entries: {}'.format(len(book)))
+    print('time: {:.3f} s'.format(time.perf_counter() - start))
+
+
+def _tablebase_command(args):
+    with Tablebases(args.directory) as tablebases:
+        for material in args.materials:
+            tablebases.generate(material, progress=lambda name, seconds: print('{}: {:.1f} s'.format(name, seconds)))
+
+
+def _uci_command(args):
+    UCIEngine().run()
+
+
+def _serve_command(args):
+    server = AnalysisServer(workers=args.workers, max_batch=args.max_batch, max_pending=args.max_pending,
+                            deadline=args.deadline)
+
+    async def serve():
+        await server.start(args.host, args.port, args.unix)
+        print('listening on {}'.format(server.address), flush=True)
+        try:
+            await server.serve_forever()
+        finally:
+            await server.close()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+def _perft_command(args):
+    position = Position(args.fen)
+    start = time.perf_counter()
+    if args.divide:
+        counts = perft_divide(position, args.depth)
+        for move, nodes in sorted(counts.items()):
+            print('{}: {}'.format(move, nodes))
+        nodes = sum(counts.values())
+    else:
+        nodes = perft(position, args.depth)
+    seconds = time.perf_counter() - start
+    print('nodes: {}'.format(nodes))
+    print('time: {:.3f} s'.format(seconds))
+    print('nodes/s: {:.0f}'.format(nodes / seconds if seconds else float('inf')))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m deepes')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    perft_parser = commands.add_parser('perft', help='count leaf nodes of the move tree and time move generation')
+    perft_parser.add_argument('fen', help='position in Forsyth-Edwards notation, or "startpos"')
+    perft_parser.add_argument('depth', type=int)
+    perft_parser.add_argument('--divide', action='store_true', help='also list node counts per first move')
+    perft_parser.set_defaults(handler=_perft_command)
+
+    corpus_parser = commands.add_parser('corpus', help='check every game or FEN of a file in a pool of processes')
+    corpus_parser.add_argument('path')
+    corpus_parser.add_argument('--kind', choices=('pgn', 'fen'), help='default: guessed from the file extension')
+    corpus_parser.add_argument('--workers', type=int, help='default: one per CPU')
+    corpus_parser.add_argument('--chunk-kb', type=int, default=1024, help='size of the pieces handed to workers')
+    corpus_parser.set_defaults(handler=_corpus_command)
+
+    positions_parser = commands.add_parser('positions', help='build a position database from the games of a PGN file')
+    positions_parser.add_argument('pgn')
+    positions_parser.add_argument('output')
+    positions_parser.add_argument('--max-plies', type=int, help='only take positions this far into each game')
+    positions_parser.set_defaults(handler=_positions_command)
+
+    book_parser = commands.add_parser('book', help='build a Polyglot opening book from the games of a PGN file')
+    book_parser.add_argument('pgn')
+    book_parser.add_argument('output')
+    book_parser.add_argument('--max-plies', type=int, default=20, help='how deep into each game to take moves')
+    book_parser.add_argument('--min-games', type=int, default=1, help='leave out moves played in fewer games')
+    book_parser.set_defaults(handler=_book_command)
+
+    tablebase_parser = commands.add_parser('tablebase', help='generate endgame tablebases, e.g. KQvK or KRvKP')
+    tablebase_parser.add_argument('materials', nargs='+')
+    tablebase_parser.add_argument('--directory', default='tablebases', help='where to write and look for tables')
+    tablebase_parser.set_defaults(handler=_tablebase_command)
+
+    serve_parser = commands.add_parser('serve', help='answer JSON-lines analysis requests over TCP or a Unix socket')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8765)
+    serve_parser.add_argument('--unix', help='listen on a Unix socket at this path instead of TCP')
+    serve_parser.add_argument('--workers', type=int, help='analysis processes, default: one per CPU')
+    serve_parser.add_argument('--max-batch', type=int, default=64, help='most requests handed to a worker at once')
+    serve_parser.add_argument('--max-pending', type=int, default=1024, help='queued requests before backpressure')
+    serve_parser.add_argument('--deadline', type=float, default=10.0, help='default deadline of a request in seconds')
+    serve_parser.set_defaults(handler=_serve_command)
+
+    uci_parser = commands.add_parser('uci', help='speak the Universal Chess Interface protocol on stdin and stdout')
+    uci_parser.set_defaults(handler=_uci_command)
+
+    args = parser.parse_args(argv)
+    if getattr(args, 'fen', None) == 'startpos':
+        args.fen = None
+    args.handler(args)
+
 
-    return d
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Load test for the deepES analysis server.
+
+``python loadtest_deepes.py`` starts a server in this process and reports throughput and latency percentiles of a
+mix of requests sent over concurrent connections; ``python loadtest_deepes.py --port 8765`` tests a server already
+started with ``python -m deepes serve``.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+
+from deepes import AnalysisServer
+from bench_deepes import _random_game_fens
+
+OPS = ('moves', 'evaluate', 'search')
+
+
+def _percentile(values, fraction):
+    return values[min(int(round(fraction * (len(values) - 1))), len(values) - 1)]
+
+
+def _requests(count, weights, depth, deadline, seed=0):
+    rng = random.Random(seed)
+    fens = _random_game_fens(games=20, plies=60, seed=seed)
+    for i in range(count):
+        op = rng.choices(OPS, weights)[0]
+        request = {'id': i, 'op': op, 'fen': rng.choice(fens)}
+        if op == 'search':
+            request['depth'] = depth
+        if deadline is not None:
+            request['deadline'] = deadline
+        yield request
+
+
+async def _client(host, port, unix, requests, latencies, outcomes):
+    if unix is not None:
+        reader, writer = await asyncio.open_unix_connection(unix)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for request in requests:
+            sent = time.perf_counter()
+            writer.write(json.dumps(request).encode() + b'\n')
+            await writer.drain()
+            response = json.loads(await reader.readline())
+            latencies[request['op']].append(time.perf_counter() - sent)
+            outcomes[response.get('error', 'ok')] += 1
+    finally:
+        writer.close()
+
+
+async def load_test(host='127.0.0.1', port=None, unix=None, connections=16, count=2000, weights=(4, 4, 1), depth=2,
+                    deadline=None, workers=None):
+    """Send `count` requests over `connections` connections, each waiting for an answer before its next request"""
+    server = None
+    if port is None and unix is None:
+        server = AnalysisServer(workers=workers)
+        await server.start(host, 0)
+        host, port = server.address
+    requests = list(_requests(count, weights, depth, deadline))
+    latencies = {op: [] for op in OPS}
+    outcomes = Counter()
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(_client(host, port, unix, requests[i::connections], latencies, outcomes)
+                               for i in range(connections)))
+    finally:
+        seconds = time.perf_counter() - started
+        if server is not None:
+            stats = server.stats
+            await server.close()
+    print('{} requests over {} connections in {:.2f} s: {:.0f} requests/s'.format(count, connections, seconds,
+                                                                                 count / seconds))
+    if server is not None:
+        print('{} batches, {:.1f} requests per batch'.format(stats['batches'], count / max(stats['batches'], 1)))
+    print('{:<12} {:>8} {:>10} {:>10} {:>10}'.format('', 'count', 'p50 ms', 'p99 ms', 'max ms'))
+    for op in OPS + ('all',):
+        values = sorted(sum(latencies.values(), []) if op == 'all' else latencies[op])
+        if values:
+            print('{:<12} {:>8} {:>10.1f} {:>10.1f} {:>10.1f}'.format(
+                op, len(values), _percentile(values, 0.5) * 1000, _percentile(values, 0.99) * 1000, values[-1] * 1000))
+    print('outcomes: {}'.format(', '.join('{} {}'.format(n, outcome) for outcome, n in outcomes.most_common())))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, help='port of a running server, default: start one in this process')
+    parser.add_argument('--unix', help='Unix socket of a running server')
+    parser.add_argument('--connections', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--mix', default='4,4,1', help='relative weights of moves, evaluate and search requests')
+    parser.add_argument('--depth', type=int, default=2, help='depth of search requests')
+    parser.add_argument('--deadline', type=int, help='deadline of every request in ms')
+    parser.add_argument('--workers', type=int, help='workers of the server started in this process')
+    args = parser.parse_args(argv)
+    asyncio.run(load_test(args.host, args.port, args.unix, args.connections, args.requests,
+                          tuple(int(w) for w in args.mix.split(',')), args.depth, args.deadline, args.workers))
+
+
+if __name__ == '__main__':
+    main()
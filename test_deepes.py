@@ -1,5 +1,16 @@
+import io
+import os
+import random
+import subprocess
+import sys
+import time
 from textwrap import dedent
-from deepes import Position, Piece, Color
+from deepes import Position, Piece, Color, Move, TranspositionTable, Bound, Replacement
+from deepes import Searcher, ParallelSearcher, evaluate, MATE_SCORE, UCIEngine, parse_move, parse_san, parse_moves
+from deepes import read_games, CorpusProcessor, PositionDB, PositionRecord, OpeningBook, polyglot_key
+from deepes import pack_positions, unpack_positions, position_array, POSITION_BYTES, evaluate_batch, position_tensor
+import deepes
+from deepes import KNIGHT_ATTACKS, KING_ATTACKS, SQUARE_INDICES, queen_attacks, rook_attacks
 import pytest
 xfail = pytest.mark.xfail
 
@@ -60,6 +71,14 @@ def test_init_board_array():
     assert Position()._board_array == STARTING_BOARD_ARRAY
 
 
+def test_bitboards_match_board_array():
+    pos = Position('rn2kbn1/1ppb2p1/p7/1B1pppqp/2rPPPQP/1P6/P1P3PR/RNB1K1N1 w Qq - 6 11')
+    for y, rank in enumerate(pos._board_array):
+        for x, char in enumerate(rank):
+            for piece_char, bb in pos._bitboards.items():
+                assert bool(bb >> (y * 8 + x) & 1) == (char == piece_char)
+
+
 def test_initializes_with_fen():
     assert Position(fen=STARTING_FEN)
 
@@ -173,18 +192,16 @@ def test_must_promote():
     assert 'Illegal move' in str(excinfo.value)
 
 
-@xfail
 def test_promote():
     pos = Position('3qk3/P7/8/8/8/8/7p/3QK3 w - - 0 0')
     pos = pos.move('a8=Q')
-    assert pos.fen() == 'Q2qk3/8/8/8/8/8/7p/3QK3 b - - 1 1'
+    assert pos.fen() == 'Q2qk3/8/8/8/8/8/7p/3QK3 b - - 0 0'
 
 
-@xfail
 def test_promote_to_check():
     pos = Position('3qk3/P7/8/8/8/8/7p/3QK3 b - - 0 0')
     pos = pos.move('h1=Q+')
-    assert pos.fen() == '3qk3/P7/8/8/8/8/8/3QK2q w - - 1 2'
+    assert pos.fen() == '3qk3/P7/8/8/8/8/8/3QK2q w - - 0 1'
 
 
 def test_rook_move():
@@ -205,7 +222,6 @@ def test_rook_move_black():
     assert pos.fen() == 'rnbqkbn1/ppppppp1/2r5/7p/7P/5PP1/PPPPP3/RNBQKBNR w KQq - 1 5'
 
 
-@xfail
 def test_rook_move_no_jump_over_piece():
     pos = Position('8/8/1K1kr3/8/4r2R/8/8/R7 w - - 2 33')
     with pytest.raises(Exception) as excinfo:
@@ -291,6 +307,1087 @@ def test_candidate_targets_king():
     assert pos.candidate_targets_from('e1') == {'d1', 'd2'}
 
 
+def test_attack_tables():
+    assert bin(KNIGHT_ATTACKS[SQUARE_INDICES['a1']]).count('1') == 2
+    assert bin(KNIGHT_ATTACKS[SQUARE_INDICES['d4']]).count('1') == 8
+    assert bin(KING_ATTACKS[SQUARE_INDICES['h8']]).count('1') == 3
+    assert bin(queen_attacks(SQUARE_INDICES['d4'], 0)).count('1') == 27
+    assert bin(rook_attacks(SQUARE_INDICES['d4'], 1 << SQUARE_INDICES['d6'])).count('1') == 12
+
+
+def test_legal_moves_in_check():
+    pos = Position('rnbqkbnr/ppp2ppp/3p4/1B2p3/4P3/8/PPPP1PPP/RNBQK1NR b KQkq - 1 3')
+    assert sorted(m.uci() for m in pos.legal_moves()) == ['b8c6', 'b8d7', 'c7c6', 'c8d7', 'd8d7', 'e8e7']
+
+
+def test_legal_moves_pinned_piece():
+    pos = Position('4k3/4r3/8/8/8/8/4B3/4K3 w - - 0 1')
+    assert not [m for m in pos.legal_moves() if m.origin == SQUARE_INDICES['e2']]
+
+
+def test_legal_moves_en_passant_discovered_check():
+    pos = Position('8/8/8/K2pP2r/8/8/8/7k w - d6 0 1')
+    assert 'e5d6' not in {m.uci() for m in pos.legal_moves()}
+    pos = Position('8/8/8/3pP3/8/8/8/K6k w - d6 0 1')
+    assert 'e5d6' in {m.uci() for m in pos.legal_moves()}
+
+
+def test_legal_move_codes_match_moves():
+    pos = Position('r3k2r/pPppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1')
+    codes = pos._legal_move_codes()
+    assert [deepes.decode_move(code) for code in codes] == pos.legal_moves()
+    assert [deepes.encode_move(move) for move in pos.legal_moves()] == codes
+    assert {m.uci() for m in pos.legal_moves() if m.promotion} == {'b7a8q', 'b7a8r', 'b7a8b', 'b7a8n',
+                                                                   'b7b8q', 'b7b8r', 'b7b8b', 'b7b8n'}
+
+
+def test_square_conversions():
+    for i, name in enumerate(deepes.SQUARE_NAMES):
+        x, y = Position.square_str_to_xy(name)
+        assert y * 8 + x == i
+        assert Position.square_xy_to_str(x, y) == name
+
+
+def test_en_passant_capture():
+    pos = Position('rnbqkbnr/1pp1pppp/8/p2pP3/8/P7/1PPP1PPP/RNBQKBNR w KQkq d6 0 4')
+    assert pos.move('exd6').fen() == 'rnbqkbnr/1pp1pppp/3P4/p7/8/P7/1PPP1PPP/RNBQKBNR b KQkq - 0 4'
+
+
+def test_capture():
+    pos = Position('rnbqkbnr/ppp1pppp/8/3p4/4P3/8/PPPP1PPP/RNBQKBNR w KQkq d6 0 2')
+    assert pos.move('exd5').fen() == 'rnbqkbnr/ppp1pppp/8/3P4/8/8/PPPP1PPP/RNBQKBNR b KQkq - 0 2'
+
+
+def test_castling():
+    pos = Position('r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1')
+    assert pos.move('O-O').fen() == 'r3k2r/8/8/8/8/8/8/R4RK1 b kq - 1 1'
+    assert pos.move('O-O-O').move('O-O').fen() == 'r4rk1/8/8/8/8/8/8/2KR3R w - - 2 2'
+
+
+def test_cannot_castle_through_check():
+    pos = Position('r3k2r/8/8/8/8/8/5r2/R3K2R w KQkq - 0 1')
+    with pytest.raises(Exception) as excinfo:
+        pos.move('O-O')
+    assert 'Illegal move' in str(excinfo.value)
+
+
+def test_rook_capture_removes_castling_availability():
+    pos = Position('r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1')
+    assert pos.move('Rxh8+').fen() == 'r3k2R/8/8/8/8/8/8/R3K3 b Qq - 0 1'
+
+
+def test_promotion():
+    pos = Position('3qk3/P7/8/8/8/8/7p/3QK3 w - - 0 1')
+    assert pos.move('a8=N').fen() == 'N2qk3/8/8/8/8/8/7p/3QK3 b - - 0 1'
+
+
+def test_push_pop_restores_position():
+    fens = ['r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1',
+            'r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1',
+            'rnbqkbnr/1pp1pppp/8/p2pP3/8/P7/1PPP1PPP/RNBQKBNR w KQkq d6 0 4']
+    for fen in fens:
+        pos = Position(fen)
+        for move in pos.legal_moves():
+            pos.push(move)
+            for reply in pos.legal_moves():
+                pos.push(reply)
+                assert pos.pop() == reply
+            assert pos.pop() == move
+            assert pos.fen() == fen
+            assert pos._bitboards == Position(fen)._bitboards
+            assert (pos._white, pos._black) == (Position(fen)._white, Position(fen)._black)
+
+
+def test_push_matches_move():
+    pos = Position('r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1')
+    expected = pos.move('O-O-O').fen()
+    pos.push(Move.from_uci('e1c1'))
+    assert pos.fen() == expected
+
+
+def test_zobrist_incremental_matches_from_scratch():
+    rng = random.Random(1)
+    for _ in range(20):
+        pos = Position()
+        keys = [pos.zobrist_key()]
+        for _ in range(60):
+            moves = pos.legal_moves()
+            if not moves:
+                break
+            pos.push(rng.choice(moves))
+            assert pos.zobrist_key() == pos._compute_zobrist() == Position(pos.fen()).zobrist_key()
+            keys.append(pos.zobrist_key())
+        while pos._stack:
+            assert keys.pop() == pos.zobrist_key()
+            pos.pop()
+        assert pos.zobrist_key() == keys.pop()
+
+
+def test_positions_are_hashable():
+    positions = {Position(), Position(), Position().move('e4'), Position(FEN_AFTER_E4)}
+    assert len(positions) == 2
+    assert Position(FEN_AFTER_E4) in positions
+
+
+def test_zobrist_key_transposition():
+    pos = Position().move('Nf3').move('Nc6').move('e3')
+    assert pos.zobrist_key() == Position().move('e3').move('Nc6').move('Nf3').zobrist_key()
+    assert pos.zobrist_key() != Position().move('e4').move('Nc6').move('Nf3').zobrist_key()
+
+
+def test_equal_keys_differing_clocks():
+    pos = Position()
+    other = Position('rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 4 3')
+    assert pos.zobrist_key() == other.zobrist_key()
+    assert pos != other
+
+
+def test_attack_queries_agree():
+    for position in _random_game_positions(23, games=3):
+        for color in Color:
+            reverse = {name for name in deepes.SQUARE_NAMES if position.is_square_attacked(name, color)}
+            assert {deepes.SQUARE_NAMES[sq] for sq in range(64) if position.is_attacked(sq, color)} == reverse
+            assert position.attacked_squares(color) == reverse
+            assert {deepes.SQUARE_NAMES[sq] for sq in range(64) if position.attack_map(color) >> sq & 1} == reverse
+            # answered from the attack map now that it is cached
+            assert {name for name in deepes.SQUARE_NAMES if position.is_square_attacked(name, color)} == reverse
+            for name in reverse:
+                attackers = position.attackers_of(name, color)
+                assert attackers
+                assert all(position._look_sq(sq).isupper() == (color == Color.WHITE) for sq in attackers)
+        assert position.in_check() == position._in_check()
+
+
+def test_attackers_of():
+    position = Position('r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1')
+    assert position.attackers_of('d5', Color.WHITE) == {'c3', 'e4'}
+    assert position.attackers_of('d5', Color.BLACK) == {'b6', 'f6', 'e6'}
+    assert position.attackers_of('g2', Color.BLACK) == {'h3'}
+    assert position.attackers_of('a1', Color.BLACK) == frozenset()
+
+
+def test_in_check_either_color():
+    position = Position('4k3/8/8/8/8/8/8/4K2r w - - 0 1')
+    assert position.in_check() and position.in_check(Color.WHITE)
+    assert not position.in_check(Color.BLACK)
+
+
+def test_attack_maps_follow_moves():
+    position = Position()
+    assert not position.is_square_attacked('a3', Color.BLACK)
+    before = position.attacked_squares(Color.WHITE)
+    position.push(Move.from_uci('e2e4'))
+    # the pawn attacks d5 and f5, and it opened lines for the bishop and the queen
+    assert position.attacked_squares(Color.WHITE) - before == {'d5', 'f5', 'a6', 'b5', 'c4', 'g4', 'h5'}
+    assert position.is_square_attacked('h5', Color.WHITE)
+    position.pop()
+    assert position.attacked_squares(Color.WHITE) == before
+
+
+def test_transposition_table_size():
+    tt = TranspositionTable(size_mb=1)
+    assert len(tt) == 2 ** 20 // 16
+    assert tt._keys.itemsize * len(tt._keys) + tt._data.itemsize * len(tt._data) == 2 ** 20
+
+
+def test_transposition_table_store_probe():
+    tt = TranspositionTable(size_mb=0.01)
+    move = Move.from_uci('e7e8q')
+    tt.store(12345, 7, Bound.LOWER, -31000, move)
+    assert tt.probe(12345) == (7, Bound.LOWER, -31000, move)
+    assert tt.probe(12345 + len(tt)) is None
+    assert tt.probe(54321) is None
+    assert (tt.hits, tt.misses, tt.collisions) == (1, 2, 1)
+    # storing without a move keeps the move of the earlier entry for the same key
+    tt.store(12345, 8, Bound.EXACT, 10)
+    assert tt.probe(12345).move == move
+
+
+@pytest.mark.parametrize('replacement,kept', [
+    (Replacement.ALWAYS, False),
+    (Replacement.DEPTH_PREFERRED, True),
+    (Replacement.TWO_TIER, True),
+])
+def test_transposition_table_replacement(replacement, kept):
+    tt = TranspositionTable(size_mb=0.01, replacement=replacement)
+    buckets = len(tt) // 2 if replacement == Replacement.TWO_TIER else len(tt)
+    deep, shallow = 5, 5 + buckets
+    tt.store(deep, 10, Bound.EXACT, 1)
+    tt.store(shallow, 2, Bound.EXACT, 2)
+    assert (tt.probe(deep) is not None) == kept
+    assert (tt.probe(shallow) is not None) == (replacement != Replacement.DEPTH_PREFERRED)
+    # entries from an earlier search are replaced regardless of depth
+    tt.new_search()
+    tt.store(shallow + buckets, 1, Bound.UPPER, 3)
+    assert tt.probe(shallow + buckets) is not None
+
+
+def _store_in_table(tt):
+    tt.store(12345, 3, Bound.EXACT, 42, Move.from_uci('e2e4'))
+
+
+def test_transposition_table_shared_between_processes():
+    import multiprocessing
+    tt = TranspositionTable(size_mb=0.01, shared=True)
+    process = multiprocessing.Process(target=_store_in_table, args=(tt,))
+    process.start()
+    process.join()
+    assert tt.probe(12345) == (3, Bound.EXACT, 42, Move.from_uci('e2e4'))
+    tt.clear()
+    assert tt.probe(12345) is None
+
+
+def test_transposition_table_rejects_torn_entries():
+    tt = TranspositionTable(size_mb=0.01)
+    _store_in_table(tt)
+    # the data word of another write with the key of this one, as when two processes write a slot at once
+    tt._data[12345 % len(tt)] ^= 1 << 16
+    assert tt.probe(12345) is None
+
+
+def test_evaluate_symmetric():
+    assert evaluate(Position()) == 0
+    pos = Position('rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq e3 0 1')
+    assert evaluate(pos) == evaluate(Position('rnbqkbnr/pppp1ppp/8/4p3/8/8/PPPPPPPP/RNBQKBNR w KQkq e6 0 1')) < 0
+
+
+def test_search_finds_mate():
+    result = Searcher().search(Position('r1bqkb1r/pppp1ppp/2n2n2/4p2Q/2B1P3/8/PPPP1PPP/RNB1K1NR w KQkq - 4 4'),
+                               max_depth=3)
+    assert result.move.uci() == 'h5f7'
+    assert result.score == MATE_SCORE - 1
+
+
+def test_search_wins_material():
+    result = Searcher().search(Position('4k3/8/8/3q4/8/8/3R4/3K4 w - - 0 1'), max_depth=2)
+    assert result.move.uci() == 'd2d5'
+
+
+def test_search_no_legal_moves():
+    assert Searcher().search(Position('7k/5Q2/6K1/8/8/8/8/8 b - - 0 1')).move is None
+    assert Searcher().search(Position('7k/6Q1/6K1/8/8/8/8/8 b - - 0 1')).score == -MATE_SCORE
+
+
+def test_staged_moves_are_the_legal_moves():
+    pos = Position('r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1')
+    tt_move, killer = Move.from_uci('e1g1'), Move.from_uci('a2a3')
+    moves = pos.staged_moves(tt_move, killers=[killer, Move.from_uci('e2e4')])  # e2e4 is not legal here
+    staged = []
+    for move in moves:
+        staged.append((moves.stage, move))
+    assert sorted(move for _, move in staged) == sorted(pos.legal_moves())
+    assert staged[0] == ('tt', tt_move)
+    assert staged[1] == ('tactical', Move.from_uci('e2a6'))  # bishop takes bishop before queen takes pawn
+    stages = [stage for stage, _ in staged]
+    assert stages == sorted(stages, key=['tt', 'tactical', 'killers', 'quiet'].index)
+    assert [move for stage, move in staged if stage == 'killers'] == [killer]
+    assert moves.generated == len(staged)  # the tt move and the killer are counted once
+
+
+def test_staged_moves_in_check_and_without_quiets():
+    pos = Position('rnbqkbnr/ppp2ppp/3p4/1B2p3/4P3/8/PPPP1PPP/RNBQK1NR b KQkq - 1 3')
+    assert sorted(pos.staged_moves(Move.from_uci('g8f6'))) == sorted(pos.legal_moves())
+    pos = Position('4k3/1P6/8/3p4/4P3/8/8/4K3 w - - 0 1')
+    assert [m.uci() for m in pos.staged_moves(quiets=False)] == ['e4d5', 'b7b8q', 'b7b8r', 'b7b8b', 'b7b8n']
+
+
+def test_is_legal_code():
+    for fen in ('r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1',
+                '8/8/8/K2pP2r/8/8/8/7k w - d6 0 1', 'rnbqkbnr/ppp2ppp/3p4/1B2p3/4P3/8/PPPP1PPP/RNBQK1NR b KQkq - 1 3'):
+        pos = Position(fen)
+        legal = set(pos._legal_move_codes())
+        assert {code for code in range(1, len(deepes.MOVES_BY_CODE)) if pos._is_legal_code(code)} == legal
+
+
+def test_search_staged_and_all_at_once_agree():
+    pos = Position('r1bqkb1r/pppp1ppp/2n2n2/4p2Q/2B1P3/8/PPPP1PPP/RNB1K1NR w KQkq - 4 4')
+    staged, eager = Searcher(staged=True), Searcher(staged=False)
+    assert staged.search(pos, max_depth=3).move == eager.search(pos, max_depth=3).move
+    assert 0 < staged.stats()['moves_per_node'] < eager.stats()['moves_per_node']
+    assert staged.stats()['cutoffs'] > 0 and 0 < staged.stats()['first_move_cutoff_rate'] <= 1
+
+
+def test_search_counts_root_moves():
+    for staged in (True, False):
+        searcher = Searcher(staged=staged)
+        searcher.search(Position(), max_depth=1)
+        assert searcher.stats()['moves_generated'] >= 20
+
+
+def test_repetition():
+    pos = Position()
+    for uci in ('g1f3', 'g8f6', 'f3g1'):
+        pos.push(Move.from_uci(uci))
+        assert not deepes._is_repetition(pos)
+    pos.push(Move.from_uci('f6g8'))
+    assert deepes._is_repetition(pos)
+
+
+def test_search_scores_repetition_as_draw():
+    pos = Position('4k3/8/8/8/8/8/8/Q3K3 w - - 0 1')
+    for uci in ('a1a2', 'e8d8', 'a2a1', 'd8e8'):
+        pos.push(Move.from_uci(uci))
+    assert evaluate(pos) > 0
+    assert Searcher()._negamax(pos, 2, -MATE_SCORE, MATE_SCORE, 1) == 0
+
+
+def test_search_node_budget():
+    result = Searcher().search(Position(), max_nodes=500)
+    assert result.nodes <= 500
+    assert result.move in Position().legal_moves()
+
+
+def test_search_time_budget():
+    result = Searcher().search(Position(), time_limit=0.2)
+    assert result.seconds < 0.5
+    assert result.move in Position().legal_moves()
+
+
+def test_search_reports_iterations():
+    depths = []
+    Searcher().search(Position(), max_depth=3, info=lambda r: depths.append(r.depth))
+    assert depths == [1, 2, 3]
+
+
+def test_parallel_search():
+    position = Position('r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1')
+    with ParallelSearcher(workers=2, tt_size_mb=1) as searcher:
+        result = searcher.search(position, max_depth=2)
+        assert result.move in position.legal_moves()
+        assert result.depth == 2
+        assert 0 < searcher.helper_nodes < result.nodes
+        # the helpers wait for the next search
+        assert searcher.search(Position('7k/8/5KQ1/8/8/8/8/8 w - - 0 1'), max_depth=2).score == MATE_SCORE - 1
+    assert not searcher._helpers
+
+
+def test_parallel_search_survives_failing_helpers():
+    with ParallelSearcher(workers=3, tt_size_mb=1) as searcher:
+        searcher.search(Position(), max_depth=1)
+        # a helper that raises still answers
+        with pytest.raises(ValueError):
+            searcher.search(Position('8/8/8/8/8/8/8/7k w - - 0 1'), max_depth=2)
+        assert len(searcher.helper_errors) == 2
+        # a helper that dies is dropped
+        searcher._helpers[0][0].terminate()
+        searcher._helpers[0][0].join()
+        result = searcher.search(Position(), max_depth=2)
+        assert result.move in Position().legal_moves()
+        assert searcher.helper_errors == ['helper process exited with code -15'] and len(searcher._helpers) == 1
+
+
+def test_parallel_search_single_worker():
+    searcher = ParallelSearcher(workers=1, tt_size_mb=1)
+    assert searcher.search(Position(), max_depth=2).nodes == Searcher(tt_size_mb=1).search(Position(), 2).nodes
+    assert searcher.helper_nodes == 0 and not searcher._helpers
+
+
+def test_uci_session_through_pipes():
+    session = dedent('''
+        uci
+        setoption name Hash value 1
+        isready
+        ucinewgame
+        position startpos moves e2e4 e7e5 f1c4 b8c6 d1h5 g8f6
+        go depth 2
+        position fen 4k3/8/8/3q4/8/8/3R4/3K4 w - - 0 1
+        go nodes 2000
+        quit
+    ''')
+    completed = subprocess.run([sys.executable, '-m', 'deepes', 'uci'], input=session, capture_output=True,
+                               text=True, cwd=os.path.dirname(os.path.abspath(__file__)), timeout=60)
+    lines = completed.stdout.splitlines()
+    assert 'uciok' in lines
+    assert 'readyok' in lines
+    assert [line for line in lines if line.startswith('bestmove')] == ['bestmove h5f7', 'bestmove d2d5']
+    assert any(line.startswith('info depth 1 score mate 1 ') for line in lines)
+
+
+def test_uci_stop_infinite_search():
+    out = io.StringIO()
+    engine = UCIEngine(io.StringIO(), out)
+    engine.handle('position startpos')
+    engine.handle('go infinite')
+    time.sleep(0.2)
+    engine.handle('stop')
+    bestmoves = [line for line in out.getvalue().splitlines() if line.startswith('bestmove')]
+    assert len(bestmoves) == 1
+    assert Move.from_uci(bestmoves[0].split()[1]) in Position().legal_moves()
+
+
+def test_uci_illegal_move_in_position():
+    out = io.StringIO()
+    engine = UCIEngine(io.StringIO(), out)
+    engine.handle('position startpos moves e2e4 e2e4')
+    assert 'info string illegal move e2e4' in out.getvalue()
+    assert engine.position == Position().move('e4')
+
+
+def test_uci_position_without_startpos_or_fen():
+    out = io.StringIO()
+    engine = UCIEngine(io.StringIO(), out)
+    assert engine.handle('position moves e2e4')
+    assert out.getvalue() == 'info string expected startpos or fen\n'
+    assert engine.position == Position()
+
+
+@pytest.mark.parametrize('command', ['position startpos moves zz99', 'go wtime abc', 'setoption name Hash value x',
+                                     'position fen 8/8/8/8/8/8/8/K8k w - - 0 1',
+                                     'position fen 8/8/8/8/8/8/8/8 w - - 0 1', 'go depth', 'go depth 0'])
+def test_uci_malformed_command(command):
+    out = io.StringIO()
+    engine = UCIEngine(io.StringIO(), out)
+    assert engine.handle(command)
+    assert 'info string error in {}'.format(command.split()[0]) in out.getvalue()
+    engine.handle('isready')
+    assert out.getvalue().endswith('readyok\n')
+    assert engine.position == Position()
+
+
+def test_uci_failed_search_still_answers_bestmove(monkeypatch):
+    out = io.StringIO()
+    engine = UCIEngine(io.StringIO(), out)
+
+    def fail(*args, **kwargs):
+        raise ValueError('broken')
+
+    monkeypatch.setattr(engine.searcher, 'search', fail)
+    engine.handle('go depth 2')
+    engine.handle('isready')
+    assert out.getvalue().splitlines()[-3:] == ['info string error in search: broken', 'bestmove 0000', 'readyok']
+
+
+def test_search_depth_zero_searches_one_ply():
+    assert Searcher().search(Position(), max_depth=0).depth == 1
+
+
+def _exchange(lines, **server_options):
+    """Send the lines to an analysis server on one connection; its responses by id, and its stats"""
+    import asyncio
+    import json
+
+    async def exchange():
+        server = deepes.AnalysisServer(workers=1, **server_options)
+        await server.start()
+        try:
+            reader, writer = await asyncio.open_connection(*server.address)
+            for line in lines:
+                writer.write((line if isinstance(line, str) else json.dumps(line)).encode() + b'\n')
+            writer.write_eof()
+            responses = [json.loads(line) for line in (await reader.read()).splitlines()]
+            writer.close()
+            return {response['id']: response for response in responses}, server.stats
+        finally:
+            await server.close()
+
+    return asyncio.run(exchange())
+
+
+def test_analysis_server_requests():
+    responses, stats = _exchange([
+        {'id': 1, 'op': 'moves', 'fen': 'startpos', 'moves': ['e2e4']},
+        {'id': 2, 'op': 'evaluate', 'fen': FEN_AFTER_E4},
+        {'id': 3, 'op': 'search', 'fen': 'r1bqkb1r/pppp1ppp/2n2n2/4p2Q/2B1P3/8/PPPP1PPP/RNB1K1NR w KQkq - 4 4',
+         'depth': 3},
+        {'id': 4, 'moves': ['e2e5']},
+        {'id': 5, 'op': 'perft'},
+        {'id': 6, 'deadline': 'soon'},
+        'not json',
+    ])
+    assert responses[1]['moves'] == [m.uci() for m in Position(FEN_AFTER_E4).legal_moves()]
+    assert responses[2]['score'] == evaluate(Position(FEN_AFTER_E4))
+    assert (responses[3]['bestmove'], responses[3]['score'], responses[3]['pv']) == ('h5f7', MATE_SCORE - 1, ['h5f7'])
+    assert responses[4]['error'] == 'illegal move e2e5'
+    assert 'unknown op' in responses[5]['error']
+    assert responses[6]['error'].startswith('bad request')
+    assert responses[None]['error'].startswith('bad request')
+    assert stats['requests'] == 7 and stats['errors'] == 4
+
+
+def test_analysis_server_batches_requests():
+    responses, stats = _exchange([{'id': i, 'op': 'evaluate', 'moves': ['e2e4']} for i in range(100)],
+                                 max_batch=16, max_pending=8)
+    assert sorted(responses) == list(range(100))
+    assert all(response['score'] == -40 for response in responses.values())
+    assert 100 / 16 <= stats['batches'] < 100
+
+
+def test_analysis_server_deadlines():
+    started = time.perf_counter()
+    responses, stats = _exchange([{'id': 1, 'op': 'search', 'deadline': 300},
+                                  {'id': 2, 'op': 'moves', 'deadline': 0}])
+    assert time.perf_counter() - started < 5
+    assert responses[1]['bestmove'] in [m.uci() for m in Position().legal_moves()]
+    assert responses[2]['error'] == 'deadline exceeded'
+    assert stats['expired'] == 1
+
+
+def test_parse_san_matches_parse_move():
+    for san in ('e4', 'Nf3', 'exd5', 'Rae1', 'R1e2', 'Qh4xe1#', 'dxe8=Q+', 'O-O', '0-0-0'):
+        assert parse_san(san)._asdict() == parse_move(san)
+
+
+def test_common_san_records_match_the_pattern():
+    for san, record in deepes._COMMON_SAN_RECORDS.items():
+        piece, orig_file, orig_rank, capture, target, promote, suffix = deepes._SAN_PATTERN.match(san).groups()
+        assert record == (piece or 'P', orig_rank, orig_file, capture is not None, target, None, suffix == '+',
+                          suffix == '#', promote)
+
+
+def test_parse_san_castling_with_check():
+    assert parse_san('O-O+').castle == 'kingside'
+    assert parse_san('O-O+').check
+    assert parse_san('O-O-O#').checkmate
+    with pytest.raises(ValueError):
+        parse_san('O-O++')
+
+
+@pytest.mark.parametrize('san', ['', 'xd4', '4e5', 'Nz5', 'e8Q', 'Ne4x', 'Kxx'])
+def test_parse_san_rejects(san):
+    with pytest.raises(ValueError):
+        parse_san(san)
+
+
+def test_parse_moves():
+    parsed = parse_moves(iter(['e4', 'e5', 'Nf3', 'e5']))
+    assert [p.target for p in parsed] == ['e4', 'e5', 'f3', 'e5']
+    assert parsed[1] is parsed[3]
+
+
+PGN_GAMES = dedent('''
+    [Event "Casual game"]
+    [White "Anderssen, Adolf"]
+    [Black "Kieseritzky, Lionel"]
+    [Result "1-0"]
+
+    1. e4 e5 2. f4 exf4 3. Bc4 Qh4+ 4. Kf1 b5 5. Bxb5 Nf6 6. Nf3 Qh6 7. d3 Nh5 8. Nh4 Qg5
+    9. Nf5 c6 10. g4 Nf6 11. Rg1 cxb5 12. h4 Qg6 13. h5 Qg5 14. Qf3 Ng8 15. Bxf4 Qf6
+    16. Nc3 Bc5 17. Nd5 Qxb2 18. Bd6 Bxg1 19. e5 Qxa1+ 20. Ke2 Na6 21. Nxg7+ Kd8
+    22. Qf6+ Nxf6 23. Be7# 1-0
+
+    [Event "Annotated"]
+    [White "A \\"the rook\\" B"]
+    [Black "C"]
+    [Result "1/2-1/2"]
+
+    1. e4 $1 {A comment (with parentheses)} 1... c5 (1... e5 2. Nf3 (2. f4) Nc6) 2. Nf3!? d6 ; rest of line
+    3. d4 cxd4 4. Nxd4 Nf6 5. Nc3 a6 6. Be3 e5 7. Nb3 Be6 8. f3 Be7 9. Qd2 O-O 10. O-O-O 1/2-1/2
+
+    [Event "Set up"]
+    [SetUp "1"]
+    [FEN "4k3/1P6/8/8/8/8/8/4K2R w K - 0 1"]
+
+    1. b8=Q+ Kd7 2. O-O *
+''').lstrip()
+
+
+def test_read_games():
+    games = list(read_games(io.StringIO(PGN_GAMES)))
+    assert len(games) == 3
+    assert games[0].tags['White'] == 'Anderssen, Adolf'
+    assert games[1].tags['White'] == 'A "the rook" B'
+    assert [g.result for g in games] == ['1-0', '1/2-1/2', '*']
+
+
+def test_pgn_moves_main_line_only():
+    game = list(read_games(io.StringIO(PGN_GAMES)))[1]
+    assert game.moves()[:6] == ['e4', 'c5', 'Nf3', 'd6', 'd4', 'cxd4']
+    assert game.moves()[-1] == 'O-O-O'
+
+
+def test_pgn_replay():
+    immortal, sicilian, set_up = read_games(io.StringIO(PGN_GAMES))
+    fens = list(immortal.fens())
+    assert len(fens) == 45
+    assert fens[-1] == 'r1bk3r/p2pBpNp/n4n2/1p1NP2P/6P1/3P4/P1P1K3/q5b1 b - - 1 23'
+    positions = list(set_up.positions())
+    assert positions[0].fen() == '1Q2k3/8/8/8/8/8/8/4K2R b K - 0 1'
+    assert positions[-1].fen() == '1Q6/3k4/8/8/8/8/8/5RK1 b - - 2 2'
+    assert len(list(sicilian.positions())) == 19
+
+
+def test_read_games_from_path_and_bytes(tmp_path):
+    path = tmp_path / 'games.pgn'
+    path.write_text(PGN_GAMES)
+    assert [g.tags['Event'] for g in read_games(str(path))] == ['Casual game', 'Annotated', 'Set up']
+    assert [g.tags['Event'] for g in read_games(PGN_GAMES.encode())] == ['Casual game', 'Annotated', 'Set up']
+    empty = tmp_path / 'empty.pgn'
+    empty.write_text('')
+    assert list(read_games(str(empty))) == []
+
+
+def test_corpus_chunks_cut_at_game_boundaries(tmp_path):
+    path = tmp_path / 'games.pgn'
+    path.write_text('\n'.join([PGN_GAMES] * 5))
+    chunks = deepes.corpus_chunks(str(path), 'pgn', chunk_bytes=300)
+    assert len(chunks) > 1
+    data = path.read_bytes()
+    assert b''.join(data[start:end] for start, end in chunks) == data
+    assert all(data[start:start + 1] == b'[' for start, end in chunks)
+
+
+def test_process_corpus_pgn_in_order(tmp_path):
+    path = tmp_path / 'games.pgn'
+    path.write_text('\n'.join([PGN_GAMES] * 4))
+    processor = CorpusProcessor(workers=2, chunk_bytes=500)
+    assert list(processor.map(str(path), deepes.replay_game)) == [45, 19, 3] * 4
+    assert sum(s.items for s in processor.worker_stats.values()) == 12
+    assert 'total: 12 items' in processor.report()
+
+
+def test_process_corpus_fen(tmp_path):
+    path = tmp_path / 'positions.fen'
+    path.write_text('\n'.join([STARTING_FEN, '8/8/8/8/8/8/8/K5Qk w - - 0 1', '', FEN_AFTER_E4, 'nonsense']) + '\n')
+    results = list(CorpusProcessor(workers=1, chunk_bytes=40).map(str(path)))
+    assert results == [None, 'side not to move is in check', None, 'expected 6 fields']
+
+
+def test_positions_from_the_same_fen_are_independent():
+    fen = 'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1'
+    a = Position(fen)
+    b = Position(fen)
+    a.push(Move.from_uci('e1g1'))
+    assert b.fen() == fen
+    assert Position(fen).fen() == fen
+    assert a.fen() == 'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R4RK1 b kq - 1 1'
+    hash(deepes._parse_fen(fen))  # the cache holds immutable fields, not positions that could be changed
+
+
+def test_fen_follows_push_and_pop():
+    p = Position()
+    start = p.fen()
+    p.push(Move.from_uci('e2e4'))
+    assert p.fen() == 'rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq e3 0 1'
+    p.pop()
+    assert p.fen() == start
+
+
+def test_fen_round_trip_over_random_games():
+    rng = random.Random(3)
+    for _ in range(5):
+        p = Position()
+        for _ in range(60):
+            moves = sorted(p.legal_moves(), key=Move.uci)
+            if not moves:
+                break
+            p.push(rng.choice(moves))
+            q = Position(p.fen())
+            assert q.fen() == p.fen()
+            assert q == p
+            assert q.zobrist_key() == p.zobrist_key()
+
+
+def test_from_fens():
+    lines = io.StringIO('8/8/8/8/8/8/8/K6k w - - 0 1\n\nrnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1\n')
+    positions = Position.from_fens(lines)
+    assert [p.fen() for p in positions] == ['8/8/8/8/8/8/8/K6k w - - 0 1', Position().fen()]
+
+
+@pytest.mark.parametrize('fen', ['8/8/8/8/8/8/8/K7k w - - 0 1', '8/8/8/8/8/8/8/K5k w - - 0 1',
+                                 '8/8/8/8/8/8/K6k w - - 0 1', '8/8/8/8/8/8/8/8/K6k w - - 0 1'])
+def test_fen_with_bad_placement_raises_value_error(fen):
+    with pytest.raises(ValueError):
+        Position(fen)
+
+
+def _random_game_positions(seed, games=5, plies=80):
+    rng = random.Random(seed)
+    positions = []
+    for _ in range(games):
+        p = Position()
+        for _ in range(plies):
+            moves = sorted(p.legal_moves(), key=Move.uci)
+            if not moves:
+                break
+            p.push(rng.choice(moves))
+            positions.append(p.copy())
+    return positions
+
+
+def test_to_bytes_round_trip():
+    fens = ['r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1',
+            'rnbqkbnr/ppp1p1pp/8/3pPp2/8/8/PPPP1PPP/RNBQKBNR w KQkq f6 0 3',
+            'rnbqkbnr/pppp1ppp/8/8/3Pp3/8/PPP1PPPP/RNBQKBNR b Kq d3 0 3',
+            '8/8/8/8/8/8/8/K6k b - - 99 1234']
+    for fen in fens:
+        data = Position(fen).to_bytes()
+        assert len(data) == POSITION_BYTES == 32
+        assert Position.from_bytes(data).fen() == fen
+        assert Position.from_bytes(data) == Position(fen)
+    for p in _random_game_positions(seed=4):
+        q = Position.from_bytes(p.to_bytes())
+        assert q.fen() == p.fen()
+        assert q.zobrist_key() == p.zobrist_key()
+
+
+def test_to_bytes_rejects_what_it_cannot_encode():
+    with pytest.raises(ValueError):
+        Position('QQQQQQQQ/QQQQQQQQ/QQQQQQQQ/QQQQQQQQ/QQQQQQQQ/8/8/K6k w - - 0 1').to_bytes()
+    with pytest.raises(ValueError):
+        Position.from_bytes(bytes(31))
+
+
+def test_pack_and_unpack_positions():
+    positions = _random_game_positions(seed=5)
+    buffer = pack_positions(positions)
+    assert len(buffer) == POSITION_BYTES * len(positions)
+    assert [p.fen() for p in unpack_positions(buffer)] == [p.fen() for p in positions]
+    assert [p.fen() for p in unpack_positions(memoryview(buffer)[POSITION_BYTES:2 * POSITION_BYTES])] == \
+        [positions[1].fen()]
+    assert list(unpack_positions(pack_positions([]))) == []
+    with pytest.raises(ValueError):
+        list(unpack_positions(buffer[:-1]))
+
+
+def test_position_array():
+    pytest.importorskip('numpy')
+    positions = [Position(), Position().move('e4')]
+    array = position_array(pack_positions(positions))
+    assert len(array) == 2
+    assert int(array['occupied'][0]) == 0xffff00000000ffff
+    assert list(array['state'] & 1) == [0, 1]
+    assert Position.from_bytes(array[1].tobytes()).fen() == positions[1].fen()
+
+
+def test_incremental_evaluation_matches_recomputation(monkeypatch):
+    monkeypatch.setattr(deepes, 'DEBUG_EVALUATION', True)
+    rng = random.Random(20)
+    for _ in range(10):
+        position = Position()
+        scores = []
+        for _ in range(120):
+            moves = sorted(position.legal_moves(), key=Move.uci)
+            if not moves:
+                break
+            scores.append(evaluate(position))
+            position.push(rng.choice(moves))
+            assert position._score == deepes._evaluate_from_scratch(position)
+            assert position.pawn_key() == position._compute_pawn_key()
+        while scores:
+            position.pop()
+            assert evaluate(position) == scores.pop()
+
+
+def test_debug_evaluation_detects_drift(monkeypatch):
+    monkeypatch.setattr(deepes, 'DEBUG_EVALUATION', True)
+    position = Position()
+    position._score += 1
+    with pytest.raises(AssertionError):
+        evaluate(position)
+
+
+@pytest.mark.parametrize('fen,score', [
+    ('4k3/8/8/8/8/8/PPPPPPPP/4K3 w - - 0 1', 8 * 5),  # all passed, on the second rank
+    ('4k3/pppppppp/8/8/8/8/PPPPPPPP/4K3 w - - 0 1', 0),
+    ('4k3/8/8/8/8/P1P5/P1P5/4K3 w - - 0 1', 2 * (-10 - 2 * 15) + 2 * 10 + 2 * 5),  # doubled, isolated, passed
+    ('4k3/8/8/3p4/4P3/8/8/4K3 w - - 0 1', 0),  # both isolated, neither passed
+    ('4k3/8/8/8/3p4/8/8/4K3 w - - 0 1', 15 - 35),  # isolated and passed on its fifth rank
+    ('4k3/1P6/8/8/8/8/6p1/4K3 w - - 0 1', 0),
+    ('4k3/8/p7/1P6/8/8/8/4K3 w - - 0 1', 0),  # neither is passed
+])
+def test_evaluate_pawns(fen, score):
+    position = Position(fen)
+    assert deepes.evaluate_pawns(position._bitboards['P'], position._bitboards['p']) == score
+
+
+def test_pawn_hash_table_caches_pawn_structure():
+    table = deepes.PawnHashTable(size_mb=0)
+    assert len(table) == 1
+    positions = _random_game_positions(21, games=2)
+    for position in positions:
+        assert evaluate(position, table) == evaluate(position)
+    stats = table.stats()
+    assert stats['hits'] + stats['misses'] == len(positions)
+    assert stats['hits'] > 0
+    assert stats['hit_rate'] == stats['hits'] / len(positions)
+    table.clear()
+    assert table.stats()['hits'] == table.stats()['misses'] == 0
+
+
+def test_search_hits_pawn_hash_table():
+    searcher = Searcher()
+    searcher.search(Position(), max_depth=3)
+    assert searcher.pawn_table.stats()['hit_rate'] > 0.5
+    assert Searcher(pawn_table=searcher.pawn_table).pawn_table is searcher.pawn_table
+
+
+def test_uci_pawn_hash_option():
+    engine = UCIEngine(io.StringIO(), io.StringIO())
+    engine.handle('setoption name PawnHash value 2')
+    assert len(engine.searcher.pawn_table) == 2 * 2 ** 20 // deepes.PawnHashTable.ENTRY_BYTES
+    pawn_table = engine.searcher.pawn_table
+    engine.handle('setoption name Hash value 1')
+    engine.handle('ucinewgame')
+    assert engine.searcher.pawn_table is pawn_table
+
+
+def test_uci_threads_option():
+    session = dedent('''
+        setoption name Threads value 2
+        position startpos moves e2e4
+        go depth 2
+    ''')
+    out = io.StringIO()
+    engine = UCIEngine(io.StringIO(session), out)
+    pawn_table = engine.searcher.pawn_table
+    engine.run()
+    assert isinstance(engine.searcher, ParallelSearcher)
+    assert engine.searcher.workers == 2
+    assert engine.searcher.pawn_table is pawn_table
+    assert not engine.searcher._helpers  # closed at the end of the input
+    assert out.getvalue().splitlines()[-1].startswith('bestmove ')
+
+
+def test_uci_debug_checks_evaluation(monkeypatch):
+    monkeypatch.setattr(deepes, 'DEBUG_EVALUATION', False)
+    engine = UCIEngine(io.StringIO(), io.StringIO())
+    engine.handle('debug on')
+    assert deepes.DEBUG_EVALUATION
+    engine.handle('debug off')
+    assert not deepes.DEBUG_EVALUATION
+
+
+def test_evaluate_batch_matches_evaluate():
+    pytest.importorskip('numpy')
+    positions = _random_game_positions(18)
+    expected = [evaluate(p) for p in positions]
+    assert evaluate_batch(positions).tolist() == expected
+    assert evaluate_batch(pack_positions(positions)).tolist() == expected
+    assert evaluate_batch(position_array(pack_positions(positions))).tolist() == expected
+    assert evaluate_batch([]).tolist() == []
+
+
+def test_position_tensor():
+    pytest.importorskip('numpy')
+    positions = _random_game_positions(19, games=2)
+    tensor = position_tensor(positions)
+    assert tensor.shape == (len(positions), 12, 64)
+    assert (position_tensor(pack_positions(positions)) == tensor).all()
+    for position, planes in zip(positions, tensor):
+        for code, char in enumerate(deepes.PIECE_CHARS):
+            assert [sq for sq in range(64) if planes[code, sq]] == list(deepes._iter_bits(position._bitboards[char]))
+
+
+def test_position_db_build(tmp_path):
+    games = list(read_games(io.StringIO(PGN_GAMES)))
+    with PositionDB.build(tmp_path / 'positions.db', games, score=evaluate) as db:
+        start = db[Position()]
+        assert (start.games, start.white_wins, start.draws, start.black_wins) == (2, 1, 1, 0)
+        assert start.best_move == Move.from_uci('e2e4')
+        assert start.score == evaluate(Position())
+        after_e4 = db.get(Position().move('e4'))
+        assert after_e4.games == 2
+        assert after_e4.best_move in (Move.from_uci('e7e5'), Move.from_uci('c7c5'))
+        final = db[Position(list(games[0].fens())[-1])]
+        assert (final.games, final.white_wins, final.best_move) == (1, 1, None)
+        assert Position().move('a3') not in db
+        assert db.get(Position().move('a3')) is None
+        with pytest.raises(KeyError):
+            db[Position().move('a3')]
+        assert len(db) == len({p.zobrist_key() for g in games for p in [g.starting_position(), *g.positions()]})
+
+
+def test_position_db_max_plies(tmp_path):
+    games = read_games(io.StringIO(PGN_GAMES))
+    with PositionDB.build(tmp_path / 'positions.db', games, max_plies=2) as db:
+        assert db[Position().move('e4')].best_move in (Move.from_uci('e7e5'), Move.from_uci('c7c5'))
+        assert Position().move('e4').move('e5') not in db
+
+
+def test_position_db_write_and_probe_every_key(tmp_path):
+    rng = random.Random(6)
+    # keys sharing their low bits all land in the same slot and must be found by probing past each other
+    keys = [rng.getrandbits(48) << 16 for _ in range(200)] + [rng.getrandbits(64) for _ in range(1000)]
+    records = {key: PositionRecord(i + 1, i, 0, 1, Move(i % 64, (i + 1) % 64, None), i - 600 if i % 2 else None)
+               for i, key in enumerate(keys)}
+    PositionDB.write(tmp_path / 'keys.db', records)
+    with PositionDB(tmp_path / 'keys.db') as db:
+        assert len(db) == len(records)
+        for key, record in records.items():
+            assert db.get(key) == record
+        assert db.get(rng.getrandbits(64)) is None
+
+
+def test_position_db_rejects_other_files(tmp_path):
+    for content in (b'', b'not a position database' * 4):
+        path = tmp_path / 'other.db'
+        path.write_bytes(content)
+        with pytest.raises(ValueError):
+            PositionDB(path)
+
+
+def test_polyglot_key_reference_values():
+    # from the Polyglot book format description
+    expected = [([], 0x463b96181691fc9c),
+                (['e2e4'], 0x823c9b50fd114196),
+                (['e2e4', 'd7d5'], 0x0756b94461c50fb0),
+                (['e2e4', 'd7d5', 'e4e5'], 0x662fafb965db29d4),
+                (['e2e4', 'd7d5', 'e4e5', 'f7f5'], 0x22a48b5a8e47ff78),
+                (['e2e4', 'd7d5', 'e4e5', 'f7f5', 'e1e2'], 0x652a607ca3f242c1),
+                (['e2e4', 'd7d5', 'e4e5', 'f7f5', 'e1e2', 'e8f7'], 0x00fdd303c946bdd9),
+                (['a2a4', 'b7b5', 'h2h4', 'b5b4', 'c2c4'], 0x3c8123ea7b067637),
+                (['a2a4', 'b7b5', 'h2h4', 'b5b4', 'c2c4', 'b4c3', 'a1a3'], 0x5c3f9b829b279560)]
+    for moves, key in expected:
+        p = Position()
+        for uci in moves:
+            p.push(Move.from_uci(uci))
+        assert polyglot_key(p) == key
+
+
+def test_opening_book_build_and_probe(tmp_path):
+    games = list(read_games(io.StringIO(PGN_GAMES)))
+    with OpeningBook.build(tmp_path / 'book.bin', games, max_plies=30) as book:
+        assert [(entry.move.uci(), entry.weight) for entry in book.entries(Position())] == [('e2e4', 2)]
+        assert book.best_move(Position()) == Move.from_uci('e2e4')
+        assert book.best_move(Position().move('a3')) is None
+        assert book.weighted_move(Position().move('a3')) is None
+        after_e4 = Position().move('e4')
+        assert {entry.move.uci() for entry in book.entries(after_e4)} == {'e7e5', 'c7c5'}
+        rng = random.Random(7)
+        assert {book.weighted_move(after_e4, rng).uci() for _ in range(50)} == {'e7e5', 'c7c5'}
+        # castling is stored as the king taking its rook and comes back as the king's two-square move
+        position = games[1].starting_position()
+        for san in games[1].moves()[:18]:
+            position = position.move(san)
+        assert book.best_move(position) == Move.from_uci('e1c1')
+
+
+def test_opening_book_write_scales_weights(tmp_path):
+    key = polyglot_key(Position())
+    e2e4, d2d4 = (deepes.encode_polyglot_move(Position(), Move.from_uci(uci)) for uci in ('e2e4', 'd2d4'))
+    OpeningBook.write(tmp_path / 'book.bin', {key: {e2e4: 200000, d2d4: 1}})
+    with OpeningBook(tmp_path / 'book.bin') as book:
+        assert [(entry.move.uci(), entry.weight) for entry in book.entries(Position())] == [('e2e4', 50000),
+                                                                                            ('d2d4', 1)]
+    (tmp_path / 'empty.bin').write_bytes(b'')
+    with OpeningBook(tmp_path / 'empty.bin') as book:
+        assert len(book) == 0
+        assert book.best_move(Position()) is None
+
+
+def test_uci_own_book(tmp_path):
+    path = tmp_path / 'book.bin'
+    OpeningBook.build(path, read_games(io.StringIO(PGN_GAMES))).close()
+    out = io.StringIO()
+    engine = UCIEngine(io.StringIO(), out)
+    engine.handle('setoption name BookFile value {}'.format(path))
+    engine.handle('setoption name OwnBook value true')
+    engine.handle('position startpos moves e2e4 e7e5 f2f4')
+    engine.handle('go wtime 1000 btime 1000')
+    engine.handle('position startpos moves e2e4 e7e5 f2f4 e5f4')
+    engine.handle('go depth 1')
+    engine.handle('quit')
+    lines = out.getvalue().splitlines()
+    assert lines[:2] == ['info string book move', 'bestmove e5f4']
+    assert lines[-1] == 'bestmove f1c4'
+    engine.book.close()
+
+
+@pytest.fixture(scope='module')
+def tablebases(tmp_path_factory):
+    pytest.importorskip('numpy')
+    tablebases = deepes.Tablebases(str(tmp_path_factory.mktemp('tablebases')))
+    tablebases.generate('KPvK')  # and KQvK, KRvK, KBvK and KNvK, which it can turn into
+    yield tablebases
+    tablebases.close()
+
+
+@pytest.mark.parametrize('fen,wdl,dtm', [
+    ('7k/6Q1/6K1/8/8/8/8/8 b - - 0 1', -1, 0),  # checkmated
+    ('7k/5Q2/6K1/8/8/8/8/8 w - - 0 1', 1, 1),
+    ('7k/5Q2/6K1/8/8/8/8/8 b - - 0 1', 0, None),  # stalemated
+    ('8/8/8/8/8/6k1/5q2/7K b - - 0 1', 1, 1),  # in the KQvK table with the colors swapped
+    ('8/8/8/8/8/8/R7/K6k w - - 0 1', 1, 13),
+    ('8/8/8/8/8/8/R7/K6k b - - 0 1', -1, 16),
+    ('8/8/8/8/8/8/7R/K6k b - - 0 1', 0, None),  # Kxh2
+    ('8/8/8/8/8/8/8/KB5k w - - 0 1', 0, None),
+    ('4k3/8/4K3/4P3/8/8/8/8 w - - 0 1', 1, 21),
+    ('8/8/8/8/4k3/8/4P3/4K3 w - - 0 1', 0, None),
+])
+def test_tablebase_probe(tablebases, fen, wdl, dtm):
+    assert tablebases.probe(Position(fen)) == (wdl, dtm)
+
+
+@pytest.mark.parametrize('fen', [
+    '8/8/8/8/8/8/8/KR5k w - - 0 1',  # not in the table: black is in check with white to move
+    '8/8/8/8/8/8/8/R3K2k w Q - 0 1',  # castling rights
+    '8/8/8/8/3pP3/8/8/K6k b - e3 0 1',  # en passant
+    '8/8/8/8/8/8/8/KQR4k w - - 0 1',  # table not generated
+    '8/8/8/8/8/8/8/KQRB3k w - - 0 1',  # too many pieces
+])
+def test_tablebase_probe_misses(tablebases, fen):
+    assert tablebases.probe(Position(fen)) is None
+
+
+def test_tablebase_probe_ignores_en_passant_target_without_capture(tablebases):
+    position = Position('8/8/8/8/8/8/4P3/K6k w - - 0 1').move('e4')
+    assert position.fen() == '8/8/8/8/4P3/8/8/K6k b - e3 0 1'
+    assert tablebases.probe(position) == tablebases.probe(Position('8/8/8/8/4P3/8/8/K6k b - - 0 1')) is not None
+
+
+def test_tablebase_is_consistent_with_move_generation(tablebases):
+    rng = random.Random(17)
+    checked = 0
+    while checked < 100:
+        squares = rng.sample(range(64), 3)
+        if squares[2] // 8 in (0, 7):
+            continue
+        board = ['.'] * 64
+        for char, sq in zip('KkP', squares):
+            board[sq] = char
+        placement = '/'.join(''.join(board[row * 8:row * 8 + 8]) for row in range(8))
+        position = Position(Position.fen_pieces_from_board_array(placement.split('/')) + ' w - - 0 1')
+        entry = tablebases.probe(position)
+        if entry is None:  # black in check
+            continue
+        children = []
+        for move in position.legal_moves():
+            position.push(move)
+            child = Position(position.fen().rsplit(' ', 3)[0] + ' - 0 1')  # the tables ignore en passant
+            children.append(tablebases.probe(child))
+            position.pop()
+        if not children:
+            expected = (-1, 0) if position._in_check() else (0, None)
+        elif any(child.wdl == -1 for child in children):
+            expected = (1, min(child.dtm for child in children if child.wdl == -1) + 1)
+        elif any(child.wdl == 0 for child in children):
+            expected = (0, None)
+        else:
+            expected = (-1, max(child.dtm for child in children) + 1)
+        assert entry == expected, position.fen()
+        checked += 1
+
+
+def test_tablebase_generate_rejects_unsupported_material(tmp_path):
+    with pytest.raises(ValueError):
+        deepes.Tablebases(str(tmp_path)).generate('KQRvKR')
+    with pytest.raises(ValueError):
+        deepes.Tablebases(str(tmp_path)).generate('KQvQ')
+
+
+def test_search_scores_tablebase_positions(tablebases):
+    position = Position('8/8/8/8/8/8/R7/K6k w - - 0 1')
+    result = Searcher(tablebases=tablebases).search(position, max_depth=3)
+    assert result.score == MATE_SCORE - 13
+    position.push(result.move)
+    assert tablebases.probe(Position(position.fen())) == (-1, 12)
+
+
+def test_uci_tablebase_path(tablebases):
+    session = dedent('''
+        setoption name TablebasePath value {}
+        setoption name Hash value 1
+        position fen 4k3/8/4K3/4P3/8/8/8/8 w - - 0 1
+        go depth 2
+    ''').format(tablebases.directory)
+    out = io.StringIO()
+    engine = UCIEngine(io.StringIO(session), out)
+    engine.run()
+    assert 'score mate 11' in out.getvalue()
+    assert engine.searcher.tablebase_hits > 0
+    engine.searcher.tablebases.close()
+
+
 # # this shall be covered by some other function
 #
 # @xfail
@@ -300,8 +1397,4 @@ def test_candidate_targets_king():
 
 # TODO: tests to write
 # - actual moves for bishops, knights, queens and kings
-# - no moves that cause check for ourselves
-# - when checked, no moves that do not escape check
 # - checking and mating moves
-# - en passant
-# - castling
@@ -0,0 +1,101 @@
+"""
+Perft correctness and throughput suite.
+
+The node counts are the well-known reference values for each position. The benchmarks time perft at the depth
+recorded in perft_baseline.json and fail if throughput drops more than BASELINE_TOLERANCE below the recorded
+nodes/second. Run them with ``pytest --run-benchmarks test_perft.py``, and record a new baseline on the reference
+machine with ``python test_perft.py``.
+"""
+import json
+import os
+import time
+
+import pytest
+
+from deepes import Position, perft, perft_divide
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'perft_baseline.json')
+BASELINE_TOLERANCE = 0.3
+
+# name: (fen, node counts for depths 1, 2, 3, ...)
+PERFT_POSITIONS = {
+    'start': ('rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1',
+              (20, 400, 8902, 197281, 4865609)),
+    'kiwipete': ('r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1',
+                 (48, 2039, 97862, 4085603)),
+    'position3': ('8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1',
+                  (14, 191, 2812, 43238, 674624)),
+    'position4': ('r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1',
+                  (6, 264, 9467, 422333)),
+    'position4_mirrored': ('r2q1rk1/pP1p2pp/Q4n2/bbp1p3/Np6/1B3NBn/pPPP1PPP/R3K2R b KQ - 0 1',
+                           (6, 264, 9467, 422333)),
+    'position5': ('rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8',
+                  (44, 1486, 62379, 2103487)),
+    'position6': ('r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10',
+                  (46, 2079, 89890, 3894594)),
+}
+
+# deepest depth checked by the regular test run for each position, keeping it within a few seconds
+CORRECTNESS_DEPTHS = {'start': 3, 'kiwipete': 2, 'position3': 4, 'position4': 3, 'position4_mirrored': 3,
+                      'position5': 2, 'position6': 2}
+
+
+def _load_baseline():
+    with open(BASELINE_FILE) as f:
+        return json.load(f)
+
+
+def _measure(name, depth, repeat=3):
+    """Best nodes/second of a few perft runs, which is less sensitive to noise from other processes than the mean."""
+    fen, counts = PERFT_POSITIONS[name]
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        nodes = perft(Position(fen), depth)
+        best = min(best, time.perf_counter() - start)
+        assert nodes == counts[depth - 1]
+    return nodes / best
+
+
+@pytest.mark.parametrize('name', sorted(PERFT_POSITIONS))
+def test_perft(name):
+    fen, counts = PERFT_POSITIONS[name]
+    for depth in range(1, CORRECTNESS_DEPTHS[name] + 1):
+        assert perft(Position(fen), depth) == counts[depth - 1]
+
+
+def test_perft_depth_zero():
+    assert perft(Position(), 0) == 1
+
+
+def test_perft_divide():
+    fen, counts = PERFT_POSITIONS['kiwipete']
+    divided = perft_divide(Position(fen), 2)
+    assert len(divided) == counts[0]
+    assert sum(divided.values()) == counts[1]
+    assert divided['e1g1'] == 43
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize('name', sorted(PERFT_POSITIONS))
+def test_perft_throughput(name):
+    baseline = _load_baseline()[name]
+    nodes_per_second = _measure(name, baseline['depth'])
+    assert nodes_per_second >= baseline['nodes_per_second'] * (1 - BASELINE_TOLERANCE), \
+        '{:.0f} nodes/s, baseline {:.0f} nodes/s'.format(nodes_per_second, baseline['nodes_per_second'])
+
+
+def write_baseline():
+    depths = {name: min(len(counts), CORRECTNESS_DEPTHS[name] + 1)
+              for name, (fen, counts) in PERFT_POSITIONS.items()}
+    baseline = {name: {'depth': depth, 'nodes_per_second': round(_measure(name, depth))}
+                for name, depth in sorted(depths.items())}
+    with open(BASELINE_FILE, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+        f.write('\n')
+    return baseline
+
+
+if __name__ == '__main__':
+    for name, result in write_baseline().items():
+        print('{:<20} depth {} {:>10} nodes/s'.format(name, result['depth'], result['nodes_per_second']))